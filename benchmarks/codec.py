@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+""" micro-benchmarks of fsocks.protocol and fsocks.socks codecs
+
+Framing runs once per relayed chunk, so its cost is a floor of the
+per-byte cost of the tunnel.
+
+    python3 benchmarks/codec.py
+    python3 benchmarks/codec.py --fuzz XOR,Base64 --payload 16384 -k relay
+
+ns/op is the best of --repeat runs of --number operations.
+peak B/op is the memory allocated at peak during one operation, and
+blocks/op the memory blocks still allocated after it, per tracemalloc
+and sys.getallocatedblocks(): CPython has no allocation counter.
+"""
+import io
+import os
+import gc
+import sys
+import time
+import asyncio
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fsocks import protocol, socks, fuzzing, cryption  # noqa: E402
+
+
+def make_fuzz(names):
+    return fuzzing.FuzzChain([getattr(fuzzing, name)()
+                              for name in names.split(',')])
+
+
+def socks_messages():
+    cases = (('ipv4', socks.ATYPE.IPV4, ('93.184.216.34', 443)),
+             ('ipv6', socks.ATYPE.IPV6, ('2606:2800:220:1::248', 443)),
+             ('domain', socks.ATYPE.DOMAINNAME, ('www.example.com', 443)))
+    return [(name, socks.Message(socks.VER.SOCKS5, socks.CMD.CONNECT,
+                                 atype, addr))
+            for name, atype, addr in cases]
+
+
+def cases(args, loop):
+    """ yield (name, func) of single operations """
+    aes = cryption.AES256CBC('benchmark')
+    fuzz = make_fuzz(args.fuzz)
+    request = socks_messages()[2][1]
+    reply = socks.Message(socks.VER.SOCKS5, socks.REP.SUCCEEDED,
+                          socks.ATYPE.IPV4, ('0.0.0.0', 0))
+    messages = [
+        ('hello', protocol.Hello(), aes),
+        ('handshake', protocol.HandShake(make_fuzz(args.fuzz)), aes),
+        ('request', protocol.Request(1, 0, request), fuzz),
+        ('reply', protocol.Reply(2, 1, reply), fuzz),
+        ('relay', protocol.Relaying(1, 2, os.urandom(args.payload)), fuzz),
+        ('close', protocol.Close(1), fuzz),
+    ]
+    for name, msg, cipher in messages:
+        packet = msg.to_packet(cipher)
+        yield '{}.to_packet'.format(name), \
+            lambda msg=msg, cipher=cipher: msg.to_packet(cipher)
+        yield '{}.read_packet'.format(name), \
+            lambda p=packet, cipher=cipher: \
+            protocol.read_packet(io.BytesIO(p), cipher)
+        yield '{}.async_read_packet'.format(name), \
+            AsyncRead(packet, cipher, loop)
+    # a new RELAYING per chunk, from bytes or read into a pooled buffer
+    data = os.urandom(args.payload)
+    yield 'relay.new.to_packet', lambda: protocol.Relaying(
+        1, 2, data).to_packet(fuzz)
+    buf = bytearray(protocol.Relaying.header.size + args.payload)
+    payload = memoryview(buf)[protocol.Relaying.header.size:]
+    yield 'relay.pooled.to_packet', lambda: protocol.Relaying(
+        1, 2, payload, buf).to_packet(fuzz)
+    # segments as written by the scheduler
+    yield 'relay.pooled.to_frame', lambda: protocol.Relaying(
+        1, 2, payload, buf).to_frame(fuzz)
+    # fuzz chain alone, allocating its result or into a reused buffer
+    encrypted = fuzz.encrypt(data)
+    dst = bytearray(fuzz.max_expansion(args.payload))
+    yield 'fuzz.encrypt', lambda: fuzz.encrypt(data)
+    yield 'fuzz.encrypt_into', lambda: fuzz.encrypt_into(data, dst)
+    yield 'fuzz.decrypt', lambda: fuzz.decrypt(encrypted)
+    yield 'fuzz.decrypt_into', lambda: fuzz.decrypt_into(encrypted, dst)
+    for name, msg in socks_messages():
+        data = msg.to_bytes()
+        yield 'socks.{}.to_bytes'.format(name), msg.to_bytes
+        yield 'socks.{}.from_stream'.format(name), \
+            lambda data=data: socks.Message.from_stream(io.BytesIO(data))
+
+
+class AsyncRead:
+    """ async_read_packet from a StreamReader fed with the packet, the
+    coroutine is driven by hand to keep the event loop out of timings
+    """
+
+    def __init__(self, packet, cipher, loop):
+        self.packet = packet
+        self.cipher = cipher
+        self.reader = asyncio.StreamReader(loop=loop)
+
+    def __call__(self):
+        self.reader.feed_data(self.packet)
+        coro = protocol.async_read_packet(self.reader, self.cipher)
+        try:
+            coro.send(None)
+        except StopIteration as e:
+            return e.value
+        raise RuntimeError('async_read_packet blocked')
+
+
+def timeit(func, number, repeat):
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter_ns()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter_ns() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best / number
+
+
+def allocations(func, number):
+    func()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    gc.disable()
+    try:
+        blocks = sys.getallocatedblocks()
+        results = [func() for _ in range(number)]
+        blocks = sys.getallocatedblocks() - blocks
+        del results
+    finally:
+        gc.enable()
+    return peak, blocks / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fuzz', default='Plain',
+                        help='comma separated fuzz chain of relayed frames')
+    parser.add_argument('--payload', type=int, default=2048,
+                        help='RELAYING payload size')
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('-k', dest='keyword',
+                        help='only run cases containing keyword')
+    args = parser.parse_args()
+    print('{:<32}{:>12}{:>12}{:>12}'.format(
+        'case', 'ns/op', 'peak B/op', 'blocks/op'))
+    loop = asyncio.new_event_loop()
+    try:
+        for name, func in cases(args, loop):
+            if args.keyword and args.keyword not in name:
+                continue
+            ns = timeit(func, args.number, args.repeat)
+            peak, blocks = allocations(func, args.number)
+            print('{:<32}{:>12.0f}{:>12}{:>12.2f}'.format(
+                name, ns, peak, blocks))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
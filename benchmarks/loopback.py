@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+""" end-to-end loopback benchmark
+
+Starts a sink server, fserver and fclient on localhost, then drives N
+concurrent SOCKS5 clients through them:
+
+- short workers open a connection, send a small request, read a small
+  response and close, like HTTP/1.0 requests
+- bulk workers keep one connection and download large responses
+
+    python3 benchmarks/loopback.py --short 50 --bulk 2 --duration 10
+    python3 benchmarks/loopback.py --save master
+    python3 benchmarks/loopback.py --compare master
+
+Baselines are JSON files in benchmarks/baselines/ (not versioned).
+"""
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(ROOT, 'benchmarks', 'baselines')
+
+# sink request header: request length, response length
+HEADER = struct.Struct('!II')
+
+
+async def serve_client(reader, writer):
+    try:
+        while True:
+            head = await reader.readexactly(HEADER.size)
+            req_len, resp_len = HEADER.unpack(head)
+            await reader.readexactly(req_len)
+            chunk = b'x' * min(resp_len, 65536)
+            while resp_len > 0:
+                writer.write(chunk[:resp_len])
+                resp_len -= len(chunk)
+                await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    writer.close()
+
+
+def run_sink(port):
+    """ request/response server: reads HEADER and request, writes
+    response length bytes back
+    """
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        asyncio.start_server(serve_client, '127.0.0.1', port))
+    loop.run_forever()
+
+
+class Stats:
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.connect_latency = []
+        self.latency = []
+
+    def merge(self, other):
+        self.connections += other.connections
+        self.requests += other.requests
+        self.errors += other.errors
+        self.bytes += other.bytes
+        self.connect_latency += other.connect_latency
+        self.latency += other.latency
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def socks_connect(socks_port, port):
+    """ open a connection to 127.0.0.1:port through SOCKS5 """
+    reader, writer = await asyncio.open_connection('127.0.0.1', socks_port)
+    # greeting and request pipelined, as curl does
+    writer.write(b'\x05\x01\x00\x05\x01\x00\x01' +
+                 socket.inet_aton('127.0.0.1') + struct.pack('!H', port))
+    greeting = await reader.readexactly(2)
+    reply = await reader.readexactly(10)
+    if greeting != b'\x05\x00' or reply[1] != 0:
+        writer.close()
+        raise ConnectionError('SOCKS5 failure {!r}'.format(reply))
+    return reader, writer
+
+
+async def request(reader, writer, req_len, resp_len):
+    writer.write(HEADER.pack(req_len, resp_len) + b'r' * req_len)
+    remain = resp_len
+    while remain > 0:
+        data = await reader.read(min(remain, 262144))
+        if not data:
+            raise ConnectionError('connection closed')
+        remain -= len(data)
+
+
+async def short_worker(args, deadline, stats):
+    loop = asyncio.get_event_loop()
+    while loop.time() < deadline:
+        begin = loop.time()
+        writer = None
+        try:
+            reader, writer = await socks_connect(args.socks_port,
+                                                 args.sink_port)
+            connected = loop.time()
+            stats.connect_latency.append(connected - begin)
+            stats.connections += 1
+            for _ in range(args.requests_per_conn):
+                start = loop.time()
+                await request(reader, writer,
+                              args.request_size, args.response_size)
+                stats.latency.append(loop.time() - start)
+                stats.requests += 1
+                stats.bytes += args.request_size + args.response_size
+        except (ConnectionError, asyncio.IncompleteReadError, OSError):
+            stats.errors += 1
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+async def bulk_worker(args, deadline, stats):
+    loop = asyncio.get_event_loop()
+    try:
+        reader, writer = await socks_connect(args.socks_port, args.sink_port)
+    except (ConnectionError, asyncio.IncompleteReadError, OSError):
+        stats.errors += 1
+        return
+    stats.connections += 1
+    try:
+        while loop.time() < deadline:
+            await request(reader, writer, 64, args.bulk_size)
+            stats.requests += 1
+            stats.bytes += args.bulk_size
+    except (ConnectionError, asyncio.IncompleteReadError, OSError):
+        stats.errors += 1
+    writer.close()
+
+
+async def drive(args):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + args.duration
+    short, bulk = Stats(), Stats()
+    workers = [short_worker(args, deadline, short)
+               for _ in range(args.short)]
+    workers += [bulk_worker(args, deadline, bulk) for _ in range(args.bulk)]
+    begin = loop.time()
+    await asyncio.gather(*workers)
+    return short, bulk, loop.time() - begin
+
+
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('port {} not ready'.format(port))
+
+
+def start_processes(args, tmpdir):
+    base = {
+        'client_host': '127.0.0.1',
+        'client_port': args.socks_port,
+        'server_host': '127.0.0.1',
+        'server_port': args.socks_port + 1,
+        'password': 'benchmark',
+        'timeout': 3,
+        'loglevel': 'WARNING',
+    }
+    base.update(json.loads(args.config))
+    path = os.path.join(tmpdir, 'config.json')
+    with open(path, 'w') as f:
+        json.dump(base, f)
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable,
+                                       os.path.abspath(__file__),
+                                       '--sink', str(args.sink_port)]))
+        wait_port(args.sink_port)
+        for script, port in (('fserver.py', base['server_port']),
+                             ('fclient.py', base['client_port'])):
+            with open(os.path.join(tmpdir, script + '.log'), 'w') as log:
+                procs.append(subprocess.Popen(
+                    [sys.executable, os.path.join(ROOT, script), '-c', path],
+                    cwd=ROOT, stdout=log, stderr=subprocess.STDOUT))
+            wait_port(port)
+    except BaseException:
+        # the caller never gets procs to clean up
+        stop_processes(procs)
+        raise
+    return procs
+
+
+def stop_processes(procs):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        proc.wait()
+
+
+def summarize(short, bulk, elapsed):
+    total = Stats()
+    total.merge(short)
+    total.merge(bulk)
+    ms = 1000.0
+    return {
+        'elapsed': elapsed,
+        'connections_per_sec': short.connections / elapsed,
+        'requests_per_sec': short.requests / elapsed,
+        'short_mb_per_sec': short.bytes / elapsed / 1e6,
+        'bulk_mb_per_sec': bulk.bytes / elapsed / 1e6,
+        'total_mb_per_sec': total.bytes / elapsed / 1e6,
+        'errors': total.errors,
+        'connect_p50_ms': percentile(short.connect_latency, 0.5) * ms,
+        'connect_p99_ms': percentile(short.connect_latency, 0.99) * ms,
+        'latency_p50_ms': percentile(short.latency, 0.5) * ms,
+        'latency_p99_ms': percentile(short.latency, 0.99) * ms,
+        'latency_p999_ms': percentile(short.latency, 0.999) * ms,
+    }
+
+
+def report(result, baseline=None):
+    for key, value in sorted(result.items()):
+        line = '{:<22}{:>12.3f}'.format(key, value)
+        if baseline is not None and key in baseline:
+            old = baseline[key]
+            if old:
+                line += '  {:>+8.1f}%'.format((value - old) / old * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--short', type=int, default=50,
+                        help='concurrent short request workers')
+    parser.add_argument('--bulk', type=int, default=2,
+                        help='concurrent bulk download streams')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--requests-per-conn', type=int, default=1)
+    parser.add_argument('--request-size', type=int, default=200)
+    parser.add_argument('--response-size', type=int, default=2000)
+    parser.add_argument('--bulk-size', type=int, default=4 << 20,
+                        help='bytes per bulk response')
+    parser.add_argument('--socks-port', type=int, default=21080,
+                        help='fclient port, fserver uses the next one')
+    parser.add_argument('--sink-port', type=int, default=21090)
+    parser.add_argument('--config', default='{}',
+                        help='JSON merged into fserver/fclient config')
+    parser.add_argument('--save', metavar='NAME',
+                        help='save result as baseline NAME')
+    parser.add_argument('--compare', metavar='NAME',
+                        help='compare result with baseline NAME')
+    parser.add_argument('--sink', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.sink:
+        return run_sink(args.sink)
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BASELINES, args.compare + '.json')) as f:
+            baseline = json.load(f)['result']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        procs = start_processes(args, tmpdir)
+        try:
+            loop = asyncio.get_event_loop()
+            short, bulk, elapsed = loop.run_until_complete(drive(args))
+        finally:
+            stop_processes(procs)
+    result = summarize(short, bulk, elapsed)
+    report(result, baseline)
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        options = dict((k, v) for k, v in vars(args).items()
+                       if k not in ('save', 'compare', 'sink'))
+        with open(os.path.join(BASELINES, args.save + '.json'), 'w') as f:
+            json.dump({'options': options, 'result': result}, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
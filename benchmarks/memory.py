@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+""" memory footprint per channel, on both ends
+
+fserver and fclient run in child processes under tracemalloc. The
+driver opens --channels SOCKS5 connections to a local echo server
+through them and reports traced bytes per channel:
+
+- idle: connected, nothing relayed yet
+- active: after --chunk bytes were echoed on every channel
+
+    python3 benchmarks/memory.py --channels 1000
+"""
+import os
+import sys
+import gc
+import json
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from loopback import socks_connect, wait_port  # noqa: E402
+
+
+def run_side(side, path):
+    """ child process: run one end, print traced bytes for every
+    'measure' line read on stdin
+    """
+    tracemalloc.start()
+    from fsocks import config, tunnel_server, tunnel_client
+    sys.argv = [sys.argv[0], '-c', path]
+    config.load_args()
+    loop = asyncio.get_event_loop()
+    if side == 'server':
+        loop.run_until_complete(loop.create_server(
+            tunnel_server.TunnelServer, *config.server_address))
+    else:
+        client = tunnel_client.TunnelClient()
+        client.start(loop)
+
+    def measure():
+        if not sys.stdin.readline():
+            loop.stop()
+            return
+        gc.collect()
+        print(tracemalloc.get_traced_memory()[0], flush=True)
+    loop.add_reader(sys.stdin.fileno(), measure)
+    print('ready', flush=True)
+    loop.run_forever()
+
+
+class Side:
+
+    def __init__(self, side, path):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--side', side,
+             path], cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        while self.proc.stdout.readline().strip() != 'ready':
+            pass
+
+    def measure(self):
+        self.proc.stdin.write('measure\n')
+        self.proc.stdin.flush()
+        return int(self.proc.stdout.readline())
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.terminate()
+        self.proc.wait()
+
+
+async def echo(reader, writer):
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+
+
+async def settle():
+    await asyncio.sleep(0.5)
+
+
+async def exchange(reader, writer, chunk):
+    writer.write(b'x' * chunk)
+    await reader.readexactly(chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--channels', type=int, default=1000)
+    parser.add_argument('--chunk', type=int, default=16384,
+                        help='bytes echoed per active channel')
+    parser.add_argument('--socks-port', type=int, default=22080)
+    parser.add_argument('--echo-port', type=int, default=22090)
+    parser.add_argument('--config', default='{}',
+                        help='JSON merged into fserver/fclient config')
+    parser.add_argument('--side', help=argparse.SUPPRESS)
+    parser.add_argument('path', nargs='?', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.side:
+        return run_side(args.side, args.path)
+
+    cfg = {
+        'client_host': '127.0.0.1',
+        'client_port': args.socks_port,
+        'server_host': '127.0.0.1',
+        'server_port': args.socks_port + 1,
+        'password': 'benchmark',
+        'loglevel': 'WARNING',
+        'log_async': False,
+        'idle_timeout': 0,
+        'half_open_timeout': 0,
+    }
+    cfg.update(json.loads(args.config))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(
+        asyncio.start_server(echo, '127.0.0.1', args.echo_port))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'config.json')
+        with open(path, 'w') as f:
+            json.dump(cfg, f)
+        server = Side('server', path)
+        wait_port(cfg['server_port'])
+        client = Side('client', path)
+        wait_port(cfg['client_port'])
+        sides = (('fserver', server), ('fclient', client))
+        try:
+            results = {}
+            base = dict((name, side.measure()) for name, side in sides)
+            conns = loop.run_until_complete(asyncio.gather(*[
+                socks_connect(args.socks_port, args.echo_port)
+                for _ in range(args.channels)]))
+            loop.run_until_complete(settle())
+            results['idle'] = dict((name, side.measure())
+                                   for name, side in sides)
+            loop.run_until_complete(asyncio.gather(*[
+                exchange(reader, writer, args.chunk)
+                for reader, writer in conns]))
+            loop.run_until_complete(settle())
+            results['active'] = dict((name, side.measure())
+                                     for name, side in sides)
+            for _, writer in conns:
+                writer.close()
+        finally:
+            server.close()
+            client.close()
+    print('{:<10}{:>16}{:>16}'.format('', 'idle B/chan', 'active B/chan'))
+    for name, _ in sides:
+        print('{:<10}{:>16.0f}{:>16.0f}'.format(
+            name,
+            (results['idle'][name] - base[name]) / args.channels,
+            (results['active'][name] - base[name]) / args.channels))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
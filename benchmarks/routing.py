@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+""" load time and lookup cost of fsocks.routing rule sets
+
+Generates --rules random CIDR and domain entries into rule files,
+loads them into a Router and reports:
+
+- load: seconds to load each file
+- ns/lookup: rule matching without cache, then through the cache
+
+    python3 benchmarks/routing.py
+    python3 benchmarks/routing.py --rules 300000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fsocks.routing import Router  # noqa: E402
+
+
+def write_rules(path, n, rnd):
+    with open(path + '.cidr', 'w') as f:
+        for _ in range(n):
+            f.write('{}.{}.{}.0/{}\n'.format(
+                rnd.randint(1, 223), rnd.randint(0, 255),
+                rnd.randint(0, 255), rnd.choice((16, 20, 22, 24))))
+    with open(path + '.domain', 'w') as f:
+        for i in range(n):
+            f.write('host{}.example{}.{}\n'.format(
+                i, i % 5000, rnd.choice(('cn', 'com', 'net'))))
+
+
+def per_lookup(func, hosts):
+    begin = time.perf_counter_ns()
+    for host in hosts:
+        func(host)
+    return (time.perf_counter_ns() - begin) / len(hosts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rules', type=int, default=100000,
+                        help='entries per rule file')
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+    rnd = random.Random(1)
+    router = Router()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'rules')
+        write_rules(path, args.rules, rnd)
+        for kind in ('cidr', 'domain'):
+            begin = time.perf_counter()
+            router.load(router.default, '{}.{}'.format(path, kind))
+            print('load {:<8}{:>10} entries{:>10.3f} sec'.format(
+                kind, args.rules, time.perf_counter() - begin))
+    ips = ['{}.{}.{}.{}'.format(rnd.randint(1, 223), rnd.randint(0, 255),
+                                rnd.randint(0, 255), rnd.randint(0, 255))
+           for _ in range(args.lookups)]
+    domains = ['www.host{}.example{}.com'.format(i, i % 5000)
+               for i in range(args.lookups)]
+    for kind, hosts in (('cidr', ips), ('domain', domains)):
+        uncached = per_lookup(router._match, hosts)
+        # fewer hosts than the cache holds
+        n = router.maxsize // 2
+        few = hosts[:n] * (len(hosts) // n)
+        cached = per_lookup(router.route, few)
+        print('lookup {:<6}{:>10.0f} ns{:>10.0f} ns cached'.format(
+            kind, uncached, cached))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+""" fclient cost per user, callback protocols vs streams
+
+For each user_mode, starts the loopback sink, fserver and fclient,
+opens --users SOCKS5 connections and reports:
+
+- setup: seconds to establish every connection
+- kB/user: growth of fclient resident memory per connected user
+- rtt p50/p99: one small request/response on every connection
+
+    python3 benchmarks/users.py --users 10000
+    python3 benchmarks/users.py --modes protocol --users 2000
+
+Open files are raised to the hard limit, 10k users need about 30k of
+them across the driver, fclient and fserver.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loopback import (socks_connect, request, start_processes,  # noqa: E402
+                      percentile)
+
+
+def rss(pid):
+    """ resident memory of pid in bytes """
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError('no VmRSS of {}'.format(pid))
+
+
+async def connect_all(args):
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def connect():
+        async with sem:
+            return await socks_connect(args.socks_port, args.sink_port)
+    return await asyncio.gather(*[connect() for _ in range(args.users)])
+
+
+async def round_trips(conns):
+    loop = asyncio.get_event_loop()
+
+    async def one(reader, writer):
+        begin = loop.time()
+        await request(reader, writer, 16, 16)
+        return loop.time() - begin
+    return await asyncio.gather(*[one(r, w) for r, w in conns])
+
+
+def run_mode(args, mode):
+    run = argparse.Namespace(**vars(args))
+    cfg = json.loads(args.config)
+    cfg.update({'user_mode': mode, 'idle_timeout': 0,
+                'half_open_timeout': 0, 'log_async': False})
+    run.config = json.dumps(cfg)
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        procs = start_processes(run, tmpdir)
+        fclient = procs[-1]
+        try:
+            time.sleep(0.5)
+            base = rss(fclient.pid)
+            begin = time.perf_counter()
+            conns = loop.run_until_complete(connect_all(args))
+            setup = time.perf_counter() - begin
+            time.sleep(0.5)
+            idle = rss(fclient.pid)
+            rtts = loop.run_until_complete(round_trips(conns))
+            for _, writer in conns:
+                writer.close()
+        finally:
+            for proc in procs:
+                proc.terminate()
+            for proc in procs:
+                proc.wait()
+    ms = 1000.0
+    return {
+        'setup_sec': setup,
+        'kb_per_user': (idle - base) / args.users / 1024,
+        'rtt_p50_ms': percentile(rtts, 0.5) * ms,
+        'rtt_p99_ms': percentile(rtts, 0.99) * ms,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--modes', default='protocol,stream',
+                        help='comma separated user_mode values')
+    parser.add_argument('--concurrency', type=int, default=500,
+                        help='connections being established at once')
+    parser.add_argument('--socks-port', type=int, default=23080,
+                        help='fclient port, fserver uses the next one')
+    parser.add_argument('--sink-port', type=int, default=23090)
+    parser.add_argument('--config', default='{}',
+                        help='JSON merged into fserver/fclient config')
+    args = parser.parse_args()
+
+    # inherited by the child processes
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    results = [(mode, run_mode(args, mode))
+               for mode in args.modes.split(',')]
+    keys = sorted(results[0][1])
+    print('{:<12}'.format('') +
+          ''.join('{:>14}'.format(key) for key in keys))
+    for mode, result in results:
+        print('{:<12}'.format(mode) +
+              ''.join('{:>14.3f}'.format(result[key]) for key in keys))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+""" admission control of fserver connects
+
+Connects (and their DNS lookups) in progress are limited globally, per
+tunnel and per destination. A connect over a limit waits in a FIFO
+queue of `max_queue` entries for at most `max_wait` seconds, it is
+rejected at once when the queue is full. A released slot goes to the
+first waiter it can be given to: one waiting for a busy destination
+does not block the others.
+"""
+import asyncio
+from collections import deque
+from . import metrics
+
+
+__all__ = ['Admission']
+
+
+queue_depth = metrics.registry.gauge(
+    'fsocks_connect_queue_depth', 'Connects waiting for admission')
+in_progress = metrics.registry.gauge(
+    'fsocks_connects_in_progress', 'Admitted connects not finished yet')
+wait_seconds = metrics.registry.histogram(
+    'fsocks_connect_wait_seconds', 'Time waited for connect admission',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10))
+rejected_full = metrics.registry.counter(
+    'fsocks_connect_rejected_total', 'Connects refused admission',
+    reason='queue_full')
+rejected_timeout = metrics.registry.counter(
+    'fsocks_connect_rejected_total', 'Connects refused admission',
+    reason='timeout')
+
+
+class Admission:
+
+    def __init__(self, total=256, per_tunnel=128, per_destination=16,
+                 max_queue=1024, max_wait=5):
+        self.configure(total, per_tunnel, per_destination,
+                       max_queue, max_wait)
+        self.active = 0
+        self.tunnels = {}  # tunnel -> connects in progress
+        self.destinations = {}  # (host, port) -> connects in progress
+        self.waiters = deque()  # (future, tunnel, destination)
+
+    def configure(self, total, per_tunnel, per_destination,
+                  max_queue, max_wait):
+        self.total = total
+        self.per_tunnel = per_tunnel
+        self.per_destination = per_destination
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+
+    def _admit(self, tunnel, dest):
+        if self.active >= self.total or \
+                self.tunnels.get(tunnel, 0) >= self.per_tunnel or \
+                self.destinations.get(dest, 0) >= self.per_destination:
+            return False
+        self.active += 1
+        self.tunnels[tunnel] = self.tunnels.get(tunnel, 0) + 1
+        self.destinations[dest] = self.destinations.get(dest, 0) + 1
+        in_progress.set(self.active)
+        return True
+
+    async def acquire(self, tunnel, dest):
+        """ wait for a connect slot, return False if rejected """
+        if self._admit(tunnel, dest):
+            return True
+        if len(self.waiters) >= self.max_queue:
+            rejected_full.inc()
+            return False
+        loop = asyncio.get_event_loop()
+        waiter = (loop.create_future(), tunnel, dest)
+        self.waiters.append(waiter)
+        queue_depth.set(len(self.waiters))
+        begin = loop.time()
+        timer = loop.call_later(self.max_wait, self._expire, waiter)
+        try:
+            return await waiter[0]
+        except asyncio.CancelledError:
+            fut = waiter[0]
+            if fut.done() and not fut.cancelled() and fut.result():
+                # admitted by _wake() before the cancel, give it back
+                self.release(tunnel, dest)
+            else:
+                self._remove(waiter)
+            raise
+        finally:
+            timer.cancel()
+            wait_seconds.observe(loop.time() - begin)
+
+    def _remove(self, waiter):
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass  # dropped by _wake()
+        queue_depth.set(len(self.waiters))
+
+    def _expire(self, waiter):
+        fut = waiter[0]
+        if not fut.done():
+            rejected_timeout.inc()
+            fut.set_result(False)
+            self._remove(waiter)
+
+    def release(self, tunnel, dest):
+        self.active -= 1
+        for counts, key in ((self.tunnels, tunnel),
+                            (self.destinations, dest)):
+            if counts[key] > 1:
+                counts[key] -= 1
+            else:
+                del counts[key]
+        in_progress.set(self.active)
+        if self.waiters:
+            self._wake()
+
+    def _wake(self):
+        waiters = deque()
+        for waiter in self.waiters:
+            fut, tunnel, dest = waiter
+            if fut.done():
+                # cancelled
+                continue
+            if self.active < self.total and self._admit(tunnel, dest):
+                fut.set_result(True)
+            else:
+                waiters.append(waiter)
+        self.waiters = waiters
+        queue_depth.set(len(waiters))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+""" size-classed pool of receive buffers
+
+Remote data is read straight into a pooled bytearray, behind room
+reserved for the RELAYING header, and the buffer goes back to the pool
+once the frame is encoded: relaying a chunk allocates no receive
+buffer and copies no payload before the fuzz pass.
+"""
+
+
+__all__ = ['BufferPool', 'pool']
+
+
+class BufferPool:
+
+    def __init__(self, classes=(4096, 16384, 65536, 262144), max_free=32):
+        """
+        :param classes: buffer sizes, ascending
+        :param max_free: free buffers kept per class, extra ones are
+                         left to the garbage collector
+        """
+        self.classes = tuple(classes)
+        self.max_free = max_free
+        self.free = dict((size, []) for size in self.classes)
+
+    def size_class(self, size):
+        """ smallest class holding size bytes, the biggest one at most """
+        for cls in self.classes:
+            if cls >= size:
+                return cls
+        return self.classes[-1]
+
+    def acquire(self, size):
+        cls = self.size_class(size)
+        free = self.free[cls]
+        if free:
+            return free.pop()
+        return bytearray(cls)
+
+    def release(self, buf):
+        free = self.free.get(len(buf))
+        if free is not None and len(free) < self.max_free:
+            free.append(buf)
+
+    def __len__(self):
+        """ number of free buffers """
+        return sum(len(free) for free in self.free.values())
+
+
+pool = BufferPool()
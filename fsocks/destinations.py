@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+""" connect statistics of fserver per destination host:port
+
+Connect timeouts follow the latency of each destination, like a TCP
+retransmission timeout (RFC 6298): smoothed RTT plus four deviations,
+doubled after each timeout, between `min_timeout` and `max_timeout`.
+
+A destination failing `failures` times in a row gets its circuit
+opened: connects to it fail fast, with the REP code of the last
+failure, for `ttl` seconds. Then one connect is let through, its
+success closes the circuit, its failure opens it again for twice as
+long, up to `max_ttl`.
+"""
+import errno
+import socket
+import asyncio
+from collections import OrderedDict
+from .socks import REP
+
+
+__all__ = ['Destinations', 'error_code']
+
+
+def error_code(exc):
+    """ SOCKS REP of a failed connect """
+    if isinstance(exc, asyncio.TimeoutError):
+        return REP.HOST_UNREACHABLE
+    if isinstance(exc, ConnectionRefusedError):
+        return REP.CONNECTION_REFUSED
+    if isinstance(exc, socket.gaierror):
+        return REP.HOST_UNREACHABLE
+    if isinstance(exc, OSError) and exc.errno == errno.ENETUNREACH:
+        return REP.NETWORK_UNREACHABLE
+    return REP.HOST_UNREACHABLE
+
+
+class Destination:
+    __slots__ = ('srtt', 'rttvar', 'backoff', 'failures', 'ttl',
+                 'open_until', 'code')
+
+    def __init__(self):
+        self.srtt = None  # no sample yet
+        self.rttvar = 0.0
+        self.backoff = 1
+        self.failures = 0  # in a row
+        self.ttl = 0  # of next opening
+        self.open_until = None  # circuit closed
+        self.code = None  # REP of last failure
+
+
+class Destinations:
+
+    def __init__(self, min_timeout=2, max_timeout=6.6, failures=3, ttl=5,
+                 max_ttl=60, maxsize=4096):
+        """
+        :param min_timeout: floor of adaptive timeouts, above the first
+                            SYN retransmission (1s)
+        :param maxsize: destinations tracked, least recent ones are
+                        forgotten
+        """
+        self.configure(min_timeout, max_timeout, failures, ttl, max_ttl)
+        self.maxsize = maxsize
+        self.table = OrderedDict()  # (host, port) -> Destination
+
+    def configure(self, min_timeout, max_timeout, failures, ttl, max_ttl=60):
+        self.min_timeout = min_timeout
+        self.max_timeout = max(min_timeout, max_timeout)
+        self.failures = failures
+        self.ttl = ttl
+        self.max_ttl = max(ttl, max_ttl)
+
+    def _get(self, key):
+        dest = self.table.get(key)
+        if dest is None:
+            if len(self.table) >= self.maxsize:
+                self.table.popitem(last=False)
+            dest = self.table[key] = Destination()
+        else:
+            self.table.move_to_end(key)
+        return dest
+
+    def timeout(self, key):
+        """ connect timeout of destination key """
+        dest = self.table.get(key)
+        if dest is None or dest.srtt is None:
+            return self.max_timeout
+        rto = (dest.srtt + 4 * dest.rttvar) * dest.backoff
+        return min(max(rto, self.min_timeout), self.max_timeout)
+
+    def check(self, key, now):
+        """ REP code to fail fast with, None to connect """
+        dest = self.table.get(key)
+        if dest is None or dest.open_until is None:
+            return None
+        if now < dest.open_until:
+            return dest.code
+        # half open: let this one try, others keep failing fast with
+        # the last code until its result closes or reopens the circuit
+        dest.open_until = now + self.max_timeout
+        return None
+
+    def succeeded(self, key, rtt):
+        dest = self._get(key)
+        if dest.srtt is None:
+            dest.srtt = rtt
+            dest.rttvar = rtt / 2
+        else:
+            dest.rttvar += (abs(dest.srtt - rtt) - dest.rttvar) / 4
+            dest.srtt += (rtt - dest.srtt) / 8
+        dest.backoff = 1
+        dest.failures = 0
+        dest.ttl = 0
+        dest.open_until = None
+        dest.code = None
+
+    def failed(self, key, code, now, timed_out=False):
+        dest = self._get(key)
+        dest.code = code
+        dest.failures += 1
+        if timed_out:
+            dest.backoff = min(dest.backoff * 2, 64)
+        if self.failures and dest.failures >= self.failures:
+            dest.ttl = min(dest.ttl * 2, self.max_ttl) or self.ttl
+            dest.open_until = now + dest.ttl
+
+    def open_circuits(self, now):
+        return sum(1 for dest in self.table.values()
+                   if dest.open_until is not None and now < dest.open_until)
+
+    def __len__(self):
+        return len(self.table)
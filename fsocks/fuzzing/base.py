@@ -9,11 +9,31 @@ class FuzzError(ValueError):
     pass
 
 
+def translate(data, table):
+    """ bytes.translate() of any bytes-like data """
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    return data.translate(table)
+
+
+def copy_into(data, dst):
+    n = len(data)
+    dst[:n] = data
+    return n
+
+
 class BaseFuzz:
     """ Every fuzz method have following rules:
     1. accept a bytes string as initial key
     2. if initial key is None, use a (suitable)random one
     3. fuzz.decrypt(fuzz.encrypt(data)) === data
+    4. decrypted data is never longer than encrypted data
+
+    encrypt/decrypt accept any bytes-like data. encrypt_into and
+    decrypt_into write to a caller's buffer, not overlapping the source,
+    instead: those of the base class copy the result of encrypt/decrypt,
+    fuzz methods computing in place override them and wrap them in
+    encrypt/decrypt.
     """
     enabled = True
 
@@ -26,6 +46,22 @@ class BaseFuzz:
     def decrypt(self, data: bytes):
         pass
 
+    def max_expansion(self, n):
+        """ upper bound of len(encrypt(data)) with len(data) == n """
+        return n
+
+    def encrypt_into(self, src, dst):
+        """ encrypt src into the writable buffer dst of at least
+        max_expansion(len(src)) bytes, return the length written
+        """
+        return copy_into(self.encrypt(src), dst)
+
+    def decrypt_into(self, src, dst):
+        """ decrypt src into dst of at least len(src) bytes, return the
+        length written
+        """
+        return copy_into(self.decrypt(src), dst)
+
     @property
     def _name(self):
         return self.__class__.__name__
@@ -43,21 +79,68 @@ class BaseFuzz:
 
 
 class FuzzChain:
+    """ fuzz methods applied in turn
+
+    Intermediate results ping-pong between two scratch buffers reused
+    by every frame, only the last stage allocates a result.
+    """
 
     def __init__(self, fuzz_list):
         self.fuzz_list = fuzz_list
+        self.scratch = [bytearray(), bytearray()]
 
-    def encrypt(self, data):
-        result = data
+    def max_expansion(self, n):
         for fuzz in self.fuzz_list:
-            result = fuzz.encrypt(result)
+            n = fuzz.max_expansion(n)
+        return n
+
+    def _stages(self, fuzz_list, data, encrypt):
+        """ run data through fuzz_list, return a view of the result in
+        a scratch buffer
+        """
+        for i, fuzz in enumerate(fuzz_list):
+            dst = self.scratch[i % 2]
+            need = fuzz.max_expansion(len(data)) if encrypt else len(data)
+            if len(dst) < need:
+                dst = self.scratch[i % 2] = bytearray(max(need, 2 * len(dst)))
+            if encrypt:
+                n = fuzz.encrypt_into(data, dst)
+            else:
+                n = fuzz.decrypt_into(data, dst)
+            data = memoryview(dst)[:n]
+        return data
+
+    def _run(self, fuzz_list, data, encrypt):
+        if not fuzz_list:
+            return data
+        view = self._stages(fuzz_list[:-1], data, encrypt)
+        last = fuzz_list[-1]
+        result = last.encrypt(view) if encrypt else last.decrypt(view)
+        if result is view and view is not data:
+            # Plain returns its input, never hand out a scratch buffer
+            result = bytes(view)
         return result
 
+    def _run_into(self, fuzz_list, src, dst, encrypt):
+        if not fuzz_list:
+            return copy_into(src, dst)
+        view = self._stages(fuzz_list[:-1], src, encrypt)
+        last = fuzz_list[-1]
+        if encrypt:
+            return last.encrypt_into(view, dst)
+        return last.decrypt_into(view, dst)
+
+    def encrypt(self, data):
+        return self._run(self.fuzz_list, data, True)
+
     def decrypt(self, data):
-        result = data
-        for fuzz in reversed(self.fuzz_list):
-            result = fuzz.decrypt(result)
-        return result
+        return self._run(self.fuzz_list[::-1], data, False)
+
+    def encrypt_into(self, src, dst):
+        return self._run_into(self.fuzz_list, src, dst, True)
+
+    def decrypt_into(self, src, dst):
+        return self._run_into(self.fuzz_list[::-1], src, dst, False)
 
     def to_bytes(self):
         result = b''
@@ -1,5 +1,5 @@
 import base64
-from .base import BaseFuzz
+from .base import BaseFuzz, translate, copy_into
 
 
 __all__ = ['Plain', 'Base64', 'Base32', 'Base16',
@@ -37,6 +37,12 @@ class Plain(CodecFuzz):
     def decode(self, data):
         return data
 
+    def encrypt_into(self, src, dst):
+        return copy_into(src, dst)
+
+    def decrypt_into(self, src, dst):
+        return copy_into(src, dst)
+
 
 class Base64(CodecFuzz):
     def encode(self, data):
@@ -45,6 +51,9 @@ class Base64(CodecFuzz):
     def decode(self, data):
         return base64.b64decode(data)
 
+    def max_expansion(self, n):
+        return (n + 2) // 3 * 4
+
 
 class Base32(CodecFuzz):
     def encode(self, data):
@@ -53,6 +62,9 @@ class Base32(CodecFuzz):
     def decode(self, data):
         return base64.b32decode(data)
 
+    def max_expansion(self, n):
+        return (n + 4) // 5 * 8
+
 
 class Base16(CodecFuzz):
     def encode(self, data):
@@ -61,6 +73,9 @@ class Base16(CodecFuzz):
     def decode(self, data):
         return base64.b16decode(data)
 
+    def max_expansion(self, n):
+        return n * 2
+
 
 class Base85(CodecFuzz):
     def encode(self, data):
@@ -69,56 +84,48 @@ class Base85(CodecFuzz):
     def decode(self, data):
         return base64.b85decode(data)
 
-
-def byte2bit(value):
-    return bin(value)[2:].zfill(8)
+    def max_expansion(self, n):
+        return (n + 3) // 4 * 5
 
 
-def bit2byte(bits):
-    return int(bits, base=2)
+B64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
 
 
 class XXencode(CodecFuzz):
-    """XXencode"""
+    """XXencode
+
+    Same 6 bits groups as base64 with another alphabet: base64 is done
+    by binascii and its alphabet translated. Input is zero padded to a
+    multiple of 3 bytes, the first byte tells the padding length.
+    """
     enabled = False
     table = bytearray(b'+-0123456789'
                       b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
                       b'abcdefghijklmnopqrstuvwxyz')
 
-    # FIXME: kinda slow
+    def __init__(self, key: bytes=None):
+        super().__init__(key)
+        table = bytes(self.table)
+        # '=' stands for the zero padding bytes
+        self.encode_table = bytes.maketrans(B64_ALPHABET + b'=',
+                                            table + table[:1])
+        self.decode_table = bytes.maketrans(table, B64_ALPHABET)
+
     def encode(self, data):
-        data = bytearray(data)
-        result = bytearray()
-        remains = len(data) % 3
-        paddings = 0 if not remains else 3 - remains
-        result.append(paddings)
-        for _ in range(paddings):
-            data.append(0)
-        for i in range(0, len(data), 3):
-            bits = ''
-            for j in range(3):
-                bits += byte2bit(data[i + j])
-            assert len(bits) == 24
-            for k in range(0, 24, 6):
-                nb = bit2byte(bits[k: k + 6])
-                result.append(self.table[nb])
-        return bytes(result)
+        paddings = -len(data) % 3
+        return bytes((paddings,)) + \
+            base64.b64encode(data).translate(self.encode_table)
 
     def decode(self, data):
         paddings = data[0]
-        data = bytearray(data[1:])
-        result = bytearray()
-        bits = ''
-        for b in data:
-            nb = self.table.find(b)
-            bits += byte2bit(nb)[2:]
-        assert len(bits) % 8 == 0
-        for i in range(0, len(bits), 8):
-            result.append(bit2byte(bits[i: i + 8]))
+        result = base64.b64decode(translate(data[1:], self.decode_table))
         if paddings != 0:
-            return bytes(result[:-paddings])
+            return result[:-paddings]
         else:
-            return bytes(result)
+            return result
+
+    def max_expansion(self, n):
+        return 1 + (n + 2) // 3 * 4
 
 
 class UUencode(XXencode):
@@ -126,12 +133,10 @@ class UUencode(XXencode):
 
 
 class AtBash(CodecFuzz):
+    table = bytes(range(0xFF, -1, -1))
 
     def encode(self, data):
-        result = bytearray()
-        for b in data:
-            result.append(abs(0xFF - b))
-        return bytes(result)
+        return translate(data, self.table)
 
     def decode(self, data):
         return self.encrypt(data)
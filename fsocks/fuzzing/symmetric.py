@@ -2,7 +2,7 @@
 import math
 from random import randint
 import struct
-from .base import BaseFuzz, FuzzError
+from .base import BaseFuzz, FuzzError, translate, copy_into
 
 __all__ = ['XOR', 'RailFence']
 
@@ -19,6 +19,7 @@ class XOR(BaseFuzz):
                 self.ikey, = struct.unpack('!B', self.key)
             except struct.error:
                 raise FuzzError
+        self.table = bytes(b ^ self.ikey for b in range(256))
 
     def encrypt(self, data):
         return self.xor_codec(data)
@@ -27,12 +28,7 @@ class XOR(BaseFuzz):
         return self.xor_codec(data)
 
     def xor_codec(self, data):
-        result = bytearray()
-        for b in data:
-            result.append(b ^ self.ikey)
-        result = bytes(result)
-        assert len(data) == len(result)
-        return result
+        return translate(data, self.table)
 
 
 class RailFence(BaseFuzz):
@@ -52,22 +48,63 @@ class RailFence(BaseFuzz):
     def encrypt(self, data):
         if not self.reasonable(data):
             return data
-        return bytes(self.fence(data))
+        result = bytearray(len(data))
+        self.encrypt_into(data, result)
+        return bytes(result)
 
     def decrypt(self, data):
         if not self.reasonable(data):
             return data
-        lst = range(len(data))
-        pos = dict(((v, i) for i, v in enumerate(self.fence(lst))))
-        return bytes((data[pos[n]] for n in lst))
+        result = bytearray(len(data))
+        self.decrypt_into(data, result)
+        return bytes(result)
+
+    def encrypt_into(self, src, dst):
+        if not self.reasonable(src):
+            return copy_into(src, dst)
+        src = memoryview(src)
+        dst = memoryview(dst)
+        pos = 0
+        for first, second, count in self.rails(len(src)):
+            # a rail is one stride of data, or two interleaved ones
+            if second is None:
+                dst[pos:pos + count] = src[first]
+            else:
+                dst[pos:pos + count:2] = src[first]
+                dst[pos + 1:pos + count:2] = src[second]
+            pos += count
+        return pos
+
+    def decrypt_into(self, src, dst):
+        if not self.reasonable(src):
+            return copy_into(src, dst)
+        src = memoryview(src)
+        dst = memoryview(dst)
+        pos = 0
+        for first, second, count in self.rails(len(src)):
+            if second is None:
+                dst[first] = src[pos:pos + count]
+            else:
+                dst[first] = src[pos:pos + count:2]
+                dst[second] = src[pos + 1:pos + count:2]
+            pos += count
+        return pos
 
     def reasonable(self, data):
         return 1 < self.ikey < len(data)
 
-    def fence(self, lst):
-        fence = [[None for _ in range(len(lst))] for _ in range(self.ikey)]
-        rails = list(range(self.ikey - 1)) \
-            + list(range(self.ikey - 1, 0, -1))
-        for n, x in enumerate(lst):
-            fence[rails[n % len(rails)]][n] = x
-        return (c for rail in fence for c in rail if c is not None)
+    def rails(self, n):
+        """ yield (first, second, count) of each rail of n bytes
+        fenced with a period of 2 * (ikey - 1): slices of its indices,
+        second is None for the top and bottom rails
+        """
+        period = 2 * (self.ikey - 1)
+        for rail in range(self.ikey):
+            first = slice(rail, n, period)
+            count = len(range(rail, n, period))
+            if 0 < rail < self.ikey - 1:
+                second = slice(period - rail, n, period)
+                count += len(range(period - rail, n, period))
+            else:
+                second = None
+            yield first, second, count
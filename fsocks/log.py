@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
+import time
+import atexit
+import queue
 import logging
+import logging.handlers
 
 
-__all__ = ['logger']
+__all__ = ['logger', 'setup', 'shutdown', 'RateLimitFilter']
 
 
 _formater = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
@@ -11,3 +15,86 @@ _handler.setFormatter(_formater)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(_handler)
+_listener = None
+_exit_registered = False  # shutdown() registered with atexit
+
+
+class RateLimitFilter(logging.Filter):
+    """ let the same warning (formatted, arguments included) through
+    at most once per interval, the next one reports how many
+    records were suppressed in between; errors are never dropped
+    """
+    maxsize = 1024  # messages remembered before forgetting stale ones
+
+    def __init__(self, interval=1.0, level=logging.WARNING):
+        super().__init__()
+        self.interval = interval
+        self.level = level
+        self.records = {}  # (levelno, message) -> [last, suppressed]
+
+    def filter(self, record):
+        if not self.level <= record.levelno < logging.ERROR:
+            return True
+        key = (record.levelno, record.getMessage())
+        now = time.monotonic()
+        state = self.records.get(key)
+        if state is None:
+            if len(self.records) >= self.maxsize:
+                self._forget(now)
+            self.records[key] = [now, 0]
+            return True
+        if now - state[0] < self.interval:
+            state[1] += 1
+            return False
+        if state[1]:
+            record.msg = '{} ({} suppressed)'.format(record.msg, state[1])
+        state[0] = now
+        state[1] = 0
+        return True
+
+    def _forget(self, now):
+        """ drop messages not seen for an interval """
+        self.records = dict(
+            (key, state) for key, state in self.records.items()
+            if now - state[0] < self.interval)
+
+
+def setup(level=None, path=None, async_=True, ratelimit=0):
+    """ (re)configure fsocks logger
+    :param path: log to file instead of stderr
+    :param async_: hand records to a background thread so that
+                   terminal or disk I/O never blocks the event loop
+    :param ratelimit: seconds between two identical warnings, 0 to disable
+    """
+    global _handler, _listener, _exit_registered
+    shutdown()
+    if level is not None:
+        logger.setLevel(level)
+    for f in logger.filters[:]:
+        if isinstance(f, RateLimitFilter):
+            logger.removeFilter(f)
+    if ratelimit:
+        logger.addFilter(RateLimitFilter(ratelimit))
+    for h in logger.handlers[:]:
+        logger.removeHandler(h)
+    _handler = logging.FileHandler(path) if path \
+        else logging.StreamHandler()
+    _handler.setFormatter(_formater)
+    if not async_:
+        logger.addHandler(_handler)
+        return
+    q = queue.Queue()
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    _listener = logging.handlers.QueueListener(q, _handler)
+    _listener.start()
+    if not _exit_registered:
+        atexit.register(shutdown)
+        _exit_registered = True
+
+
+def shutdown():
+    """ flush pending records of the background thread """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+""" runtime metrics in Prometheus text format
+
+Updating a metric on the hot path is a single attribute update,
+everything else (label formatting, cumulative buckets, callbacks)
+only happens when the endpoint is scraped.
+"""
+import asyncio
+from bisect import bisect_left
+from .log import logger
+
+
+__all__ = ['registry', 'Registry', 'Counter', 'Gauge', 'Histogram',
+           'LoopLagMonitor', 'MetricsServer']
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter:
+    __slots__ = ('labels', 'value')
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name):
+        yield name, self.labels, self.value
+
+
+class Gauge:
+    __slots__ = ('labels', 'value', 'func')
+
+    def __init__(self, labels, func=None):
+        self.labels = labels
+        self.value = 0
+        self.func = func  # evaluated at scrape time
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name):
+        value = self.value if self.func is None else self.func()
+        yield name, self.labels, value
+
+
+class Histogram:
+    __slots__ = ('labels', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, labels, buckets=DEFAULT_BUCKETS):
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name):
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += n
+            labels = dict(self.labels)
+            labels['le'] = _format_value(float(bound))
+            yield name + '_bucket', labels, cumulative
+        yield name + '_sum', self.labels, self.sum
+        yield name + '_count', self.labels, self.count
+
+
+class _Family:
+
+    def __init__(self, name, doc, kind):
+        self.name = name
+        self.doc = doc
+        self.kind = kind
+        self.children = {}  # sorted label items -> metric
+
+
+class Registry:
+    """ A collection of metric families """
+
+    def __init__(self):
+        self.families = {}
+
+    def _get(self, cls, kind, name, doc, labels, **kwargs):
+        family = self.families.get(name)
+        if family is None:
+            family = _Family(name, doc, kind)
+            self.families[name] = family
+        elif family.kind != kind:
+            raise ValueError('{} is already a {}'.format(name, family.kind))
+        key = tuple(sorted(labels.items()))
+        metric = family.children.get(key)
+        if metric is None:
+            metric = cls(labels, **kwargs)
+            family.children[key] = metric
+        return metric
+
+    def counter(self, name, doc, **labels):
+        return self._get(Counter, 'counter', name, doc, labels)
+
+    def gauge(self, name, doc, func=None, **labels):
+        return self._get(Gauge, 'gauge', name, doc, labels, func=func)
+
+    def histogram(self, name, doc, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, 'histogram', name, doc, labels,
+                         buckets=buckets)
+
+    def remove(self, name, **labels):
+        family = self.families.get(name)
+        if family is not None:
+            family.children.pop(tuple(sorted(labels.items())), None)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.families):
+            family = self.families[name]
+            lines.append('# HELP {} {}'.format(name, family.doc))
+            lines.append('# TYPE {} {}'.format(name, family.kind))
+            for metric in list(family.children.values()):
+                for sname, labels, value in metric.samples(name):
+                    lines.append('{}{} {}'.format(
+                        sname, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# shared by fclient and fserver
+tunnels = registry.gauge('fsocks_tunnels', 'Active tunnels')
+channels = registry.gauge('fsocks_channels', 'Active channels')
+tx_bytes = registry.counter('fsocks_tunnel_bytes_total',
+                            'Bytes written to tunnels', direction='tx')
+rx_bytes = registry.counter('fsocks_tunnel_bytes_total',
+                            'Bytes read from tunnels', direction='rx')
+tx_frames = registry.counter('fsocks_tunnel_frames_total',
+                             'Frames written to tunnels', direction='tx')
+rx_frames = registry.counter('fsocks_tunnel_frames_total',
+                             'Frames read from tunnels', direction='rx')
+encrypt_seconds = registry.histogram(
+    'fsocks_fuzz_seconds', 'Fuzz/cipher time per frame', op='encrypt',
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+             0.001, 0.0025, 0.005, 0.01, 0.025, 0.05))
+decrypt_seconds = registry.histogram(
+    'fsocks_fuzz_seconds', 'Fuzz/cipher time per frame', op='decrypt',
+    buckets=encrypt_seconds.buckets)
+connect_seconds = registry.histogram(
+    'fsocks_connect_seconds', 'Connect latency', result='ok')
+connect_failed_seconds = registry.histogram(
+    'fsocks_connect_seconds', 'Connect latency', result='error')
+loop_lag = registry.histogram(
+    'fsocks_loop_lag_seconds', 'Event loop scheduling lag')
+relay_payload_bytes = registry.histogram(
+    'fsocks_relay_payload_bytes', 'Payload size of RELAYING frames sent',
+    buckets=tuple(1 << n for n in range(9, 19)))
+registry.gauge('fsocks_relay_frames_per_megabyte',
+               'RELAYING frames sent per MB of payload',
+               func=lambda: relay_payload_bytes.count * 1e6
+               / relay_payload_bytes.sum if relay_payload_bytes.sum else 0)
+
+
+def watch_write_buffer(tunnel_id, transport):
+    """ export write buffer depth of a tunnel transport """
+    registry.gauge('fsocks_tunnel_write_buffer_bytes',
+                   'Bytes pending in tunnel write buffer',
+                   func=transport.get_write_buffer_size, tunnel=tunnel_id)
+
+
+def unwatch_write_buffer(tunnel_id):
+    registry.remove('fsocks_tunnel_write_buffer_bytes', tunnel=tunnel_id)
+
+
+class LoopLagMonitor:
+    """ measure how late the event loop runs a scheduled callback """
+
+    def __init__(self, loop, interval=0.5, histogram=loop_lag):
+        self.loop = loop
+        self.interval = interval
+        self.histogram = histogram
+        self.handle = None
+        self.expected = 0
+
+    def start(self):
+        self.expected = self.loop.time() + self.interval
+        self.handle = self.loop.call_at(self.expected, self._tick)
+
+    def _tick(self):
+        now = self.loop.time()
+        self.histogram.observe(max(0.0, now - self.expected))
+        self.expected = now + self.interval
+        self.handle = self.loop.call_at(self.expected, self._tick)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+class MetricsServer:
+    """ minimal HTTP endpoint serving registry in text format,
+    listening on TCP host:port or on a unix socket path
+    """
+
+    def __init__(self, registry=registry):
+        self.registry = registry
+        self.server = None
+        self.monitor = None  # LoopLagMonitor, stopped on close
+
+    async def _handle(self, reader, writer):
+        try:
+            # request line and headers are ignored, any path will do
+            await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError,
+                ConnectionResetError):
+            writer.close()
+            return
+        body = self.registry.render().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() +
+                     b'\r\n\r\n' + body)
+        try:
+            await writer.drain()
+        except ConnectionResetError:
+            pass
+        writer.close()
+
+    async def start(self, host=None, port=None, path=None):
+        if path:
+            self.server = await asyncio.start_unix_server(self._handle, path)
+            logger.info('metrics listen on unix:%s', path)
+        else:
+            self.server = await asyncio.start_server(self._handle, host, port)
+            logger.info('metrics listen on %s:%s', host, port)
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+
+
+def start(loop, config):
+    """ start endpoint and loop lag monitor as configured,
+    return the MetricsServer, whose close() stops both,
+    None if metrics are disabled
+    """
+    if not config.metrics_port and not config.metrics_path:
+        return None
+    server = MetricsServer()
+    loop.run_until_complete(server.start(config.metrics_host,
+                                         config.metrics_port,
+                                         config.metrics_path))
+    server.monitor = LoopLagMonitor(loop)
+    server.monitor.start()
+    return server
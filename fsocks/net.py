@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
-import select
 import struct
-import io
 import asyncio
+import selectors
 from .log import logger
 
 
@@ -10,89 +9,179 @@ class NetworkError(Exception):
     pass
 
 
+class ReadSizer:
+    """ adaptive read size of a connection
+
+    Bulk transfers fill every read: the size doubles up to `maximum`,
+    so they cost fewer, bigger tunnel frames. Interactive ones read
+    little: after two reads under a quarter of it, the size halves
+    down to `minimum`.
+    """
+    __slots__ = ('size', 'minimum', 'maximum', 'small')
+
+    def __init__(self, minimum=2048, maximum=262144):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.size = minimum
+        self.small = 0
+
+    def update(self, nread):
+        """ record a read of nread bytes, return next read size """
+        if nread >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+            self.small = 0
+        elif nread <= self.size // 4:
+            self.small += 1
+            if self.small >= 2:
+                self.size = max(self.size // 2, self.minimum)
+                self.small = 0
+        else:
+            self.small = 0
+        return self.size
+
+
 class SockStream:
-    """A thin wrapper for socket"""
+    """A thin wrapper for socket
+
+    Reads go into preallocated buffers with recv_into(), writes send
+    memoryview slices, nothing is copied per partial recv/send.
+    The async methods switch the socket to non-blocking mode.
+    """
 
     def __init__(self, sock, loop=None):
         self.sock = sock
-        # self.loop = asyncio.get_event_loop() if loop is None else loop
+        self._loop = loop
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def _async(self):
+        if self.sock.gettimeout() != 0:
+            self.sock.setblocking(False)
+        return self.loop
 
     def connect(self, addr):
         try:
             return self.sock.connect(addr)
-        except (ConnectionRefusedError,
-                TimeoutError,
-                OSError) as e:
+        except OSError as e:
             raise NetworkError(str(e))
 
     async def async_connect(self, addr):
-        return await self.loop.sock_connect(addr)
+        try:
+            return await self._async().sock_connect(self.sock, addr)
+        except OSError as e:
+            raise NetworkError(str(e))
 
     def read(self, nbytes, insist=True):
+        """ read nbytes, or some bytes if not insist """
         if insist:
             return self.read_all(nbytes)
-        # read some data
         try:
             read = self.sock.recv(nbytes)
-        except (OSError,
-                TimeoutError,
-                ConnectionResetError) as e:
+        except OSError as e:
             raise NetworkError(str(e))
         if len(read) == 0:
             raise NetworkError('connection closed')
         return read
 
     def read_all(self, nbytes):
-        read = b''
-        left = nbytes
-        while left > 0:
-            data = self.sock.recv(left)
-            n = len(data)
+        """ return a bytearray of exactly nbytes """
+        buf = bytearray(nbytes)
+        self.read_into(buf)
+        return buf
+
+    def read_into(self, buf):
+        """ fill buf entirely """
+        view = memoryview(buf)
+        got = 0
+        while got < len(view):
+            try:
+                n = self.sock.recv_into(view[got:])
+            except OSError as e:
+                raise NetworkError(str(e))
             if n == 0:
                 raise NetworkError('connection closed')
-            read += data
-            left -= n
-        return read
+            got += n
+        return got
 
     async def async_read(self, nbytes, insist=True):
         if insist:
-            return self.async_read_all(self, nbytes)
-        data = await self.loop.sock_recv(self.sock, nbytes)
+            return await self.async_read_all(nbytes)
+        try:
+            data = await self._async().sock_recv(self.sock, nbytes)
+        except OSError as e:
+            raise NetworkError(str(e))
+        if len(data) == 0:
+            raise NetworkError('connection closed')
         return data
 
     async def async_read_all(self, nbytes):
-        read = b''
-        left = nbytes
-        while left > 0:
-            data = await self.loop.sock_recv(self.sock, left)
-            n = len(data)
+        buf = bytearray(nbytes)
+        await self.async_read_into(buf)
+        return buf
+
+    async def async_read_into(self, buf):
+        loop = self._async()
+        view = memoryview(buf)
+        got = 0
+        while got < len(view):
+            try:
+                n = await loop.sock_recv_into(self.sock, view[got:])
+            except OSError as e:
+                raise NetworkError(str(e))
             if n == 0:
                 raise NetworkError('connection closed')
-            read += data
-            left -= n
-        return read
+            got += n
+        return got
 
     def write(self, data, insist=True):
         if insist:
             return self.write_all(data)
         try:
             return self.sock.send(data)
-        except (OSError,
-                TimeoutError,
-                ConnectionResetError) as e:
+        except OSError as e:
             raise NetworkError(str(e))
 
     def write_all(self, data):
+        view = memoryview(data)
+        sent = 0
+        while sent < len(view):
+            n = self.write(view[sent:], insist=False)
+            if n == 0:
+                raise NetworkError('The buffer is full')
+            sent += n
+        return sent
+
+    def writev(self, buffers):
+        """ write all buffers, gathered by sendmsg() """
+        views = [memoryview(b) for b in buffers]
         sent = 0
-        while sent < len(data):
-            n = self.write(data[sent:], insist=False)
+        while views:
+            try:
+                n = self.sock.sendmsg(views)
+            except OSError as e:
+                raise NetworkError(str(e))
             if n == 0:
                 raise NetworkError('The buffer is full')
-            if n < 0:
-                raise NetworkError('internal error')
             sent += n
+            while n:
+                if n >= len(views[0]):
+                    n -= len(views.pop(0))
+                else:
+                    views[0] = views[0][n:]
+                    n = 0
         return sent
 
+    async def async_write(self, data):
+        try:
+            await self._async().sock_sendall(self.sock, data)
+        except OSError as e:
+            raise NetworkError(str(e))
+        return len(data)
+
     def close(self):
         return self.sock.close()
 
@@ -106,21 +195,49 @@ def pipe(plain, fuzz, cipher):
     so we add 2 bytes header indicating len(payload)
     before the encrypted payload
     """
-    rdset = [plain.sock, fuzz.sock]
-    while True:
-        rlist, _, _ = select.select(rdset, [], [])
-        if plain.sock in rlist:
-            try:
-                data = plain.sock.recv(4096)
-            except ConnectionResetError as e:
-                logger.warn(e)
-                break
-            if len(data) == 0:
-                break
-            edata = cipher.encrypt(data)
-            fuzz.write_all(struct.pack('!H', len(edata)))
-            fuzz.write_all(edata)
-        if fuzz.sock in rlist:
-            elen = struct.unpack('!H', fuzz.read(2))[0]
-            edata = fuzz.read(elen)
-            plain.write_all(cipher.decrypt(edata))
+    selector = selectors.DefaultSelector()
+    selector.register(plain.sock, selectors.EVENT_READ, plain)
+    selector.register(fuzz.sock, selectors.EVENT_READ, fuzz)
+    # encrypted length must fit the 2 bytes header, whatever the
+    # expansion of the fuzz chain (AES256CBC adds 32 bytes at most)
+    maximum = 16384
+    expansion = getattr(cipher, 'max_expansion', None)
+    if expansion is not None:
+        while maximum > 1 and expansion(maximum) > 0xFFFF:
+            maximum //= 2
+    sizer = ReadSizer(min(4096, maximum), maximum)
+    buf = bytearray(sizer.maximum)
+    view = memoryview(buf)
+    header = bytearray(2)
+    out = out_view = None
+    if hasattr(cipher, 'encrypt_into'):
+        # fuzz chains encrypt into a reused buffer, after the header
+        out = bytearray(2 + cipher.max_expansion(sizer.maximum))
+        out_view = memoryview(out)
+    try:
+        while True:
+            for key, _ in selector.select():
+                if key.data is plain:
+                    try:
+                        n = plain.sock.recv_into(view[:sizer.size])
+                    except ConnectionResetError as e:
+                        logger.warning('%s', e)
+                        return
+                    if n == 0:
+                        return
+                    sizer.update(n)
+                    if out is not None:
+                        elen = cipher.encrypt_into(view[:n], out_view[2:])
+                        struct.pack_into('!H', out, 0, elen)
+                        fuzz.write_all(out_view[:2 + elen])
+                    else:
+                        # ciphers like AES256CBC want bytes
+                        edata = cipher.encrypt(bytes(view[:n]))
+                        fuzz.writev((struct.pack('!H', len(edata)), edata))
+                else:
+                    fuzz.read_into(header)
+                    elen, = struct.unpack('!H', header)
+                    edata = fuzz.read_all(elen)
+                    plain.write_all(cipher.decrypt(edata))
+    finally:
+        selector.close()
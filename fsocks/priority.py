@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import ipaddress
+from .protocol import PRIORITY
+
+
+__all__ = ['PriorityRules']
+
+
+class Rule:
+    """ all given conditions must match
+        {"priority": "high", "port": 22}
+        {"priority": "low", "domain": "backup.example.com", "port": [873]}
+        {"priority": "high", "network": "10.0.0.0/8"}
+    domain matches itself and its subdomains
+    """
+
+    def __init__(self, priority, port=None, domain=None, network=None):
+        try:
+            self.priority = PRIORITY[priority.upper()]
+        except KeyError:
+            raise ValueError('invalid priority {}'.format(priority))
+        if isinstance(port, int):
+            port = [port]
+        self.ports = None if port is None else frozenset(port)
+        self.domain = None if domain is None else domain.lower().strip('.')
+        self.network = None if network is None \
+            else ipaddress.ip_network(network, strict=False)
+
+    def match(self, host, port):
+        if self.ports is not None and port not in self.ports:
+            return False
+        if self.domain is not None:
+            host = host.lower().rstrip('.')
+            if host != self.domain \
+                    and not host.endswith('.' + self.domain):
+                return False
+        if self.network is not None:
+            try:
+                if ipaddress.ip_address(host) not in self.network:
+                    return False
+            except ValueError:  # domain name
+                return False
+        return True
+
+
+class PriorityRules:
+    """ first matching rule gives the priority of a destination """
+
+    def __init__(self, rules=()):
+        self.rules = [Rule(**r) for r in rules]
+
+    def match(self, host, port, default=PRIORITY.NORMAL):
+        for rule in self.rules:
+            if rule.match(host, port):
+                return rule.priority
+        return default
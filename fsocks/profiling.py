@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+""" on-demand profiling of a running fclient/fserver
+
+    kill -USR1 <pid>   profile the event loop for N seconds
+    kill -USR2 <pid>   take a tracemalloc snapshot
+
+Results are dumped to files in profile_dir, traffic keeps flowing.
+"""
+import os
+import time
+import signal
+import cProfile
+import pstats
+import tracemalloc
+from .log import logger
+
+
+__all__ = ['Profiler']
+
+
+class Profiler:
+
+    def __init__(self, loop, outdir='.', seconds=30, frames=10, top=30):
+        self.loop = loop
+        self.outdir = outdir
+        self.seconds = seconds
+        self.frames = frames
+        self.top = top
+        self.profile = None
+        self.handle = None
+        self.snapshot = None
+        self.dump = None  # future of the last dump
+
+    def install(self):
+        try:
+            self.loop.add_signal_handler(signal.SIGUSR1, self.toggle_profile)
+            self.loop.add_signal_handler(signal.SIGUSR2, self.take_snapshot)
+        except (AttributeError, NotImplementedError):
+            # no SIGUSR1/2 or no signal support in this loop (Windows)
+            logger.warning('profiling signals are not supported')
+            return False
+        logger.debug('profiling hooks installed (SIGUSR1/SIGUSR2)')
+        return True
+
+    def _path(self, kind, ext):
+        name = 'fsocks-{}-{}-{}.{}'.format(
+            os.getpid(), kind, time.strftime('%Y%m%d-%H%M%S'), ext)
+        return os.path.join(self.outdir, name)
+
+    @property
+    def profiling(self):
+        return self.profile is not None
+
+    def toggle_profile(self):
+        if self.profiling:
+            return self.stop_profile()
+        self.start_profile()
+
+    def start_profile(self, seconds=None):
+        if self.profiling:
+            return
+        seconds = seconds or self.seconds
+        logger.info('start profiling for %s seconds', seconds)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.handle = self.loop.call_later(seconds, self.stop_profile)
+
+    def _stop(self):
+        """ stop profiling, return the profile to dump if any """
+        profile = self.profile
+        if profile is None:
+            return None
+        profile.disable()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.profile = None
+        return profile
+
+    def _dump_profile(self, profile, path):
+        profile.dump_stats(path)
+        with open(path + '.txt', 'w') as f:
+            stats = pstats.Stats(profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(self.top)
+        return path
+
+    def _in_executor(self, kind, func, *args):
+        """ run a dump out of the loop, return its future """
+        def done(fut):
+            if fut.cancelled():
+                return
+            if fut.exception() is not None:
+                logger.warning('%s dump failed: %s', kind, fut.exception())
+            else:
+                logger.info('%s dumped to %s', kind, fut.result())
+        fut = self.dump = self.loop.run_in_executor(None, func, *args)
+        fut.add_done_callback(done)
+        return fut
+
+    def stop_profile(self):
+        """ stop profiling, return a future of the dumped path """
+        profile = self._stop()
+        if profile is None:
+            return None
+        return self._in_executor('profile', self._dump_profile, profile,
+                                 self._path('profile', 'prof'))
+
+    def _dump_snapshot(self, snapshot, previous, traced, path):
+        snapshot.dump(path)
+        with open(path + '.txt', 'w') as f:
+            f.write('traced: {} bytes, peak: {} bytes\n'.format(*traced))
+            f.write('top {} by size:\n'.format(self.top))
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                f.write('{}\n'.format(stat))
+            if previous is not None:
+                f.write('top {} since previous snapshot:\n'.format(self.top))
+                diff = snapshot.compare_to(previous, 'lineno')
+                for stat in diff[:self.top]:
+                    f.write('{}\n'.format(stat))
+        return path
+
+    def take_snapshot(self):
+        """ first call starts tracing, following calls take a snapshot,
+        return a future of the dumped path: the snapshot and the top
+        differences against previous one are written out of the loop
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.snapshot = tracemalloc.take_snapshot()
+            logger.info('tracemalloc started')
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        previous, self.snapshot = self.snapshot, snapshot
+        return self._in_executor(
+            'tracemalloc snapshot', self._dump_snapshot, snapshot, previous,
+            tracemalloc.get_traced_memory(),
+            self._path('tracemalloc', 'snapshot'))
+
+    def close(self):
+        # shutting down, nothing to stall
+        profile = self._stop()
+        if profile is not None:
+            self._dump_profile(profile, self._path('profile', 'prof'))
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.snapshot = None
+
+
+def install(loop, config):
+    profiler = Profiler(loop, config.profile_dir, config.profile_seconds)
+    profiler.install()
+    return profiler
@@ -1,10 +1,11 @@
 import io
 import struct
+import asyncio
 from random import randint
-from time import time
+from time import time, perf_counter
 from enum import Enum, unique
 from functools import wraps
-from . import logger, fuzzing, socks
+from . import logger, fuzzing, socks, metrics
 
 
 class ProtocolError(Exception):
@@ -25,6 +26,9 @@ def safe_process(func):
 def get_message(data):
     mtype = data[2]
     mtype = MTYPE(mtype)
+    if mtype is MTYPE.RELAYING:
+        # most frequent one, payload is a view of data
+        return Relaying.from_buffer(data)
     s = io.BytesIO(data)
     if mtype is MTYPE.HELLO:
         return Hello.from_stream(s)
@@ -34,10 +38,12 @@ def get_message(data):
         return Request.from_stream(s)
     elif mtype is MTYPE.REPLY:
         return Reply.from_stream(s)
-    elif mtype is MTYPE.RELAYING:
-        return Relaying.from_stream(s)
     elif mtype is MTYPE.CLOSE:
         return Close.from_stream(s)
+    elif mtype is MTYPE.DATAGRAM:
+        return Datagram.from_stream(s)
+    elif mtype is MTYPE.FLOW:
+        return Flow.from_stream(s)
     else:
         return None
 
@@ -47,9 +53,7 @@ def read_packet(stream, cipher=None):
     etype, = struct.unpack('!H', stream.read(2))
     elen, = struct.unpack('!I', stream.read(4))
     edata = stream.read(elen)
-    if cipher is not None:
-        edata = cipher.decrypt(edata)
-    return get_message(edata)
+    return decode_packet(edata, cipher)
 
 
 @safe_process
@@ -59,15 +63,158 @@ async def async_read_packet(reader, cipher=None):
     data = await reader.readexactly(4)
     elen, = struct.unpack('!I', data)
     edata = await reader.readexactly(elen)
+    return decode_packet(edata, cipher)
+
+
+class Ciphers:
+    """ ciphers of an open tunnel, by ENC.TYPE
+
+    The low byte of ENC.TYPE tells the pre shared cipher (0) from the
+    negotiated fuzz (1), the high byte is the epoch of the fuzz. A
+    HANDSHAKE in an open tunnel starts a new epoch: frames sent after
+    it use the new fuzz, frames of the previous epoch still in flight
+    are decoded with theirs. The fuzz of an epoch is dropped once
+    both peers sent in a newer one.
+    """
+    __slots__ = ('cipher', 'fuzzs', 'epoch', 'peer_epoch')
+
+    def __init__(self, cipher, fuzz=None):
+        self.cipher = cipher
+        self.fuzzs = {} if fuzz is None else {0: fuzz}
+        self.epoch = 0  # of frames sent
+        self.peer_epoch = 0  # of frames received
+
+    @property
+    def fuzz(self):
+        return self.fuzzs.get(self.epoch)
+
+    @property
+    def switching(self):
+        return len(self.fuzzs) > 1
+
+    def get(self, etype):
+        if etype & 0xFF == 0:
+            return self.cipher
+        try:
+            return self.fuzzs[etype >> 8]
+        except KeyError:
+            raise ProtocolError('No fuzz of epoch {}'.format(etype >> 8))
+
+    def decode(self, etype, edata):
+        packet = decode_packet(edata, self.get(etype))
+        if packet.mtype is MTYPE.HANDSHAKE:
+            packet.epoch = etype >> 8
+        return packet
+
+    def encode(self, message):
+        """ (header, data) of message in the epoch sent """
+        if message.mtype is MTYPE.HANDSHAKE:
+            # following frames use its fuzz
+            self.epoch = message.epoch
+            self._retire()
+            return message.to_frame(self.cipher, message.epoch)
+        return message.to_frame(self.fuzzs[self.epoch], self.epoch)
+
+    def start(self, fuzz):
+        """ return a HANDSHAKE starting a new epoch of fuzz """
+        epoch = (self.epoch + 1) & 0xFF
+        self.fuzzs[epoch] = fuzz
+        return HandShake(fuzz, epoch=epoch)
+
+    def received(self, handshake):
+        """ peer sends in the epoch of handshake from now on, return
+        the HANDSHAKE acknowledging it if peer started it, else None
+        """
+        epoch = handshake.epoch
+        ack = None
+        if epoch not in self.fuzzs:
+            self.fuzzs[epoch] = handshake.fuzz
+            ack = HandShake(handshake.fuzz, epoch=epoch)
+        self.peer_epoch = epoch
+        self._retire()
+        return ack
+
+    def _retire(self):
+        if self.epoch == self.peer_epoch and self.switching:
+            self.fuzzs = {self.epoch: self.fuzzs[self.epoch]}
+
+
+class FrameReader:
+    """ read tunnel frames in batches
+
+    Each read takes everything buffered by the StreamReader, up to
+    `chunk` bytes, and every complete frame in it is decoded: one
+    await per batch instead of three per frame.
+    """
+
+    def __init__(self, reader, ciphers, chunk=262144):
+        """
+        :param ciphers: Ciphers of the tunnel
+        """
+        self.reader = reader
+        self.ciphers = ciphers
+        self.chunk = chunk
+        self.buf = bytearray()
+
+    async def read_packets(self):
+        """ return a non empty list of packets,
+        raise IncompleteReadError at EOF
+        """
+        while True:
+            packets = self.parse()
+            if packets:
+                return packets
+            data = await self.reader.read(self.chunk)
+            if not data:
+                raise asyncio.IncompleteReadError(bytes(self.buf), None)
+            self.buf += data
+
+    def parse(self):
+        buf = self.buf
+        packets = []
+        offset = 0
+        with memoryview(buf) as view:
+            while len(buf) - offset >= 6:
+                etype, elen = struct.unpack_from('!HI', buf, offset)
+                end = offset + 6 + elen
+                if len(buf) < end:
+                    # remaining part of frame is not received yet
+                    break
+                packet = self.ciphers.decode(etype, view[offset + 6:end])
+                packets.append(packet)
+                offset = end
+                if packet.mtype is MTYPE.HANDSHAKE:
+                    # following frames may need the fuzz it brings
+                    break
+        if offset:
+            del buf[:offset]
+        return packets
+
+
+def decode_packet(edata, cipher=None):
+    metrics.rx_frames.value += 1
+    metrics.rx_bytes.value += 6 + len(edata)
     if cipher is not None:
+        begin = perf_counter()
         edata = cipher.decrypt(edata)
+        metrics.decrypt_seconds.observe(perf_counter() - begin)
+    if isinstance(edata, memoryview):
+        # a view of the receive buffer, which is reused,
+        # messages must not keep it
+        edata = bytes(edata)
     return get_message(edata)
 
 
+def frame_header(data, etype):
+    """ ENC.TYPE and ENC.LEN of encrypted data """
+    metrics.tx_frames.value += 1
+    metrics.tx_bytes.value += 6 + len(data)
+    return struct.pack('!HI', etype, len(data))
+
+
 @safe_process
 def form_packet(data, etype):
-    return struct.pack('!HI', etype, len(data)) \
-        + data
+    return frame_header(data, etype) + data
 
 
 @unique
@@ -84,9 +231,20 @@ class MTYPE(Enum):
     REPLY = 0x04
     RELAYING = 0x05
     CLOSE = 0x06
+    DATAGRAM = 0x07
+    FLOW = 0x08
+
+
+@unique
+class PRIORITY(Enum):
+    HIGH = 0x00
+    NORMAL = 0x01
+    LOW = 0x02
 
 
 class Message:
+    # frequent messages have __slots__, Hello and HandShake keep a dict
+    __slots__ = ('nonce',)
     magic = 0x1986
     mtype = None
 
@@ -110,15 +268,26 @@ class Message:
                            self.mtype.value, self.nonce)
 
     def to_packet(self, cipher):
+        header, data = self.to_frame(cipher)
+        return header + data
+
+    @safe_process
+    def to_frame(self, cipher, epoch=0):
+        """ (header, encrypted data) segments of the packet, to be
+        written with writelines() without joining them
+        """
         # etype 0 -> before negotiate
         # etype 1 -> after negotiate
+        # high byte -> epoch of negotiated fuzz, see Ciphers
         if self.mtype is MTYPE.HELLO or \
                 self.mtype is MTYPE.HANDSHAKE:
-            etype = 0
+            etype = epoch << 8
         else:
-            etype = 1
-        return form_packet(cipher.encrypt(
-            self.to_bytes()), etype)
+            etype = epoch << 8 | 1
+        begin = perf_counter()
+        data = cipher.encrypt(self.to_bytes())
+        metrics.encrypt_seconds.observe(perf_counter() - begin)
+        return frame_header(data, etype), data
 
 
 class Hello(Message):
@@ -150,8 +319,9 @@ class Hello(Message):
 class HandShake(Message):
     mtype = MTYPE.HANDSHAKE
 
-    def __init__(self, fuzz=None, timestamp=None, **kwargs):
+    def __init__(self, fuzz=None, timestamp=None, epoch=0, **kwargs):
         self.timestamp = timestamp or int(time())
+        self.epoch = epoch  # carried by ENC.TYPE
         if fuzz is None:
             self.fuzz = fuzzing.FuzzChain(fuzzing.available_fuzz())
         elif isinstance(fuzz, fuzzing.FuzzChain):
@@ -198,6 +368,7 @@ class HandShake(Message):
 
 
 class _SocksWrapper(Message):
+    __slots__ = ('src', 'dst', 'msg')
     mtype = None
     is_request = None
 
@@ -228,22 +399,59 @@ class _SocksWrapper(Message):
 
 
 class Request(_SocksWrapper):
+    __slots__ = ('priority',)
     mtype = MTYPE.REQUEST
     is_request = True
 
+    def __init__(self, src, dst, msg, priority=None, **kwargs):
+        self.priority = priority or PRIORITY.NORMAL
+        super().__init__(src, dst, msg, **kwargs)
+
+    @classmethod
+    @safe_process
+    def from_stream(cls, s):
+        mtype, nonce = Message.read_common(s)
+        if mtype is not cls.mtype:
+            raise ProtocolError('Not a {} message'.format(cls.mtype.name))
+        src, dst, priority = struct.unpack('!IIB', s.read(9))
+        try:
+            priority = PRIORITY(priority)
+        except ValueError:
+            raise ProtocolError('Invalid priority {}'.format(priority))
+        msg = socks.Message.from_stream(s, request=cls.is_request)
+        return cls(src, dst, msg, priority, nonce=nonce)
+
+    def to_bytes(self):
+        return self.common_bytes() \
+            + struct.pack('!IIB', self.src, self.dst, self.priority.value) \
+            + self.msg.to_bytes()
+
+    def __str__(self):
+        return '[{} {} {}]'.format(self.mtype.name, self.priority.name,
+                                   self.msg)
+
 
 class Reply(_SocksWrapper):
+    __slots__ = ()
     mtype = MTYPE.REPLY
     is_request = False
 
 
 class Relaying(Message):
+    __slots__ = ('src', 'dst', 'payload', 'buffer')
     mtype = MTYPE.RELAYING
-
-    def __init__(self, src, dst, payload, **kwargs):
+    # MAGIC MTYPE NONCE SRC DST
+    header = struct.Struct('!HBIII')
+
+    def __init__(self, src, dst, payload, buffer=None, **kwargs):
+        """
+        :param buffer: bytearray holding payload at offset header.size,
+                       the header is packed in front of it, no copy
+        """
         self.src = src
         self.dst = dst
         self.payload = payload
+        self.buffer = buffer
         super().__init__(**kwargs)
 
     @classmethod
@@ -256,13 +464,32 @@ class Relaying(Message):
         payload = s.read()  # all remaining
         return cls(src, dst, payload, nonce=nonce)
 
+    @classmethod
+    @safe_process
+    def from_buffer(cls, data):
+        """ parse data without copying, payload is a memoryview """
+        magic, mtype, nonce, src, dst = cls.header.unpack_from(data)
+        if magic != Message.magic:
+            raise ProtocolError('Invalid magic')
+        if mtype != cls.mtype.value:
+            raise ProtocolError('Not a Relay message')
+        return cls(src, dst, memoryview(data)[cls.header.size:],
+                   nonce=nonce)
+
     def to_bytes(self):
+        if self.buffer is not None:
+            self.header.pack_into(self.buffer, 0, self.magic,
+                                  self.mtype.value, self.nonce,
+                                  self.src, self.dst)
+            return memoryview(self.buffer)[
+                :self.header.size + len(self.payload)]
         return self.common_bytes() \
             + struct.pack('!II', self.src, self.dst) \
             + self.payload
 
 
 class Close(Message):
+    __slots__ = ('src',)
     mtype = MTYPE.CLOSE
 
     def __init__(self, src, **kwargs):
@@ -278,3 +505,85 @@ class Close(Message):
 
     def to_bytes(self):
         return self.common_bytes() + struct.pack('!I', self.src)
+
+
+class Flow(Message):
+    """ client asks server to stop or start reading the remote of
+    channel src->dst, its user can't take more data
+    """
+    __slots__ = ('src', 'dst', 'paused')
+    mtype = MTYPE.FLOW
+
+    def __init__(self, src, dst, paused, **kwargs):
+        self.src = src
+        self.dst = dst
+        self.paused = paused
+        super().__init__(**kwargs)
+
+    @classmethod
+    @safe_process
+    def from_stream(cls, s):
+        mtype, nonce = Message.read_common(s)
+        if mtype is not cls.mtype:
+            raise ProtocolError('Not a Flow message')
+        src, dst, paused = struct.unpack('!IIB', s.read(9))
+        return cls(src, dst, bool(paused), nonce=nonce)
+
+    def to_bytes(self):
+        return self.common_bytes() + struct.pack(
+            '!IIB', self.src, self.dst, self.paused)
+
+
+class Datagram(Message):
+    """ a batch of UDP datagrams of one association,
+    each one is (addr, data), addr being the remote (host, port)
+    """
+    __slots__ = ('src', 'dst', 'datagrams')
+    mtype = MTYPE.DATAGRAM
+
+    def __init__(self, src, dst, datagrams, **kwargs):
+        self.src = src
+        self.dst = dst
+        self.datagrams = datagrams
+        super().__init__(**kwargs)
+
+    @property
+    def size(self):
+        return sum(len(data) for _, data in self.datagrams)
+
+    @classmethod
+    @safe_process
+    def from_stream(cls, s):
+        mtype, nonce = Message.read_common(s)
+        if mtype is not cls.mtype:
+            raise ProtocolError('Not a Datagram message')
+        src, dst, count = struct.unpack('!IIH', s.read(10))
+        datagrams = []
+        for _ in range(count):
+            try:
+                atype = socks.ATYPE(s.read(1)[0])
+                addr = socks.read_address(s, atype)
+            except (IndexError, ValueError) as e:
+                raise ProtocolError('Invalid datagram address: {}'.format(e))
+            length, = struct.unpack('!H', s.read(2))
+            data = s.read(length)
+            if len(data) != length:
+                raise ProtocolError('Truncated datagram')
+            datagrams.append((addr, data))
+        return cls(src, dst, datagrams, nonce=nonce)
+
+    def to_bytes(self):
+        parts = [self.common_bytes(),
+                 struct.pack('!IIH', self.src, self.dst,
+                             len(self.datagrams))]
+        for addr, data in self.datagrams:
+            atype = socks.atype_of(addr[0])
+            parts.append(struct.pack('!B', atype.value))
+            parts.append(socks.pack_address(atype, addr))
+            parts.append(struct.pack('!H', len(data)))
+            parts.append(data)
+        return b''.join(parts)
+
+    def __str__(self):
+        return '[{} {} datagrams]'.format(self.mtype.name,
+                                          len(self.datagrams))
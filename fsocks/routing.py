@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+""" direct or tunnel route of fclient CONNECT destinations
+
+IP literals are matched against CIDR rules, longest prefix first,
+domain names against domain rules, longest suffix first: a domain
+matches itself and its subdomains. Domain names are never resolved to
+be matched against CIDR rules, that would leak every lookup to the
+local resolver.
+
+Rules are given in config.route_rules:
+    {"route": "direct", "network": "192.168.0.0/16"}
+    {"route": "direct", "domain": "example.cn"}
+    {"route": "direct", "file": "rules/lan.txt"}
+    {"route": "tunnel", "domain": "blocked.example.cn"}
+A file holds one IP, CIDR or domain per line, "#" starts a comment.
+A more specific rule wins whatever the order, a rule given again
+replaces the former one.
+"""
+import socket
+from enum import Enum
+from collections import OrderedDict
+
+
+__all__ = ['ROUTE', 'Router', 'CidrTable', 'DomainTrie']
+
+
+class ROUTE(Enum):
+    TUNNEL = 0x00
+    DIRECT = 0x01
+
+
+def parse_network(entry):
+    """ (family, prefix as int, prefix length) of an IP or CIDR,
+    None if entry is no IP
+    """
+    addr, _, plen = entry.partition('/')
+    family = socket.AF_INET6 if ':' in addr else socket.AF_INET
+    try:
+        packed = socket.inet_pton(family, addr)
+    except OSError:
+        return None
+    bits = len(packed) * 8
+    plen = int(plen) if plen else bits
+    if not 0 <= plen <= bits:
+        raise ValueError('invalid prefix length {}'.format(entry))
+    # host bits are ignored, like ip_network(strict=False)
+    return family, int.from_bytes(packed, 'big') >> (bits - plen), plen
+
+
+class CidrTable:
+    """ longest prefix match of IPv4 and IPv6 addresses
+
+    Prefixes are kept in a hash table per prefix length, looked up
+    from the longest length in use to the shortest: the match of a
+    radix tree, with O(1) inserts so large rule sets load fast, and a
+    lookup costing one probe per distinct prefix length.
+    """
+
+    def __init__(self):
+        # family -> {prefix length -> {prefix -> value}}
+        self.tables = {socket.AF_INET: {}, socket.AF_INET6: {}}
+        self.lengths = {socket.AF_INET: [], socket.AF_INET6: []}
+        self.count = 0
+
+    def add(self, family, prefix, plen, value):
+        tables = self.tables[family]
+        table = tables.get(plen)
+        if table is None:
+            table = tables[plen] = {}
+            self.lengths[family] = sorted(tables, reverse=True)
+        if prefix not in table:
+            self.count += 1
+        table[prefix] = value
+
+    def lookup(self, family, packed):
+        """ value of the longest prefix matching packed address """
+        addr = int.from_bytes(packed, 'big')
+        bits = len(packed) * 8
+        tables = self.tables[family]
+        for plen in self.lengths[family]:
+            value = tables[plen].get(addr >> (bits - plen))
+            if value is not None:
+                return value
+        return None
+
+    def __len__(self):
+        return self.count
+
+
+class DomainTrie:
+    """ longest suffix match of domain names, a trie of their labels
+    from the top-level one down
+    """
+    VALUE = ''  # key of the value in a node, labels are never empty
+
+    def __init__(self):
+        self.root = {}
+        self.count = 0
+
+    def add(self, domain, value):
+        node = self.root
+        for label in reversed(domain.split('.')):
+            child = node.get(label)
+            if child is None:
+                child = node[label] = {}
+            node = child
+        if self.VALUE not in node:
+            self.count += 1
+        node[self.VALUE] = value
+
+    def lookup(self, domain):
+        node = self.root
+        value = None
+        for label in reversed(domain.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            value = node.get(self.VALUE, value)
+        return value
+
+    def __len__(self):
+        return self.count
+
+
+class Router:
+    """ route of destination hosts, decisions are cached """
+
+    def __init__(self, rules=(), default='tunnel', maxsize=4096):
+        self.default = self._route(default)
+        self.networks = CidrTable()
+        self.domains = DomainTrie()
+        self.maxsize = maxsize
+        self.cache = OrderedDict()  # host -> ROUTE
+        for rule in rules:
+            self.add_rule(**rule)
+
+    @staticmethod
+    def _route(route):
+        try:
+            return ROUTE[route.upper()]
+        except KeyError:
+            raise ValueError('invalid route {}'.format(route))
+
+    def add_rule(self, route, network=None, domain=None, file=None):
+        route = self._route(route)
+        if network is not None:
+            parsed = parse_network(network)
+            if parsed is None:
+                raise ValueError('invalid network {}'.format(network))
+            self.networks.add(*parsed, route)
+        if domain is not None:
+            self._add(route, domain)
+        if file is not None:
+            self.load(route, file)
+        self.cache.clear()
+
+    def add(self, route, entry):
+        """ add an IP, CIDR or domain entry """
+        self._add(route, entry)
+        self.cache.clear()
+
+    def _add(self, route, entry):
+        if entry[-1].isalpha() and ':' not in entry:
+            parsed = None  # domain, no IP ends with a letter
+        else:
+            parsed = parse_network(entry)
+        if parsed is not None:
+            self.networks.add(*parsed, route)
+        elif '/' in entry:
+            raise ValueError('invalid network {}'.format(entry))
+        else:
+            domain = entry.lower().strip('.')
+            if domain.startswith('*.'):
+                domain = domain[2:]
+            self.domains.add(domain, route)
+
+    def load(self, route, path):
+        """ add the entries of a rule file, return their number """
+        n = 0
+        with open(path) as f:
+            for line in f:
+                entry = line.partition('#')[0].strip()
+                if entry:
+                    self._add(route, entry)
+                    n += 1
+        self.cache.clear()
+        return n
+
+    def _match(self, host):
+        if ':' in host:
+            try:
+                return self.networks.lookup(
+                    socket.AF_INET6, socket.inet_pton(socket.AF_INET6, host))
+            except OSError:
+                return None
+        try:
+            packed = socket.inet_pton(socket.AF_INET, host)
+        except OSError:
+            return self.domains.lookup(host.lower().rstrip('.'))
+        return self.networks.lookup(socket.AF_INET, packed)
+
+    def route(self, host):
+        cache = self.cache
+        route = cache.get(host)
+        if route is not None:
+            cache.move_to_end(host)
+            return route
+        route = self._match(host)
+        if route is None:
+            route = self.default
+        if len(cache) >= self.maxsize:
+            cache.popitem(last=False)
+        cache[host] = route
+        return route
+
+    def __len__(self):
+        return len(self.networks) + len(self.domains)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+""" tunnel egress scheduler
+
+All channels of a tunnel share one transport, whose write buffer is
+FIFO: a bulk download filling it delays every interactive channel.
+The scheduler keeps the transport buffer short and queues frames per
+channel instead, draining the queues by deficit round-robin, so each
+backlogged channel gets `quantum` bytes per round whatever its frame
+sizes are. Frames are encoded (fuzzed) only when they are written.
+
+Channels are scheduled in priority classes: every round visits the
+high, normal then low class, a channel gets `quantum * weight` bytes
+per round, weight depending on its class. High priority channels are
+served first and get a bigger share, but low ones never starve.
+
+A channel whose queue grows beyond `channel_limit` gets its source
+transport paused until the queue is half drained.
+"""
+import asyncio
+from collections import deque
+from . import metrics
+from .protocol import PRIORITY, MTYPE
+
+
+__all__ = ['EgressScheduler']
+
+
+CLASSES = (PRIORITY.HIGH, PRIORITY.NORMAL, PRIORITY.LOW)
+WEIGHTS = {PRIORITY.HIGH: 4, PRIORITY.NORMAL: 2, PRIORITY.LOW: 1}
+
+class_bytes = dict((p, metrics.registry.counter(
+    'fsocks_class_bytes_total', 'Bytes written to tunnels by priority',
+    priority=p.name.lower())) for p in CLASSES)
+class_frames = dict((p, metrics.registry.counter(
+    'fsocks_class_frames_total', 'Frames written to tunnels by priority',
+    priority=p.name.lower())) for p in CLASSES)
+class_queued = dict((p, metrics.registry.gauge(
+    'fsocks_class_queued_bytes', 'Bytes waiting in scheduler by priority',
+    priority=p.name.lower())) for p in CLASSES)
+
+
+class _Queue:
+    __slots__ = ('cid', 'priority', 'frames', 'size', 'deficit',
+                 'source', 'paused')
+
+    def __init__(self, cid, priority):
+        self.cid = cid
+        self.priority = priority
+        self.frames = deque()  # (message, cost)
+        self.size = 0
+        self.deficit = 0
+        self.source = None
+        self.paused = False
+
+
+def frame_cost(message):
+    if message.mtype is MTYPE.RELAYING:
+        return 32 + len(message.payload)
+    if message.mtype is MTYPE.DATAGRAM:
+        return 32 + message.size
+    return 32
+
+
+class EgressScheduler:
+
+    def __init__(self, transport, encode, quantum=16384,
+                 high_water=65536, channel_limit=262144, drain=None):
+        """
+        :param encode: message -> segments written to transport
+        :param drain: coroutine function waiting for the transport to
+                      be writable again, for stream based transports;
+                      protocols call pause()/resume() instead
+        """
+        self.transport = transport
+        self.encode = encode
+        self.quantum = quantum
+        self.high_water = high_water
+        self.channel_limit = channel_limit
+        self.drain = drain
+        self.control = deque()  # tunnel level frames, always first
+        self.queues = {}  # cid -> _Queue
+        # backlogged queues, in round-robin order, per class
+        self.active = dict((p, deque()) for p in CLASSES)
+        self.paused = False
+        self.scheduled = False
+        self.closed = False
+        self.loop = asyncio.get_event_loop()
+        try:
+            transport.set_write_buffer_limits(high=high_water)
+        except (AttributeError, NotImplementedError):
+            pass
+
+    def push(self, cid, message, source=None, priority=None):
+        """ queue message for channel cid, None for tunnel level frames
+        :param source: transport feeding this channel, paused on backlog
+        :param priority: class of channel, taken when it gets backlogged
+        """
+        if self.closed:
+            return
+        if cid is None:
+            self.control.append(message)
+        else:
+            queue = self.queues.get(cid)
+            if queue is None:
+                queue = _Queue(cid, priority or PRIORITY.NORMAL)
+                self.queues[cid] = queue
+            if source is not None:
+                queue.source = source
+            cost = frame_cost(message)
+            queue.frames.append((message, cost))
+            queue.size += cost
+            class_queued[queue.priority].value += cost
+            if len(queue.frames) == 1:
+                queue.deficit = 0
+                self.active[queue.priority].append(queue)
+            if queue.size > self.channel_limit and not queue.paused \
+                    and queue.source is not None:
+                queue.paused = True
+                queue.source.pause_reading()
+        if not self.scheduled and not self.paused:
+            # batch frames pushed in the same loop iteration
+            self.scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        transport = self.transport
+        if self.closed or transport.is_closing():
+            return
+        if self.control:
+            parts = []
+            while self.control:
+                parts.extend(self.encode(self.control.popleft()))
+            transport.writelines(parts)
+        while not self.paused and self.backlogged:
+            # one round over every class
+            for priority in CLASSES:
+                if self.paused:
+                    break
+                self._serve(self.active[priority], priority)
+
+    @property
+    def backlogged(self):
+        return any(self.active.values())
+
+    def _serve(self, ring, priority):
+        transport = self.transport
+        quantum = self.quantum * WEIGHTS[priority]
+        nbytes = nframes = 0
+        for _ in range(len(ring)):
+            queue = ring.popleft()
+            queue.deficit += quantum
+            frames = queue.frames
+            parts = []
+            while frames and frames[0][1] <= queue.deficit:
+                message, cost = frames.popleft()
+                queue.deficit -= cost
+                queue.size -= cost
+                nbytes += cost
+                nframes += 1
+                parts.extend(self.encode(message))
+            if parts:
+                # vectored write of headers and payloads, no joining
+                # on Python 3.12+
+                transport.writelines(parts)
+            if queue.paused and queue.size <= self.channel_limit // 2:
+                queue.paused = False
+                if not queue.source.is_closing():
+                    queue.source.resume_reading()
+            if frames:
+                ring.append(queue)
+            else:
+                queue.deficit = 0
+                del self.queues[queue.cid]
+            if transport.get_write_buffer_size() > self.high_water:
+                self.pause()
+            if self.paused:
+                break
+        class_bytes[priority].value += nbytes
+        class_frames[priority].value += nframes
+        class_queued[priority].value -= nbytes
+
+    def pause(self):
+        if self.paused:
+            return
+        self.paused = True
+        if self.drain is not None:
+            asyncio.ensure_future(self._wait_drain())
+
+    async def _wait_drain(self):
+        try:
+            await self.drain()
+        except ConnectionError:
+            self.close()
+            return
+        self.resume()
+
+    def resume(self):
+        self.paused = False
+        if (self.backlogged or self.control) and not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def pending(self, cid):
+        """ bytes queued for channel cid """
+        queue = self.queues.get(cid)
+        return 0 if queue is None else queue.size
+
+    def close(self):
+        self.closed = True
+        self.control.clear()
+        for queue in self.queues.values():
+            class_queued[queue.priority].value -= queue.size
+        self.queues.clear()
+        for ring in self.active.values():
+            ring.clear()
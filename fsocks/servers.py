@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+""" fservers of fclient: latency, health and selection
+
+Every server is probed with a Hello/HandShake exchange on a new
+connection, the Hello round trip is a sample of its RTT, smoothed like
+TCP's (RFC 6298). A server whose probes or tunnel fail `failures` times
+in a row is down until one succeeds again.
+
+New channels go to the server with an open tunnel and the lowest
+smoothed RTT, servers that are down only when no other one is left.
+"""
+from . import metrics
+
+
+__all__ = ['Server', 'Servers', 'parse_servers']
+
+
+def parse_servers(entries, default):
+    """ (host, port) of config.servers entries, "host:port" strings or
+    {"host": ..., "port": ...}, [default] if there are none
+    """
+    addresses = []
+    for entry in entries:
+        if isinstance(entry, str):
+            host, _, port = entry.rpartition(':')
+            if not host or not port.isdigit():
+                raise ValueError('invalid server {}'.format(entry))
+            addresses.append((host.strip('[]'), int(port)))
+        else:
+            addresses.append((entry['host'], int(entry['port'])))
+    return addresses or [default]
+
+
+class Server:
+    __slots__ = ('host', 'port', 'name', 'srtt', 'rttvar', 'failures',
+                 'tunnel', 'channels', 'probes', 'probe_failures')
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.name = '{}:{}'.format(host, port)
+        self.srtt = None  # no sample yet
+        self.rttvar = 0.0
+        self.failures = 0  # in a row
+        self.tunnel = None  # open tunnel to it, if any
+        labels = {'server': self.name}
+        self.channels = metrics.registry.counter(
+            'fsocks_server_channels_total', 'Channels opened per server',
+            **labels)
+        self.probes = metrics.registry.counter(
+            'fsocks_server_probes_total', 'Handshake probes per server',
+            result='ok', **labels)
+        self.probe_failures = metrics.registry.counter(
+            'fsocks_server_probes_total', 'Handshake probes per server',
+            result='error', **labels)
+        metrics.registry.gauge(
+            'fsocks_server_rtt_seconds', 'Smoothed handshake RTT per server',
+            func=lambda: self.srtt or 0, **labels)
+
+    def __str__(self):
+        return self.name
+
+
+class Servers:
+
+    def __init__(self, addresses, failures=3):
+        self.servers = [Server(host, port) for host, port in addresses]
+        self.failures = failures
+        for server in self.servers:
+            metrics.registry.gauge(
+                'fsocks_server_up', 'Servers taking new channels',
+                func=lambda server=server: int(self.usable(server)),
+                server=server.name)
+
+    def healthy(self, server):
+        return server.failures < self.failures
+
+    def usable(self, server):
+        return server.tunnel is not None and self.healthy(server)
+
+    def succeeded(self, server, rtt):
+        """ record a successful probe or negotiation """
+        if server.srtt is None:
+            server.srtt = rtt
+            server.rttvar = rtt / 2
+        else:
+            server.rttvar += (abs(server.srtt - rtt) - server.rttvar) / 4
+            server.srtt += (rtt - server.srtt) / 8
+        server.failures = 0
+        server.probes.inc()
+
+    def failed(self, server):
+        server.failures += 1
+        server.probe_failures.inc()
+
+    def best(self):
+        """ server to open a new channel through, None if no tunnel
+        is open
+        """
+        best = None
+        best_key = None
+        for server in self.servers:
+            if server.tunnel is None:
+                continue
+            key = (not self.healthy(server),
+                   float('inf') if server.srtt is None else server.srtt)
+            if best is None or key < best_key:
+                best, best_key = server, key
+        return best
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def __len__(self):
+        return len(self.servers)
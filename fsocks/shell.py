@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 import sys
-from fsocks.log import logger
+from fsocks import log
 
 
 def check_python():
-    info = sys.version_info
-    if info[0] < 3 or info[1] < 5:
-        print('Python 3.5+ required')
+    # asyncio.BufferedProtocol of tunnel_server
+    if sys.version_info < (3, 7):
+        print('Python 3.7+ required')
         sys.exit(1)
 
 
@@ -18,12 +18,59 @@ class Config:
             "client_port": 1080,
             "server_host": "0.0.0.0",
             "server_port": 1081,
+            # fclient: ["host:port", ...] or [{"host":, "port":}, ...],
+            # server_host/server_port if empty
+            "servers": [],
+            "server_probe_interval": 10,  # seconds between handshakes
+            "server_failures": 3,  # failed probes in a row, server is down
             "method": "sha256",
             "password": "my_password",
-            "timeout": 6.6,
-            "loglevel": "DEBUG"
+            "timeout": 6.6,  # ceiling of adaptive connect timeouts
+            "connect_timeout_min": 2,  # their floor
+            "circuit_failures": 3,  # failed connects in a row, 0: never
+            "negative_ttl": 5,  # seconds failing fast, doubling to 60
+            # connects in progress on fserver, over those they queue
+            "connect_limit": 256,
+            "connect_limit_tunnel": 128,
+            "connect_limit_destination": 16,
+            "connect_queue": 1024,  # waiting connects, more are rejected
+            "connect_queue_timeout": 5,  # seconds waiting at most
+            "idle_timeout": 300,  # 0 means never
+            "half_open_timeout": 30,
+            "udp_timeout": 60,  # UDP ASSOCIATE expiry without traffic
+            "user_buffer_limit": 16384,  # bytes buffered before pausing
+            # "protocol": callbacks per user, "stream": a task per user
+            "user_mode": "protocol",
+            "read_size_min": 2048,  # adaptive read size of user sockets
+            "read_size_max": 262144,
+            # fserver switches busy tunnels to their cheapest fuzz
+            # when the loop lags or fuzzing costs too much CPU
+            "renegotiate_interval": 5,  # seconds between load checks
+            "renegotiate_lag": 0.1,  # loop lag seconds, 0 means never
+            "renegotiate_cpu_per_mb": 0.05,  # CPU seconds, 0 means never
+            "priority_rules": [],  # see fsocks.priority.Rule
+            # CONNECTs of fclient routed direct or through the tunnel,
+            # see fsocks.routing
+            "route_rules": [],
+            "route_default": "tunnel",
+            "loglevel": "DEBUG",
+            "log_file": None,
+            "log_async": True,
+            "log_ratelimit": 0,  # seconds between identical warnings, 0: off
+            "metrics_host": "127.0.0.1",
+            "metrics_port": 0,  # 0 means disabled
+            "metrics_path": None,  # unix socket, overrides host/port
+            "profile_dir": ".",
+            "profile_seconds": 30
         }
 
+    def __getattr__(self, key):
+        # fallback to defaults before load_args()
+        try:
+            return self.__dict__['raw'][key]
+        except KeyError:
+            raise AttributeError(key)
+
     @property
     def client_address(self):
         return (self.client_host, self.client_port)
@@ -47,7 +94,8 @@ class Config:
         self.raw.update(_cfg)
         for key in self.raw:
             setattr(self, key, self.raw[key])
-        logger.setLevel(self.loglevel)
+        log.setup(self.loglevel, self.log_file,
+                  self.log_async, self.log_ratelimit)
 
 
 config = Config()
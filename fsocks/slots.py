@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+""" dense channel id allocator
+
+A channel id is a 32 bits integer carried in SRC/DST of tunnel messages:
+
+    +------------+-------------+
+    | GENERATION |    INDEX    |
+    +------------+-------------+
+    |  12 bits   |   20 bits   |
+    +------------+-------------+
+
+INDEX points into a compact slot table, GENERATION is bumped every time
+the slot is freed, so that late frames for a closed channel never
+reach the new channel reusing its slot. Generation starts at 1,
+thus 0 is never a valid id.
+"""
+
+
+__all__ = ['SlotTable', 'SlotError']
+
+
+INDEX_BITS = 20
+INDEX_MASK = (1 << INDEX_BITS) - 1
+GENERATION_MASK = (1 << (32 - INDEX_BITS)) - 1
+
+
+class SlotError(Exception):
+    pass
+
+
+class SlotTable:
+
+    def __init__(self, capacity=INDEX_MASK + 1):
+        assert 0 < capacity <= INDEX_MASK + 1
+        self.capacity = capacity
+        self.items = []
+        self.generations = []
+        self.free = []  # freed indexes, reused LIFO
+        self.count = 0
+
+    def add(self, item):
+        """ store item and return its id """
+        assert item is not None
+        if self.free:
+            index = self.free.pop()
+        else:
+            index = len(self.items)
+            if index >= self.capacity:
+                raise SlotError('no free slot')
+            self.items.append(None)
+            self.generations.append(1)
+        self.items[index] = item
+        self.count += 1
+        return (self.generations[index] << INDEX_BITS) | index
+
+    def get(self, cid, default=None):
+        index = cid & INDEX_MASK
+        if index < len(self.items) \
+                and self.generations[index] == cid >> INDEX_BITS:
+            item = self.items[index]
+            if item is not None:
+                return item
+        return default
+
+    def remove(self, cid):
+        """ free slot of cid, return the item or None if it's stale """
+        item = self.get(cid)
+        if item is None:
+            return None
+        index = cid & INDEX_MASK
+        self.items[index] = None
+        self.generations[index] = \
+            self.generations[index] % GENERATION_MASK + 1
+        self.free.append(index)
+        self.count -= 1
+        return item
+
+    def values(self):
+        return [item for item in self.items if item is not None]
+
+    def __contains__(self, cid):
+        return self.get(cid) is not None
+
+    def __len__(self):
+        return self.count
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import io
 import struct
 import ipaddress
 from enum import Enum, unique
@@ -51,6 +52,39 @@ class REP(Enum):
     ADDRESS_TYPE_NOT_SUPPORTED = 0x08
 
 
+def atype_of(host):
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        return ATYPE.DOMAINNAME
+    return ATYPE.IPV4 if ip.version == 4 else ATYPE.IPV6
+
+
+def read_address(stream, atype):
+    """ read ADDR and PORT of given ATYP, return (host, port) """
+    if atype is ATYPE.DOMAINNAME:
+        alen = struct.unpack('!B', stream.read(1))[0]
+        host = stream.read(alen).decode()
+    elif atype is ATYPE.IPV4:
+        host = ipaddress.IPv4Address(stream.read(4)).compressed
+    elif atype is ATYPE.IPV6:
+        host = ipaddress.IPv6Address(stream.read(16)).compressed
+    port = struct.unpack('!H', stream.read(2))[0]
+    return host, port
+
+
+def pack_address(atype, addr):
+    """ ADDR and PORT of given ATYP """
+    if atype is ATYPE.DOMAINNAME:
+        alen = len(addr[0].encode())
+        data = struct.pack('!B{}s'.format(alen), alen, addr[0].encode())
+    elif atype is ATYPE.IPV4:
+        data = ipaddress.IPv4Address(addr[0]).packed
+    elif atype is ATYPE.IPV6:
+        data = ipaddress.IPv6Address(addr[0]).packed
+    return data + struct.pack('!H', addr[1])
+
+
 class Message:
     """SOCKS message
     Request:
@@ -93,15 +127,7 @@ class Message:
             raise SocksError(
                 REP.GENERAL_SOCKS_SERVER_FAILURE,
                 str(e))
-        if atype is ATYPE.DOMAINNAME:
-            alen = struct.unpack('!B', stream.read(1))[0]
-            host = stream.read(alen).decode()
-        elif atype is ATYPE.IPV4:
-            host = ipaddress.IPv4Address(stream.read(4)).compressed
-        elif atype is ATYPE.IPV6:
-            host = ipaddress.IPv6Address(stream.read(16)).compressed
-        port = struct.unpack('!H', stream.read(2))[0]
-        return cls(ver, code, atype, (host, port))
+        return cls(ver, code, atype, read_address(stream, atype))
 
     @classmethod
     async def from_reader(cls, reader, request=True):
@@ -127,16 +153,7 @@ class Message:
     def to_bytes(self):
         data = struct.pack('!4B', self.ver.value, self.code.value,
                            self.RSV, self.atype.value)
-        if self.atype is ATYPE.DOMAINNAME:
-            alen = len(self.addr[0].encode())
-            data += struct.pack('!B{}s'.format(alen),
-                                alen, self.addr[0].encode())
-        elif self.atype is ATYPE.IPV4:
-            data += ipaddress.IPv4Address(self.addr[0]).packed
-        elif self.atype is ATYPE.IPV6:
-            data += ipaddress.IPv6Address(self.addr[0]).packed
-        data += struct.pack('!H', self.addr[1])
-        return data
+        return data + pack_address(self.atype, self.addr)
 
     def __str__(self):
         return '<{} {} {} {}:{}>'.format(
@@ -192,3 +209,144 @@ class ServerGreeting:
 
     def __str__(self):
         return '<{} {}>'.format(self.ver.name, self.method.name)
+
+
+class UdpDatagram:
+    """SOCKS UDP request header, RFC1928 section 7
+        +----+------+------+----------+----------+----------+
+        |RSV | FRAG | ATYP | DST.ADDR | DST.PORT |   DATA   |
+        +----+------+------+----------+----------+----------+
+        | 2  |  1   |  1   | Variable |    2     | Variable |
+        +----+------+------+----------+----------+----------+
+    """
+
+    def __init__(self, addr, data, frag=0):
+        self.addr = addr
+        self.data = data
+        self.frag = frag
+
+    @classmethod
+    def from_bytes(cls, data):
+        stream = io.BytesIO(data)
+        try:
+            rsv, frag, atype = struct.unpack('!HBB', stream.read(4))
+            atype = ATYPE(atype)
+            addr = read_address(stream, atype)
+        except (ValueError, struct.error) as e:
+            raise SocksError(REP.GENERAL_SOCKS_SERVER_FAILURE, str(e))
+        return cls(addr, data[stream.tell():], frag)
+
+    def to_bytes(self):
+        atype = atype_of(self.addr[0])
+        return struct.pack('!HBB', 0, self.frag, atype.value) \
+            + pack_address(atype, self.addr) + self.data
+
+    def __str__(self):
+        return '<UDP {}:{} {} bytes>'.format(
+            self.addr[0], self.addr[1], len(self.data))
+
+
+# precomputed greeting replies of a server without authentication
+NO_AUTH_GREETING = ServerGreeting().to_bytes()
+NO_ACCEPTABLE_GREETING = ServerGreeting(
+    method=METHOD.NO_ACCEPTABLE_METHODS).to_bytes()
+
+_ADDRESS_LENGTH = {ATYPE.IPV4.value: 4, ATYPE.IPV6.value: 16}
+
+
+class HandshakeParser:
+    """ incremental parser of client greeting then request
+
+    Bytes are fed as they are received, in one buffer, so a greeting
+    and request pipelined in a single segment are both parsed, and
+    bytes following the request are kept in `buffer` as early data.
+        parser = HandshakeParser()
+        while parser.request is None:
+            parser.feed(await reader.read(n))
+            if parser.greeting_done: ...
+    """
+    GREETING, REQUEST, DONE = range(3)
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.state = self.GREETING
+        self.methods = None
+        self.request = None
+
+    @property
+    def greeting_done(self):
+        return self.methods is not None
+
+    @property
+    def no_auth(self):
+        """ client offered NO AUTHENTICATION REQUIRED """
+        return METHOD.NO_AUTHENTICATION_REQUIRED.value in self.methods
+
+    def feed(self, data):
+        """ return True once request is parsed, raise SocksError """
+        self.buffer += data
+        if self.state == self.GREETING:
+            if not self._parse_greeting():
+                return False
+        if self.state == self.REQUEST:
+            if not self._parse_request():
+                return False
+        return True
+
+    def _parse_greeting(self):
+        buf = self.buffer
+        if len(buf) < 2:
+            return False
+        if buf[0] != VER.SOCKS5.value:
+            raise SocksError(REP.GENERAL_SOCKS_SERVER_FAILURE,
+                             'invalid version {}'.format(buf[0]))
+        end = 2 + buf[1]
+        if len(buf) < end:
+            return False
+        self.methods = bytes(buf[2:end])
+        del buf[:end]
+        self.state = self.REQUEST
+        return True
+
+    def _parse_request(self):
+        buf = self.buffer
+        if len(buf) < 5:
+            return False
+        ver, code, rsv, atype = struct.unpack_from('!4B', buf)
+        if ver != VER.SOCKS5.value:
+            raise SocksError(REP.GENERAL_SOCKS_SERVER_FAILURE,
+                             'invalid version {}'.format(ver))
+        try:
+            code = CMD(code)
+        except ValueError as e:
+            raise SocksError(REP.COMMAND_NOT_SUPPORTED, str(e))
+        try:
+            atype = ATYPE(atype)
+        except ValueError as e:
+            raise SocksError(REP.ADDRESS_TYPE_NOT_SUPPORTED, str(e))
+        if rsv != Message.RSV:
+            raise SocksError(REP.GENERAL_SOCKS_SERVER_FAILURE,
+                             'invalid RSV {}'.format(rsv))
+        if atype is ATYPE.DOMAINNAME:
+            start = 5
+            end = start + buf[4]
+        else:
+            start = 4
+            end = start + _ADDRESS_LENGTH[atype.value]
+        if len(buf) < end + 2:
+            return False
+        raw = bytes(buf[start:end])
+        if atype is ATYPE.DOMAINNAME:
+            try:
+                host = raw.decode()
+            except UnicodeDecodeError as e:
+                raise SocksError(REP.GENERAL_SOCKS_SERVER_FAILURE, str(e))
+        elif atype is ATYPE.IPV4:
+            host = ipaddress.IPv4Address(raw).compressed
+        else:
+            host = ipaddress.IPv6Address(raw).compressed
+        port, = struct.unpack_from('!H', buf, end)
+        del buf[:end + 2]
+        self.request = Message(VER.SOCKS5, code, atype, (host, port))
+        self.state = self.DONE
+        return True
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+""" hashed timer wheel
+
+Thousands of channels with idle timeouts would mean thousands of
+loop.call_later() handles in the loop's heap. The wheel keeps timers in
+buckets hashed by deadline tick and runs a single call_later() per tick,
+scheduling/cancelling a timer is O(1).
+
+Accuracy is one tick, which is fine for idle/half-open timeouts.
+"""
+import asyncio
+import weakref
+
+
+__all__ = ['TimerWheel', 'get_wheel']
+
+
+class Timer:
+    __slots__ = ('callback', 'args', 'rounds', 'bucket')
+
+    def __init__(self, callback, args, rounds, bucket):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.bucket = bucket
+
+    @property
+    def cancelled(self):
+        return self.bucket is None
+
+
+class TimerWheel:
+
+    def __init__(self, loop, tick=1.0, size=512):
+        self.loop = loop
+        self.tick = tick
+        self.buckets = [dict() for _ in range(size)]  # Timer -> None
+        self.cursor = 0
+        self.count = 0
+        self.handle = None
+        self.now = loop.time()  # coarse clock, updated every tick
+
+    def schedule(self, delay, callback, *args):
+        """ call callback(*args) after delay seconds (rounded up to tick) """
+        if self.handle is None:
+            self.now = self.loop.time()
+        ticks = max(1, int(-(-delay // self.tick)))
+        rounds, offset = divmod(ticks - 1, len(self.buckets))
+        bucket = self.buckets[(self.cursor + 1 + offset) % len(self.buckets)]
+        timer = Timer(callback, args, rounds, bucket)
+        bucket[timer] = None
+        self.count += 1
+        if self.handle is None:
+            self.handle = self.loop.call_later(self.tick, self._advance)
+        return timer
+
+    def cancel(self, timer):
+        if timer is None or timer.bucket is None:
+            return
+        del timer.bucket[timer]
+        timer.bucket = None
+        self.count -= 1
+
+    def _advance(self):
+        self.now = self.loop.time()
+        self.cursor = (self.cursor + 1) % len(self.buckets)
+        bucket = self.buckets[self.cursor]
+        expired = []
+        for timer in bucket:
+            if timer.rounds > 0:
+                timer.rounds -= 1
+            else:
+                expired.append(timer)
+        for timer in expired:
+            del bucket[timer]
+            timer.bucket = None
+        self.count -= len(expired)
+        for timer in expired:
+            timer.callback(*timer.args)
+        if self.count > 0:
+            self.handle = self.loop.call_later(self.tick, self._advance)
+        else:
+            self.handle = None
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        for bucket in self.buckets:
+            for timer in bucket:
+                timer.bucket = None
+            bucket.clear()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+
+_wheels = weakref.WeakKeyDictionary()
+
+
+def get_wheel(loop=None):
+    """ one shared wheel per event loop """
+    loop = loop or asyncio.get_event_loop()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = TimerWheel(loop)
+        _wheels[loop] = wheel
+    return wheel
@@ -1,17 +1,51 @@
 #!/usr/bin/env python3
 import sys
 import asyncio
+import logging
 from fsocks import logger, config, protocol, socks
-from fsocks import fuzzing, cryption
+from fsocks import fuzzing, cryption, metrics, profiling, timer, udp
+from fsocks.net import ReadSizer
+from fsocks.slots import SlotTable, SlotError
+from fsocks.scheduler import EgressScheduler
+from fsocks.priority import PriorityRules
+from fsocks.routing import Router, ROUTE
+from fsocks.destinations import error_code
+from fsocks.servers import Servers, parse_servers
+
+
+routed_direct = metrics.registry.counter(
+    'fsocks_routed_total', 'CONNECT requests by route', route='direct')
+routed_tunnel = metrics.registry.counter(
+    'fsocks_routed_total', 'CONNECT requests by route', route='tunnel')
 
 
 class User:
-    def __init__(self, reader, writer):
+    __slots__ = ('transport', 'reader', 'writer', 'user_id', 'remote_id',
+                 'task', 'connect_begin', 'timer', 'last_active', 'priority',
+                 'udp', 'direct', 'tunnel', 'ready', 'paused')
+
+    def __init__(self, transport, reader=None, writer=None):
+        """ reader and writer are None for users of UserProtocol """
+        self.transport = transport
         self.reader = reader
         self.writer = writer
-        self.user_id = writer.transport._sock_fd
+        self.user_id = None  # allocated by TunnelClient.users
         self.remote_id = None
         self.task = None
+        self.connect_begin = None
+        self.timer = None
+        self.last_active = 0
+        self.priority = None
+        self.udp = None  # UdpRelay of UDP ASSOCIATE
+        self.direct = None  # transport to destination, routed directly
+        self.tunnel = None  # Tunnel of the channel otherwise
+        self.paused = False  # server stopped reading its remote
+        # resolved True on successful REPLY, False when deleted before
+        self.ready = asyncio.get_event_loop().create_future()
+
+    @property
+    def idle_timeout(self):
+        return config.udp_timeout if self.udp else config.idle_timeout
 
     @property
     def actived(self):
@@ -21,9 +55,19 @@ class User:
     def established(self):
         return self.remote_id is not None
 
-    def close(self):
+    def close(self, abort=True):
+        if self.remote_id:  # 0 for failed connection
+            metrics.channels.dec()
         self.remote_id = None
-        self.writer.transport.abort()
+        if self.udp is not None:
+            self.udp.close()
+        for transport in (self.transport, self.direct):
+            if transport is None:
+                continue
+            if abort:
+                transport.abort()
+            else:
+                transport.close()
         # self.task.cancel()
         # self.task = None
 
@@ -31,6 +75,284 @@ class User:
         return 'User(%d)' % self.user_id
 
 
+class UdpRelay:
+    """ client side of UDP ASSOCIATE: SOCKS UDP datagrams of the user
+    are batched into DATAGRAM messages, and the other way around
+    """
+    __slots__ = ('client', 'user', 'transport', 'user_host', 'user_addr',
+                 'batcher')
+
+    def __init__(self, client, user):
+        self.client = client
+        self.user = user
+        self.transport = None
+        self.user_host = user.transport.get_extra_info('peername')[0]
+        self.user_addr = None  # learnt from first datagram
+        self.batcher = udp.Batcher(self.flush)
+
+    async def open(self, host):
+        loop = asyncio.get_event_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: udp.Endpoint(self.received), local_addr=(host, 0))
+        return self.transport.get_extra_info('sockname')[:2]
+
+    def received(self, data, addr):
+        user = self.user
+        # only relay datagrams of the host owning the TCP association
+        if addr[0] != self.user_host or not user.established:
+            return
+        try:
+            datagram = socks.UdpDatagram.from_bytes(data)
+        except socks.SocksError:
+            return
+        if datagram.frag != 0:
+            # fragmentation is not supported, drop it
+            return
+        self.user_addr = addr
+        user.last_active = self.client.wheel.now
+        self.batcher.add(datagram.addr, datagram.data)
+
+    def flush(self, batch):
+        user = self.user
+        if not user.established:
+            return
+        packet = protocol.Datagram(user.user_id, user.remote_id, batch)
+        user.tunnel.scheduler.push(user.user_id, packet,
+                                   self.transport, user.priority)
+
+    def send(self, datagrams):
+        if self.user_addr is None:
+            return
+        for addr, data in datagrams:
+            self.transport.sendto(
+                socks.UdpDatagram(addr, data).to_bytes(), self.user_addr)
+
+    def close(self):
+        self.batcher.close()
+        if self.transport is not None:
+            self.transport.abort()
+
+
+class Direct(asyncio.Protocol):
+    """ connection to the destination of a user routed directly, data
+    is relayed as is, without framing nor fuzzing
+    """
+    __slots__ = ('client', 'user', 'transport')
+
+    def __init__(self, client, user):
+        self.client = client
+        self.user = user
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # resumed once the user got its REPLY
+        transport.pause_reading()
+
+    def data_received(self, data):
+        user = self.user
+        user.last_active = self.client.wheel.now
+        user.transport.write(data)
+        if user.writer is not None and \
+                user.transport.get_write_buffer_size() > \
+                user.transport.get_write_buffer_limits()[1]:
+            # stream user, no pause_writing() reaches us
+            self.transport.pause_reading()
+            asyncio.ensure_future(self._drain(user.writer))
+
+    async def _drain(self, writer):
+        try:
+            await writer.drain()
+        except ConnectionError:
+            return
+        self.transport.resume_reading()
+
+    def eof_received(self):
+        self._closed()
+
+    def connection_lost(self, exc):
+        self._closed()
+
+    def _closed(self):
+        user = self.user
+        if self.client._get_user(user.user_id) is user:
+            self.client._delete_user(user, abort=False)
+
+    def pause_writing(self):
+        self.user.transport.pause_reading()
+
+    def resume_writing(self):
+        self.user.transport.resume_reading()
+
+
+class UserProtocol(asyncio.Protocol):
+    """ SOCKS5 user handled by callbacks (user_mode "protocol"),
+    without a task, StreamReader and StreamWriter per user
+
+    Flow control is explicit: the scheduler pauses reading a user
+    whose channel is backlogged, a user whose write buffer is full
+    pauses its channel on the server with a FLOW message.
+    """
+    __slots__ = ('client', 'user', 'parser', 'pending')
+
+    def __init__(self, client):
+        self.client = client
+        self.user = None
+        self.parser = socks.HandshakeParser()
+        self.pending = None  # data received before REPLY
+
+    def connection_made(self, transport):
+        logger.debug('user accepted')
+        user = User(transport)
+        if self.client._add_user(user):
+            self.user = user
+
+    def data_received(self, data):
+        if self.user is None or self.user.transport.is_closing():
+            return
+        if self.parser is not None:
+            self._handshake(data)
+        elif self.pending is None:
+            self.client._relay(self.user, data)
+        else:
+            # data pipelined before REPLY, hold it until connected
+            self.pending += data
+            if len(self.pending) > config.user_buffer_limit:
+                self.user.transport.pause_reading()
+
+    def _handshake(self, data):
+        client, user, parser = self.client, self.user, self.parser
+        greeted = parser.greeting_done
+        try:
+            done = parser.feed(data)
+        except socks.SocksError as e:
+            logger.warning('invalid SOCKS5 handshake: %s', e)
+            if parser.greeting_done:
+                asyncio.ensure_future(client._reply_error(user, e.code))
+            else:
+                client._delete_user(user)
+            return
+        if parser.greeting_done and not greeted:
+            if not parser.no_auth:
+                logger.warning('no acceptable SOCKS5 method')
+                user.transport.write(socks.NO_ACCEPTABLE_GREETING)
+                client._delete_user(user, abort=False)
+                return
+            user.transport.write(socks.NO_AUTH_GREETING)
+        if done:
+            self.parser = None
+            # bytes pipelined after the request are the first relayed ones
+            self.pending = bytearray(parser.buffer)
+            asyncio.ensure_future(self._request(parser.request))
+
+    async def _request(self, msg):
+        if await self.client._request(self.user, msg):
+            self.user.ready.add_done_callback(self._ready)
+
+    def _ready(self, ready):
+        if not ready.result():
+            return
+        pending = self.pending
+        self.pending = None
+        if pending:
+            self.client._relay(self.user, bytes(pending))
+        self.user.transport.resume_reading()
+
+    def eof_received(self):
+        self._closed()
+
+    def connection_lost(self, exc):
+        self._closed()
+
+    def _closed(self):
+        user = self.user
+        if user is not None and self.client._get_user(user.user_id) is user:
+            self.client._user_closed(user)
+
+    def pause_writing(self):
+        if self.user.direct is not None:
+            self.user.direct.pause_reading()
+        else:
+            self.client._pause_channel(self.user)
+
+    def resume_writing(self):
+        if self.user.direct is not None:
+            self.user.direct.resume_reading()
+        else:
+            self.client._resume_channel(self.user)
+
+
+async def negotiate(host, port, cipher):
+    """ Hello and HandShake with fserver at host:port, return reader,
+    writer, the chosen fuzz and the Hello round trip time
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    loop = asyncio.get_event_loop()
+    try:
+        # > Hello
+        begin = loop.time()
+        writer.write(protocol.Hello().to_packet(cipher))
+        # < Hello
+        hello_response = await protocol.async_read_packet(reader, cipher)
+        rtt = loop.time() - begin
+        logger.debug('%s', hello_response)
+        # > HandShake
+        shake_request = protocol.HandShake(
+            timestamp=hello_response.timestamp)
+        writer.write(shake_request.to_packet(cipher))
+        # < HandShake
+        shake_response = await protocol.async_read_packet(reader, cipher)
+        logger.debug('%s', shake_response)
+    except BaseException:
+        writer.transport.abort()
+        raise
+    return reader, writer, shake_response.fuzz, rtt
+
+
+class Tunnel:
+    """ negotiated connection to one fserver, carrying the channels of
+    the users it was chosen for
+    """
+
+    def __init__(self, client, server):
+        self.client = client
+        self.server = server
+        self.reader = None
+        self.writer = None
+        self.ciphers = None
+        self.scheduler = None
+        self.task = None
+
+    async def open(self, cipher):
+        """ negotiate, start reading the tunnel, return the RTT """
+        server = self.server
+        logger.info('negotiate with server %s', server)
+        reader, writer, fuzz, rtt = await negotiate(
+            server.host, server.port, cipher)
+        logger.info('negotiate with %s done, using fuzz: %s', server, fuzz)
+        self.ciphers = protocol.Ciphers(cipher, fuzz)
+        self.reader = reader
+        self.writer = writer
+        self.scheduler = EgressScheduler(
+            writer.transport, self.ciphers.encode, drain=writer.drain)
+        self.task = asyncio.ensure_future(self.client._handle_tunnel(self))
+        metrics.tunnels.inc()
+        metrics.watch_write_buffer(server.name, writer.transport)
+        self.task.add_done_callback(self._done)
+        server.tunnel = self
+        return rtt
+
+    def _done(self, task):
+        metrics.tunnels.dec()
+        metrics.unwatch_write_buffer(self.server.name)
+        self.writer.transport.abort()
+        stopped = task.cancelled()
+        if not stopped:
+            logger.warning('tunnel to %s is closed: %r',
+                           self.server, task.exception())
+        self.client._tunnel_closed(self, stopped)
+
+
 class TunnelClient:
     """
     fSocks tunnel client, and SOCK5 server for user
@@ -38,191 +360,443 @@ class TunnelClient:
 
     def __init__(self):
         self.socks_server = None
-        self.users = {}  # user_id -> User
-        # Tunnel client
-        # TODO: one tunnel client may have many tunnels
-        self.tunnel_task = None
-        self.tunnel_reader = None
-        self.tunnel_writer = None
+        self.users = SlotTable()  # user_id -> User
+        # a tunnel per server, new channels go to the fastest one
+        self.servers = Servers(
+            parse_servers(config.servers, config.server_address),
+            config.server_failures)
+        self.probe_task = None
+        self.probing = set()  # servers being probed
         self.cipher = cryption.AES256CBC(config.password)
-        self.fuzz = None
+        self.priority_rules = PriorityRules(config.priority_rules)
+        self.router = Router(config.route_rules, config.route_default)
+        self.metrics_server = None
+        self.wheel = None
+
+    def _add_user(self, user):
+        try:
+            user.user_id = self.users.add(user)
+        except SlotError:
+            logger.warning('too many users, %d', len(self.users))
+            user.transport.abort()
+            return False
+        return True
 
     def _accept_user(self, user_reader, user_writer):
         logger.debug('user accepted')
-        user = User(user_reader, user_writer)
+        user = User(user_writer.transport, user_reader, user_writer)
+        if not self._add_user(user):
+            return
         task = asyncio.Task(self._handle_user(user))
         user.task = task
-        self.users[user.user_id] = user
 
         def user_done(task):
             logger.debug('user task done')
         task.add_done_callback(user_done)
 
     def _user_closed(self, user):
-        logger.debug('{} closed'.format(user))
+        logger.debug('%s closed', user)
         if user.established:
-            self.tunnel_writer.write(
-                protocol.Close(user.user_id).to_packet(self.fuzz))
-        user.writer.transport.abort()
+            user.tunnel.scheduler.push(user.user_id,
+                                       protocol.Close(user.user_id),
+                                       priority=user.priority)
+        self._delete_user(user)
+
+    def _delete_user(self, user, abort=True):
+        if not user.ready.done():
+            user.ready.set_result(False)
+        self.wheel.cancel(user.timer)
+        user.timer = None
+        self.users.remove(user.user_id)
+        user.close(abort)
 
-    def _delete_user(self, user):
-        user.close()
-        if user.user_id in self.users:
-            del self.users[user.user_id]
+    def _pause_channel(self, user):
+        """ ask the server to stop reading the remote of user's
+        channel until user takes data again, the other channels of
+        the tunnel keep flowing
+        """
+        if user.established and not user.paused:
+            user.paused = True
+            user.tunnel.scheduler.push(None, protocol.Flow(
+                user.user_id, user.remote_id, True))
+
+    def _resume_channel(self, user):
+        if user.established and user.paused:
+            user.paused = False
+            user.tunnel.scheduler.push(None, protocol.Flow(
+                user.user_id, user.remote_id, False))
+
+    def _check_user(self, user):
+        """ half-open (waiting for REPLY) and idle timeout """
+        user.timer = None
+        if not user.established and user.direct is None:
+            logger.warning('%s got no reply in %ds',
+                           user, config.half_open_timeout)
+            self._delete_user(user)
+            return
+        idle = self.wheel.now - user.last_active
+        if idle < user.idle_timeout:
+            user.timer = self.wheel.schedule(
+                user.idle_timeout - idle, self._check_user, user)
+            return
+        logger.info('%s idle for %ds', user, idle)
+        self._user_closed(user)
 
     def _get_user(self, user_id):
         return self.users.get(user_id, None)
 
+    def _tunnel_user(self, tunnel, user_id):
+        """ user of user_id, if its channel goes through tunnel """
+        user = self.users.get(user_id, None)
+        if user is None or user.tunnel is not tunnel:
+            return None
+        return user
+
     async def safe_write(self, writer, data):
         writer.write(data)
         try:
             await writer.drain()
         except ConnectionResetError as e:
-            logger.warn('write error: {}'.format(e))
+            logger.warning('write error: %s', e)
+
+    async def _write_user(self, user, data):
+        if user.writer is None:
+            # UserProtocol, flow controlled by pause_writing()
+            user.transport.write(data)
+        else:
+            await self.safe_write(user.writer, data)
+
+    def _relay(self, user, data):
+        """ data from user to tunnel, or to its destination if direct """
+        user.last_active = self.wheel.now
+        if user.direct is not None:
+            user.direct.write(data)
+            return
+        metrics.relay_payload_bytes.observe(len(data))
+        packet = protocol.Relaying(user.user_id, user.remote_id, data)
+        user.tunnel.scheduler.push(user.user_id, packet,
+                                   user.transport, user.priority)
 
-    async def _pipe_user(self, user):
+    async def _pipe_user(self, user, data=b''):
+        """ relay user data, starting with data already read """
         # may start before connection to remote is established
+        sizer = ReadSizer(config.read_size_min, config.read_size_max)
         while True:
-            try:
-                data = await user.reader.read(2048)
-            except ConnectionResetError:
-                logger.warn('user connection reset')
-                data = b''
-            if len(data) == 0:
-                self._user_closed(user)
-                break
-            assert user.established
-            packet = protocol.Relaying(
-                user.user_id, user.remote_id, data)
-            await self.safe_write(self.tunnel_writer,
-                                  packet.to_packet(self.fuzz))
+            if not data:
+                try:
+                    data = await user.reader.read(sizer.size)
+                except ConnectionResetError:
+                    logger.warning('user connection reset')
+                    data = b''
+                if len(data) == 0:
+                    self._user_closed(user)
+                    break
+                sizer.update(len(data))
+            if not user.established:
+                # data pipelined before REPLY, hold it until connected
+                if not await user.ready:
+                    break
+            self._relay(user, bytes(data))
+            data = b''
 
-    async def _handle_user(self, user):
-        # ignore client SOCKS5 greeting
-        data = await user.reader.read(256)
-        logger.debug('ignore SOCK5 greeting ({} bytes)'.format(len(data)))
-        # response greeting without auth
-        server_greeting = socks.ServerGreeting()
-        await self.safe_write(user.writer,
-                              server_greeting.to_bytes())
-        # recv CMD
+    async def _read_handshake(self, user):
+        """ parse greeting and request from one buffer, whatever the
+        segmentation, return the parser or None on failure
+        """
+        parser = socks.HandshakeParser()
+        greeted = False
         try:
-            msg = await socks.Message.from_reader(user.reader)
-        except asyncio.streams.IncompleteReadError:
-            self._delete_user(user)
+            while True:
+                data = await user.reader.read(512)
+                if not data:
+                    self._delete_user(user)
+                    return None
+                done = parser.feed(data)
+                if parser.greeting_done and not greeted:
+                    greeted = True
+                    if not parser.no_auth:
+                        logger.warning('no acceptable SOCKS5 method')
+                        user.writer.write(socks.NO_ACCEPTABLE_GREETING)
+                        self._delete_user(user, abort=False)
+                        return None
+                    user.writer.write(socks.NO_AUTH_GREETING)
+                if done:
+                    return parser
+        except socks.SocksError as e:
+            logger.warning('invalid SOCKS5 handshake: %s', e)
+            if parser.greeting_done:
+                await self._reply_error(user, e.code)
+            else:
+                self._delete_user(user)
+            return None
+
+    async def _handle_user(self, user):
+        parser = await self._read_handshake(user)
+        if parser is None:
             return
-        if msg.code is not socks.CMD.CONNECT:
-            logger.warn('unhandle msg {}'.format(msg))
-            rep = socks.Message(
-                socks.VER.SOCKS5,
-                socks.REP.COMMAND_NOT_SUPPORTED,
-                socks.ATYPE.IPV4,
-                ('0', 0))
-            await self.safe_write(user.writer, rep.to_bytes())
+        if not await self._request(user, parser.request):
             return
-        logger.info('connecting {}:{}'.format(msg.addr[0], msg.addr[1]))
+        # bytes pipelined after the request are the first relayed ones
+        await self._pipe_user(user, parser.buffer)
+
+    async def _request(self, user, msg):
+        """ send REQUEST of user to the tunnel, or connect it directly
+        if routed so, False if replied with an error instead
+        """
+        if msg.code is socks.CMD.UDP:
+            user.udp = UdpRelay(self, user)
+            try:
+                await user.udp.open(config.client_host)
+            except OSError as e:
+                logger.warning('udp associate %s', e)
+                await self._reply_error(
+                    user, socks.REP.GENERAL_SOCKS_SERVER_FAILURE)
+                return False
+        elif msg.code is not socks.CMD.CONNECT:
+            logger.warning('unhandle msg %s', msg)
+            await self._reply_error(user, socks.REP.COMMAND_NOT_SUPPORTED)
+            return False
+        elif self.router.route(msg.addr[0]) is ROUTE.DIRECT:
+            routed_direct.inc()
+            return await self._connect_direct(user, msg)
+        else:
+            routed_tunnel.inc()
+        server = self.servers.best()
+        if server is None:
+            logger.warning('no tunnel to any server')
+            await self._reply_error(
+                user, socks.REP.GENERAL_SOCKS_SERVER_FAILURE)
+            return False
+        server.channels.inc()
+        user.tunnel = server.tunnel
+        user.priority = self.priority_rules.match(*msg.addr)
+        logger.info('connecting %s:%d (%s) via %s', msg.addr[0], msg.addr[1],
+                    user.priority.name, server)
         # send to tunnel
         connect_reqeust = protocol.Request(
-            user.user_id, 0, msg)
-        await self.safe_write(self.tunnel_writer,
-                              connect_reqeust.to_packet(self.fuzz))
-        await self._pipe_user(user)
+            user.user_id, 0, msg, user.priority)
+        user.connect_begin = asyncio.get_event_loop().time()
+        if config.half_open_timeout:
+            user.timer = self.wheel.schedule(
+                config.half_open_timeout, self._check_user, user)
+        user.tunnel.scheduler.push(user.user_id, connect_reqeust,
+                                   priority=user.priority)
+        return True
+
+    async def _connect_direct(self, user, msg):
+        """ connect user to its destination without the tunnel """
+        host, port = msg.addr
+        logger.info('connecting %s:%d (direct)', host, port)
+        loop = asyncio.get_event_loop()
+        begin = loop.time()
+        try:
+            transport, _ = await asyncio.wait_for(
+                loop.create_connection(lambda: Direct(self, user),
+                                       host, port),
+                timeout=config.timeout)
+        except (asyncio.TimeoutError, OSError) as e:
+            metrics.connect_failed_seconds.observe(loop.time() - begin)
+            code = error_code(e)
+            logger.warning('connect %s:%d %s %s', host, port, code.name, e)
+            if self._get_user(user.user_id) is user:
+                await self._reply_error(user, code)
+            return False
+        if self._get_user(user.user_id) is not user:
+            # user gone while connecting
+            transport.abort()
+            return False
+        metrics.connect_seconds.observe(loop.time() - begin)
+        user.direct = transport
+        bind_addr = transport.get_extra_info('sockname')
+        rep = socks.Message(socks.VER.SOCKS5, socks.REP.SUCCEEDED,
+                            socks.atype_of(bind_addr[0]), bind_addr[:2])
+        await self._write_user(user, rep.to_bytes())
+        user.last_active = self.wheel.now
+        if not user.ready.done():
+            user.ready.set_result(True)
+        if user.idle_timeout:
+            user.timer = self.wheel.schedule(
+                user.idle_timeout, self._check_user, user)
+        transport.resume_reading()
+        return True
 
-    async def _handle_tunnel(self, reader, writer):
+    async def _reply_error(self, user, code):
+        rep = socks.Message(socks.VER.SOCKS5, code, socks.ATYPE.IPV4,
+                            ('0.0.0.0', 0))
+        await self._write_user(user, rep.to_bytes())
+        self._delete_user(user, abort=False)
+
+    async def _handle_tunnel(self, tunnel):
         logger.debug('_handle_tunnel started')
+        frames = protocol.FrameReader(tunnel.reader, tunnel.ciphers)
         while True:
-            packet = await protocol.async_read_packet(reader, self.fuzz)
-            if packet.mtype is protocol.MTYPE.REPLY:
-                # received a SOCKS reply, update mapping
-                # and forward to corresponding user
-                remote_id = packet.src
-                user_id = packet.dst
-                user = self._get_user(user_id)
-                if user is None:
-                    # Tell server to close
-                    continue
-                await self.safe_write(user.writer,
-                                      packet.msg.to_bytes())
-                user.remote_id = remote_id
-            elif packet.mtype is protocol.MTYPE.RELAYING:
-                # received raw data, forwarding
-                remote_id = packet.src
-                user_id = packet.dst
-                user = self._get_user(user_id)
-                if user is None:
+            # every frame already received, one await per batch
+            for packet in await frames.read_packets():
+                await self._handle_packet(tunnel, packet)
+        logger.debug('_handle_tunnel exited')
+
+    async def _handle_packet(self, tunnel, packet):
+        if packet.mtype is protocol.MTYPE.REPLY:
+            # received a SOCKS reply, update mapping
+            # and forward to corresponding user
+            remote_id = packet.src
+            user_id = packet.dst
+            user = self._tunnel_user(tunnel, user_id)
+            if user is None:
+                if remote_id:
                     # Tell server to close
-                    continue
-                await self.safe_write(user.writer, packet.payload)
-            elif packet.mtype is protocol.MTYPE.CLOSE:
-                # close user tansport
-                user_id = packet.src
-                logger.debug(
-                    'remote disconnected, close user {}'.format(user_id))
-                user = self._get_user(user_id)
-                if user is None:
-                    # ignore
-                    continue
+                    tunnel.scheduler.push(user_id, protocol.Close(user_id))
+                return
+            self.wheel.cancel(user.timer)
+            user.timer = None
+            elapsed = asyncio.get_event_loop().time() - user.connect_begin
+            rep = packet.msg
+            if user.udp is not None and rep.code is socks.REP.SUCCEEDED:
+                # user talks to our UDP relay, not to the server's
+                bind_addr = user.udp.transport.get_extra_info('sockname')
+                rep = socks.Message(socks.VER.SOCKS5, rep.code,
+                                    socks.atype_of(bind_addr[0]),
+                                    bind_addr[:2])
+            await self._write_user(user, rep.to_bytes())
+            if packet.msg.code is not socks.REP.SUCCEEDED:
+                metrics.connect_failed_seconds.observe(elapsed)
+                self._delete_user(user, abort=False)
+                return
+            metrics.connect_seconds.observe(elapsed)
+            metrics.channels.inc()
+            user.remote_id = remote_id
+            user.last_active = self.wheel.now
+            if not user.ready.done():
+                user.ready.set_result(True)
+            if user.idle_timeout:
+                user.timer = self.wheel.schedule(
+                    user.idle_timeout, self._check_user, user)
+        elif packet.mtype is protocol.MTYPE.RELAYING:
+            # received raw data, forwarding
+            remote_id = packet.src
+            user_id = packet.dst
+            user = self._tunnel_user(tunnel, user_id)
+            if user is None:
+                # Tell server to close
+                tunnel.scheduler.push(user_id, protocol.Close(user_id))
+                return
+            user.last_active = self.wheel.now
+            await self._write_user(user, packet.payload)
+        elif packet.mtype is protocol.MTYPE.DATAGRAM:
+            user = self._tunnel_user(tunnel, packet.dst)
+            if user is None or user.udp is None:
+                tunnel.scheduler.push(packet.dst, protocol.Close(packet.dst))
+                return
+            user.last_active = self.wheel.now
+            user.udp.send(packet.datagrams)
+        elif packet.mtype is protocol.MTYPE.CLOSE:
+            # close user tansport
+            user_id = packet.src
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('remote disconnected, close user %d',
+                             user_id)
+            user = self._tunnel_user(tunnel, user_id)
+            if user is None:
+                # ignore
+                return
+            self._delete_user(user)
+        elif packet.mtype is protocol.MTYPE.HANDSHAKE:
+            # server renegotiates the fuzz, acknowledge it
+            logger.info('%s switched to fuzz: %s', tunnel.server, packet.fuzz)
+            ack = tunnel.ciphers.received(packet)
+            if ack is not None:
+                tunnel.scheduler.push(None, ack)
+        else:
+            logger.warning('unknown packet %s', packet)
+
+    def _tunnel_closed(self, tunnel, stopped):
+        """ channels of a lost tunnel are closed, new ones fail over to
+        the other servers
+        """
+        server = tunnel.server
+        if server.tunnel is tunnel:
+            server.tunnel = None
+        for user in list(self.users.values()):
+            if user.tunnel is tunnel:
                 self._delete_user(user)
+        if stopped:
+            return
+        # reopen it at once, then at each probe
+        asyncio.ensure_future(self._probe(server))
+
+    async def _probe(self, server):
+        """ open a tunnel to server, or measure its RTT over a new
+        connection if one is open
+        """
+        if server in self.probing:
+            return
+        self.probing.add(server)
+        try:
+            if server.tunnel is None:
+                rtt = await asyncio.wait_for(
+                    Tunnel(self, server).open(self.cipher), config.timeout)
             else:
-                logger.warn('unknown packet {}'.format(packet))
-        logger.debug('_handle_tunnel exited')
+                _, writer, _, rtt = await asyncio.wait_for(
+                    negotiate(server.host, server.port, self.cipher),
+                    config.timeout)
+                writer.close()
+        except Exception as e:
+            self.servers.failed(server)
+            logger.warning('probe %s failed %d times: %r',
+                           server, server.failures, e)
+            return
+        finally:
+            self.probing.discard(server)
+        self.servers.succeeded(server, rtt)
+        logger.debug('probe %s rtt %.3fs srtt %.3fs',
+                     server, rtt, server.srtt)
 
-    async def start_tunnel(self, loop, host, port):
-        logger.info('negotiate with server {}:{}'.format(
-            config.server_host, config.server_port))
-        reader, writer = await asyncio.open_connection(host, port)
-        # > Hello
-        hello_request = protocol.Hello()
-        await self.safe_write(writer, hello_request.to_packet(self.cipher))
-        # < Hello
-        hello_response = await protocol.async_read_packet(reader, self.cipher)
-        logger.debug(hello_response)
-        # > HandShake
-        shake_request = protocol.HandShake(timestamp=hello_response.timestamp)
-        await self.safe_write(writer, shake_request.to_packet(self.cipher))
-        # < HandShake
-        shake_response = await protocol.async_read_packet(reader, self.cipher)
-        logger.debug(shake_response)
-        logger.info('negotiate done, using fuzz: {}'.format(
-            shake_response.fuzz))
-        self.fuzz = shake_response.fuzz
-        self.tunnel_reader = reader
-        self.tunnel_writer = writer
-        self.tunnel_task = asyncio.Task(self._handle_tunnel(reader, writer))
-
-        def tunnel_done(task):
-            logger.warn('tunnel is closed')
-            sys.exit(2)
-        self.tunnel_task.add_done_callback(tunnel_done)
-        return True
+    async def _probe_servers(self):
+        while True:
+            await asyncio.gather(*[self._probe(server)
+                                   for server in self.servers])
+            await asyncio.sleep(config.server_probe_interval)
 
     def start(self, loop):
-        try:
-            loop.run_until_complete(
-                self.start_tunnel(loop,
-                                  config.server_host,
-                                  config.server_port))
-        except Exception as e:
-            logger.error('Negotiate failed: {}'.format(e))
+        self.wheel = timer.get_wheel(loop)
+        # the first probe opens the tunnels
+        loop.run_until_complete(asyncio.gather(
+            *[self._probe(server) for server in self.servers]))
+        if self.servers.best() is None:
+            logger.error('Negotiate failed with every server')
             sys.exit(1)
-        self.socks_server = loop.run_until_complete(
-            asyncio.streams.start_server(self._accept_user,
-                                         config.client_host,
-                                         config.client_port,
-                                         loop=loop))
-        logger.info('SOCKS5 server listen on {}:{}'.format(
-            config.client_host, config.client_port))
+        self.probe_task = asyncio.ensure_future(self._probe_servers())
+        if config.user_mode == 'stream':
+            server = asyncio.streams.start_server(
+                self._accept_user, config.client_host, config.client_port,
+                limit=config.user_buffer_limit)
+        else:
+            server = loop.create_server(
+                lambda: UserProtocol(self),
+                config.client_host, config.client_port)
+        self.socks_server = loop.run_until_complete(server)
+        logger.info('SOCKS5 server listen on %s:%d',
+                    config.client_host, config.client_port)
+        self.metrics_server = metrics.start(loop, config)
 
     def stop(self, loop):
         if self.socks_server is not None:
             self.socks_server.close()
             loop.run_until_complete(self.socks_server.wait_closed())
             self.socks_server = None
-        if self.tunnel_task is not None:
-            self.tunnel_task.cancel()
-        loop.run_until_complete(asyncio.wait(
-            [u.task for u in self.users.values() if u.actived] +
-            [self.tunnel_task]))
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+        if self.probe_task is not None:
+            self.probe_task.cancel()
+            self.probe_task = None
+        tasks = [server.tunnel.task for server in self.servers
+                 if server.tunnel is not None]
+        for task in tasks:
+            task.cancel()
+        tasks += [u.task for u in self.users.values() if u.actived]
+        if tasks:
+            loop.run_until_complete(asyncio.wait(tasks))
 
 
 def main():
@@ -230,9 +804,11 @@ def main():
     loop = asyncio.get_event_loop()
     tunnel = TunnelClient()
     tunnel.start(loop)
+    profiler = profiling.install(loop, config)
     try:
         loop.run_forever()
     except KeyboardInterrupt:
+        profiler.close()
         tunnel.stop(loop)
         loop.close()
 
@@ -1,227 +1,673 @@
 #!/usr/bin/env python3
-import io
+import os
+import time
 import struct
 import asyncio
 import socket
 import random
 from enum import Enum, unique
 from fsocks import logger, config, protocol, socks
-from fsocks import fuzzing, cryption
+from fsocks import fuzzing, cryption, metrics, profiling, timer, udp
+from fsocks.bufpool import pool
+from fsocks.destinations import Destinations, error_code
+from fsocks.admission import Admission
+from fsocks.net import ReadSizer
+from fsocks.slots import SlotTable, SlotError
+from fsocks.scheduler import EgressScheduler
 
 
-concurrent = 0  # for debug purpose
 # Each TunnelServer can accept many tunnel(connection)s,
 # And every tunnel(connection) is multiplexed for handling
 # many SOCKS5 request. Thus, every tunnel is keeping track of
 # the peer to peer states.
 
 
-class Client(asyncio.Protocol):
+class Client(asyncio.BufferedProtocol):
+    """ remote side of a channel, reading into pooled buffers
+    behind room for the RELAYING header
+    """
+    __slots__ = ('transport', 'channel', 'buffer', 'sizer')
+
     def connection_made(self, transport):
         self.transport = transport
         self.channel = None
-        global concurrent
-        concurrent += 1
+        self.buffer = None
+        self.sizer = ReadSizer(config.read_size_min, config.read_size_max)
+        # resumed by Channel.connect once its REPLY is queued, what the
+        # remote sends first must not come before it nor get lost
+        transport.pause_reading()
+
+    def get_buffer(self, sizehint):
+        if self.buffer is None:
+            self.buffer = pool.acquire(
+                protocol.Relaying.header.size + self.sizer.size)
+        return memoryview(self.buffer)[protocol.Relaying.header.size:]
 
-    def data_received(self, data):
-        self.channel.forward(data, False)
+    def buffer_updated(self, nbytes):
+        buf = self.buffer
+        self.buffer = None
+        self.sizer.update(nbytes)
+        if self.channel is None:
+            pool.release(buf)
+            return
+        self.channel.forward_buffer(buf, nbytes)
 
     def connection_lost(self, exc):
-        global concurrent
-        concurrent -= 1
         if exc is not None:
-            logger.warn('remote closed: {}'.format(exc))
-        self.channel.close()
+            logger.warning('remote closed: %s', exc)
+        if self.channel is not None:
+            self.channel.close()
 
 
 class Channel:
     """ A channel is a peer to peer association """
-    IDLE, CMD, DATA = 0, 1, 2
+    __slots__ = ('tunnel', 'priority', 'remote_transport', 'user', 'remote',
+                 'state', 'timer', 'last_active', 'pauses', 'user_paused')
+    IDLE, CMD, DATA, CLOSED = 0, 1, 2, 3
 
-    def __init__(self, transport, fuzz, user, remote=0):
-        self.tunnel_transport = transport
+    def __init__(self, tunnel, user, remote=0, priority=None):
+        self.tunnel = tunnel
+        self.priority = priority
         self.remote_transport = None
-        self.fuzz = fuzz
         self.user = user
         self.remote = remote
         self.state = self.IDLE
+        self.timer = None
+        self.last_active = 0
+        self.pauses = 0  # reasons to stop reading remote_transport
+        self.user_paused = False  # by FLOW of client
 
     async def connect(self, host, port):
         self.state = self.CMD
         loop = asyncio.get_event_loop()
-        bind_addr = ('255.255.255.255', 0)
+        key = (host, port)
+        code = destinations.check(key, loop.time())
+        if code is not None:
+            fast_failures.inc()
+            logger.info('%s:%d failing, %s', host, port, code.name)
+            self.fail(code)
+            return
+        if not await admission.acquire(self.tunnel, key):
+            logger.warning('too many connects, %s:%d rejected', host, port)
+            self.fail(socks.REP.GENERAL_SOCKS_SERVER_FAILURE)
+            return
+        begin = loop.time()
         try:
-            logger.info('connecting {}:{}'.format(host, port))
+            if self.state != self.CMD:
+                # closed by user while waiting
+                return
+            logger.info('connecting %s:%d', host, port)
             fut = loop.create_connection(Client, host, port)
             transport, client = await \
-                asyncio.wait_for(fut, timeout=config.timeout)
-        except (asyncio.TimeoutError,
-                ConnectionRefusedError,
-                socket.gaierror) as e:
-            logger.warn('connect {}'.format(e))
-            socks_err = socks.Message(socks.VER.SOCKS5,
-                                      socks.REP.NETWORK_UNREACHABLE,
-                                      socks.ATYPE.IPV4, bind_addr)
-            rep = protocol.Reply(self.remote, self.user, socks_err)
-            self.tunnel_transport.write(rep.to_packet(self.fuzz))
-            self.state = self.IDLE
+                asyncio.wait_for(fut, timeout=destinations.timeout(key))
+        except (asyncio.TimeoutError, OSError) as e:
+            now = loop.time()
+            metrics.connect_failed_seconds.observe(now - begin)
+            code = error_code(e)
+            destinations.failed(key, code, now,
+                                isinstance(e, asyncio.TimeoutError))
+            logger.warning('connect %s:%d %s %s', host, port, code.name, e)
+            self.fail(code)
             return
+        finally:
+            admission.release(self.tunnel, key)
+        elapsed = loop.time() - begin
+        destinations.succeeded(key, elapsed)
+        if self.state != self.CMD:
+            # closed by user while connecting
+            transport.abort()
+            return
+        metrics.connect_seconds.observe(elapsed)
+        metrics.channels.inc()
         client.channel = self
         self.remote_transport = transport
-        self.remote = transport._sock_fd
         bind_addr = transport.get_extra_info('sockname')
         socks_ok = socks.Message(socks.VER.SOCKS5, socks.REP.SUCCEEDED,
                                  socks.ATYPE.IPV4, bind_addr)
-        rep = protocol.Reply(self.remote, self.user, socks_ok)
-        self.tunnel_transport.write(rep.to_packet(self.fuzz))
+        self.tunnel.write(protocol.Reply(self.remote, self.user, socks_ok),
+                          self)
         self.state = self.DATA
-        logger.debug('channel {} opened'.format(self))
+        if not self.pauses:
+            transport.resume_reading()
+        self.touch()
+        logger.debug('channel %s opened', self)
+
+    def fail(self, code):
+        """ reply the user with an error code, remote id 0 """
+        if self.state == self.CLOSED:
+            return
+        bind_addr = ('255.255.255.255', 0)
+        socks_err = socks.Message(socks.VER.SOCKS5, code,
+                                  socks.ATYPE.IPV4, bind_addr)
+        self.tunnel.write(protocol.Reply(0, self.user, socks_err), self)
+        self.state = self.CLOSED
+        self.tunnel.remove(self)
+
+    @property
+    def idle_timeout(self):
+        return config.idle_timeout
+
+    def touch(self):
+        self.last_active = self.tunnel.wheel.now
+        if self.timer is None and self.idle_timeout:
+            self.timer = self.tunnel.wheel.schedule(
+                self.idle_timeout, self.check_idle)
 
-    def forward(self, payload, upstream=True):
+    def check_idle(self):
+        self.timer = None
+        idle = self.tunnel.wheel.now - self.last_active
+        if idle < self.idle_timeout:
+            self.timer = self.tunnel.wheel.schedule(
+                self.idle_timeout - idle, self.check_idle)
+            return
+        logger.info('channel %s idle for %ds', self, idle)
+        self.close()
+
+    def forward(self, payload):
+        """ user data to remote """
         if self.state != self.DATA:
-            logger.warn('channel is not ready')
+            logger.warning('channel is not ready')
             return
-        if upstream:
-            return self.remote_transport.write(payload)
-        packet = protocol.Relaying(self.remote, self.user, payload)
-        return self.tunnel_transport.write(packet.to_packet(self.fuzz))
+        self.last_active = self.tunnel.wheel.now
+        self.remote_transport.write(payload)
 
-    def close(self):
-        if self.state == self.IDLE:
+    def forward_buffer(self, buf, nbytes):
+        """ remote data read into pooled buf to user """
+        if self.state != self.DATA:
+            pool.release(buf)
+            logger.warning('channel is not ready')
             return
-        self.state = self.IDLE
+        self.last_active = self.tunnel.wheel.now
+        metrics.relay_payload_bytes.observe(nbytes)
+        start = protocol.Relaying.header.size
+        packet = protocol.Relaying(self.remote, self.user,
+                                   memoryview(buf)[start:start + nbytes], buf)
+        self.tunnel.write(packet, self)
+
+    def pause_reading(self):
+        """ stop reading remote, the channel is the source of its
+        scheduler queue: remote is read again once neither the
+        scheduler nor the user holds it
+        """
+        self.pauses += 1
+        if self.pauses == 1 and self.remote_transport is not None:
+            self.remote_transport.pause_reading()
+
+    def resume_reading(self):
+        self.pauses -= 1
+        if self.pauses == 0 and self.remote_transport is not None:
+            self.remote_transport.resume_reading()
+
+    def is_closing(self):
+        return self.state == self.CLOSED
+
+    def flow(self, paused):
+        """ FLOW of client, its user is slow or takes data again """
+        if paused == self.user_paused:
+            return
+        self.user_paused = paused
+        if paused:
+            self.pause_reading()
+        else:
+            self.resume_reading()
+
+    def close(self, notify=True):
+        """
+        :param notify: tell the user side with a CLOSE message
+        """
+        if self.state == self.CLOSED:
+            return
+        self.state = self.CLOSED
         if self.remote_transport is not None:
+            metrics.channels.dec()
             self.remote_transport.abort()
-        packet = protocol.Close(self.user)
-        self.tunnel_transport.write(packet.to_packet(self.fuzz))
-        logger.debug('channel {} closed'.format(self))
+            self.remote_transport = None
+        if notify:
+            self.tunnel.write(protocol.Close(self.user), self)
+        self.tunnel.remove(self)
+        logger.debug('channel %s closed', self)
 
     def __str__(self):
         return '{}->{}'.format(self.user, self.remote)
 
 
+class Association(Channel):
+    """ UDP ASSOCIATE, the NAT state of one user:
+    datagrams from the user go out of our UDP socket(s), datagrams
+    from any remote come back to the user with their source address.
+    Expires after udp_timeout seconds without traffic.
+    """
+    __slots__ = ('endpoints', 'batcher')
+
+    def __init__(self, tunnel, user, remote=0, priority=None):
+        super().__init__(tunnel, user, remote, priority)
+        self.endpoints = {}  # family -> DatagramTransport
+        self.batcher = None
+
+    @property
+    def idle_timeout(self):
+        return config.udp_timeout
+
+    async def connect(self, host, port):
+        # DST.ADDR/DST.PORT of UDP ASSOCIATE is a hint for the
+        # client side address, meaningless to us
+        self.state = self.CMD
+        try:
+            transport = await self._open(socket.AF_INET)
+        except OSError as e:
+            logger.warning('udp associate %s', e)
+            self.fail(socks.REP.GENERAL_SOCKS_SERVER_FAILURE)
+            return
+        if self.state != self.CMD:
+            transport.abort()
+            return
+        metrics.channels.inc()
+        self.remote_transport = transport
+        self.batcher = udp.Batcher(self.flush)
+        bind_addr = transport.get_extra_info('sockname')
+        socks_ok = socks.Message(socks.VER.SOCKS5, socks.REP.SUCCEEDED,
+                                 socks.ATYPE.IPV4, bind_addr)
+        self.tunnel.write(protocol.Reply(self.remote, self.user, socks_ok),
+                          self)
+        self.state = self.DATA
+        self.touch()
+        logger.debug('association %s opened', self)
+
+    async def _open(self, family):
+        loop = asyncio.get_event_loop()
+        bind = '::' if family == socket.AF_INET6 else '0.0.0.0'
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: udp.Endpoint(self.received),
+            local_addr=(bind, 0), family=family)
+        if family in self.endpoints:
+            # opened concurrently
+            transport.abort()
+        else:
+            self.endpoints[family] = transport
+        return self.endpoints[family]
+
+    def forward_datagrams(self, datagrams):
+        if self.state != self.DATA:
+            logger.warning('channel is not ready')
+            return
+        self.last_active = self.tunnel.wheel.now
+        lookup = resolver.lookup
+        for addr, data in datagrams:
+            cached = lookup(addr[0])
+            transport = None if cached is None \
+                else self.endpoints.get(cached[0])
+            if transport is None:
+                asyncio.ensure_future(self._send_slow(addr, data))
+            else:
+                transport.sendto(data, (cached[1], addr[1]))
+
+    async def _send_slow(self, addr, data):
+        try:
+            family, addr = await resolver.resolve(*addr)
+            transport = self.endpoints.get(family)
+            if transport is None:
+                transport = await self._open(family)
+        except OSError as e:
+            logger.debug('udp send to %s: %s', addr, e)
+            return
+        if self.state == self.DATA:
+            transport.sendto(data, addr)
+
+    def received(self, data, addr):
+        if self.state != self.DATA:
+            return
+        self.last_active = self.tunnel.wheel.now
+        self.batcher.add(addr[:2], data)
+
+    def flush(self, batch):
+        self.tunnel.write(protocol.Datagram(self.remote, self.user, batch),
+                          self)
+
+    def close(self, notify=True):
+        if self.state == self.CLOSED:
+            return
+        if self.batcher is not None:
+            self.batcher.close()
+        for transport in self.endpoints.values():
+            if transport is not self.remote_transport:
+                transport.abort()
+        self.endpoints.clear()
+        super().close(notify)
+
+
+resolver = udp.Resolver()
+destinations = Destinations()
+admission = Admission()
+
+fast_failures = metrics.registry.counter(
+    'fsocks_connect_fast_failures_total',
+    'Connects failed at once, destination circuit open')
+metrics.registry.gauge(
+    'fsocks_open_circuits', 'Destinations failing fast',
+    func=lambda: destinations.open_circuits(
+        asyncio.get_event_loop().time()))
+
+renegotiations = metrics.registry.counter(
+    'fsocks_renegotiations_total', 'Fuzz renegotiations of open tunnels')
+cpu_per_megabyte = metrics.registry.gauge(
+    'fsocks_cpu_seconds_per_megabyte', 'Process CPU time per MB tunneled')
+
+_costs = {}
+
+
+def fuzz_cost(fuzz, size=16384):
+    """ seconds to encrypt and decrypt size bytes, measured once per
+    fuzz method and key
+    """
+    key = (fuzz._name, fuzz._key)
+    cost = _costs.get(key)
+    if cost is None:
+        data = os.urandom(size)
+        begin = time.perf_counter()
+        fuzz.decrypt(fuzz.encrypt(data))
+        cost = _costs[key] = time.perf_counter() - begin
+    return cost
+
+
 class Tunnel:
-    def __init__(self, transport, fuzz):
+    __slots__ = ('transport', 'ciphers', 'offer', 'nbytes', 'channels',
+                 'remotes', 'wheel', 'scheduler')
+
+    def __init__(self, transport, ciphers=None, offer=()):
+        """
+        :param offer: fuzz methods offered by client, to renegotiate
+        """
         self.transport = transport
-        self.fuzz = fuzz
+        self.ciphers = ciphers
+        self.offer = offer
+        self.nbytes = 0  # tunneled since last load check
         self.channels = {}  # user_id -> Channel
+        self.remotes = SlotTable()  # remote_id -> Channel
+        self.wheel = timer.get_wheel()
+        self.scheduler = EgressScheduler(transport, self.encode)
+
+    def encode(self, message):
+        frame = self.ciphers.encode(message)
+        self.nbytes += len(frame[1])
+        buf = getattr(message, 'buffer', None)
+        if buf is not None:
+            message.buffer = None
+            data = frame[1]
+            # unless fuzz kept it as is, data is a copy now
+            if not (isinstance(data, memoryview) and data.obj is buf):
+                pool.release(buf)
+        return frame
+
+    def write(self, message, chan=None):
+        """ queue message of channel to client, keeping channel's order """
+        if chan is None:
+            self.scheduler.push(None, message)
+        else:
+            self.scheduler.push(chan.user, message, chan, chan.priority)
+
+    def renegotiate(self):
+        """ switch to the cheapest fuzz offered by client,
+        return False if already using it or switching
+        """
+        if self.ciphers.switching or not self.offer:
+            return False
+        fuzz = min(self.offer, key=fuzz_cost)
+        if self.ciphers.fuzz.fuzz_list == [fuzz]:
+            return False
+        chain = fuzzing.FuzzChain([fuzz])
+        logger.info('renegotiate %s -> %s', self.ciphers.fuzz, chain)
+        renegotiations.inc()
+        self.scheduler.push(None, self.ciphers.start(chain))
+        return True
+
+    def remove(self, chan):
+        self.wheel.cancel(chan.timer)
+        chan.timer = None
+        if self.channels.get(chan.user) is chan:
+            del self.channels[chan.user]
+        self.remotes.remove(chan.remote)
 
     def handle_request(self, packet):
         if packet.mtype is protocol.MTYPE.REQUEST:
             msg = packet.msg
-            if msg.code is not socks.CMD.CONNECT:
-                logger.warn('unsupported msg: {}'.format(msg))
-                return
             user = packet.src
-            chan = Channel(self.transport, self.fuzz, user)
-            asyncio.ensure_future(chan.connect(msg.addr[0], msg.addr[1]))
+            if msg.code is socks.CMD.CONNECT:
+                chan_cls = Channel
+            elif msg.code is socks.CMD.UDP:
+                chan_cls = Association
+            else:
+                logger.warning('unsupported msg: %s', msg)
+                Channel(self, user).fail(socks.REP.COMMAND_NOT_SUPPORTED)
+                return
+            old = self.channels.get(user)
+            if old is not None:
+                old.close(notify=False)
+            chan = chan_cls(self, user, priority=packet.priority)
+            try:
+                chan.remote = self.remotes.add(chan)
+            except SlotError:
+                logger.warning('too many channels, %d', len(self.remotes))
+                chan.fail(socks.REP.GENERAL_SOCKS_SERVER_FAILURE)
+                return
             self.channels[user] = chan
+            asyncio.ensure_future(chan.connect(msg.addr[0], msg.addr[1]))
         elif packet.mtype is protocol.MTYPE.RELAYING:
-            user = packet.src
-            self.channels[user].forward(packet.payload)
+            chan = self.remotes.get(packet.dst)
+            if chan is None or chan.user != packet.src:
+                logger.warning('relaying to unknown channel %d->%d',
+                               packet.src, packet.dst)
+                # tell client to close the user
+                self.scheduler.push(packet.src, protocol.Close(packet.src))
+                return
+            chan.forward(packet.payload)
+        elif packet.mtype is protocol.MTYPE.DATAGRAM:
+            chan = self.remotes.get(packet.dst)
+            if chan is None or chan.user != packet.src \
+                    or not isinstance(chan, Association):
+                self.scheduler.push(packet.src, protocol.Close(packet.src))
+                return
+            chan.forward_datagrams(packet.datagrams)
         elif packet.mtype is protocol.MTYPE.CLOSE:
-            user = packet.src
-            self.channels[user].close()
+            chan = self.channels.get(packet.src)
+            if chan is not None:
+                chan.close()
+        elif packet.mtype is protocol.MTYPE.FLOW:
+            chan = self.remotes.get(packet.dst)
+            if chan is not None and chan.user == packet.src:
+                chan.flow(packet.paused)
+        elif packet.mtype is protocol.MTYPE.HANDSHAKE:
+            ack = self.ciphers.received(packet)
+            if ack is not None:
+                self.scheduler.push(None, ack)
+            logger.debug('client switched to %s', packet.fuzz)
         else:
-            logger.warn('unkown packet {}'.format(packet))
+            logger.warning('unkown packet %s', packet)
 
     def close(self):
         logger.info('closing channels in tunnel')
-        for user in self.channels:
-            self.channels[user].close()
+        for chan in list(self.channels.values()):
+            chan.close(notify=False)
+        self.scheduler.close()
+
+
+# open tunnels, watched by LoadMonitor
+tunnels = set()
+
+
+class LoadMonitor:
+    """ switch busy tunnels to their cheapest fuzz under load
+
+    Every `interval` seconds, if the event loop lagged more than
+    `max_lag` or the process spent more than `max_cpu_per_mb` CPU
+    seconds per MB tunneled, tunnels carrying a tenth of the traffic
+    or more are renegotiated.
+    """
+    min_bytes = 1 << 20  # traffic measuring CPU per byte
+
+    def __init__(self, loop, interval=5, max_lag=0.1, max_cpu_per_mb=0.05):
+        self.loop = loop
+        self.interval = interval
+        self.max_lag = max_lag
+        self.max_cpu_per_mb = max_cpu_per_mb
+        self.lag = 0.0  # worst one since last check
+        self.lag_monitor = metrics.LoopLagMonitor(loop, histogram=self)
+        self.cpu = 0.0
+        self.handle = None
+
+    def observe(self, lag):
+        """ called by the LoopLagMonitor, as a histogram """
+        self.lag = max(self.lag, lag)
 
+    def start(self):
+        self.lag_monitor.start()
+        self.cpu = time.process_time()
+        self.handle = self.loop.call_later(self.interval, self._check)
 
-class TunnelServer(asyncio.Protocol):
+    def _check(self):
+        self.handle = self.loop.call_later(self.interval, self._check)
+        cpu = time.process_time()
+        nbytes = sum(tunnel.nbytes for tunnel in tunnels)
+        cpu_per_mb = 0.0
+        if nbytes >= self.min_bytes:
+            cpu_per_mb = (cpu - self.cpu) * 1e6 / nbytes
+            cpu_per_megabyte.set(cpu_per_mb)
+        overloaded = (self.max_lag and self.lag >= self.max_lag) or \
+            (self.max_cpu_per_mb and cpu_per_mb >= self.max_cpu_per_mb)
+        if overloaded and nbytes:
+            busy = [tunnel for tunnel in tunnels
+                    if tunnel.nbytes * 10 >= nbytes]
+            switched = sum(tunnel.renegotiate() for tunnel in busy)
+            if switched:
+                logger.info('loop lag %.3fs, %.3fs CPU/MB, '
+                            'renegotiated %d tunnels',
+                            self.lag, cpu_per_mb, switched)
+        for tunnel in tunnels:
+            tunnel.nbytes = 0
+        self.cpu = cpu
+        self.lag = 0.0
+
+    def stop(self):
+        self.lag_monitor.stop()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+class TunnelServer(asyncio.BufferedProtocol):
+    """ tunnel reads go straight into a receive ring, frames are
+    decoded in place from views of it
+    """
     GREETING, NEGOTIATING, OPEN, CLOSING = 0, 1, 2, 3
+    ring_size = 262144  # grown for a bigger frame, then shrunk back
+    min_read = 16384  # compact the ring below this much tail room
 
     def connection_made(self, transport):
-        logger.debug('client {}:{} connected'.format(
-            *transport.get_extra_info('peername')))
+        peername = transport.get_extra_info('peername')
+        logger.debug('client %s:%d connected', *peername)
+        self.tunnel_id = '{}:{}'.format(*peername)
+        metrics.tunnels.inc()
+        metrics.watch_write_buffer(self.tunnel_id, transport)
         self.transport = transport
         self.tunnel = None
         self.state = self.GREETING
-        self.buf = bytearray()
-        self.remains = 0
+        self.ring = bytearray(self.ring_size)
+        self.start = self.end = 0  # unparsed bytes are ring[start:end]
         self.cipher = cryption.AES256CBC(config.password)
-        self.fuzz = None
+        self.ciphers = None
 
     def connection_lost(self, exc):
         self.state = self.CLOSING
-        logger.debug('client {}:{} disconnected'.format(
-            *self.transport.get_extra_info('peername')))
+        metrics.tunnels.dec()
+        metrics.unwatch_write_buffer(self.tunnel_id)
+        logger.debug('client %s disconnected', self.tunnel_id)
         if self.tunnel is not None:
+            tunnels.discard(self.tunnel)
             self.tunnel.close()
 
-    def data_received(self, data):
-        length = len(data)
-        if self.remains > 0:
-            # remaining part of previous packet
-            if length == self.remains:
-                self.buf.extend(data)
-                self.packet_received(self.buf)
-                self.remains = 0
-                self.buf.clear()
-            elif length < self.remains:
-                self.buf.extend(data)
-                self.remains -= length
-            elif length > self.remains:
-                self.buf.extend(data[:self.remains])
-                self.packet_received(self.buf)
-                self.remains = 0
-                self.buf.clear()
-                self.data_received(data[self.remains:])
-            return
-        # start of packet
-        assert length >= 6, 'packet length too small'
-        need_len, = struct.unpack('!I', data[2:6])
-        real_len = length - 6
-        self.remains = need_len - real_len
-        if self.remains == 0:
-            self.packet_received(data)
-        elif self.remains > 0:
-            self.buf.extend(data)
-        elif self.remains < 0:
-            logger.debug('more than one packet recevied at once')
-            self.packet_received(data[:6 + need_len])
-            remaining = data[6 + need_len:]
-            self.remains = 0
-            self.data_received(remaining)
-
-    def packet_received(self, packet_data):
+    def pause_writing(self):
+        if self.tunnel is not None:
+            self.tunnel.scheduler.pause()
+
+    def resume_writing(self):
+        if self.tunnel is not None:
+            self.tunnel.scheduler.resume()
+
+    def get_buffer(self, sizehint):
+        if len(self.ring) - self.end < self.min_read:
+            self._compact()
+        return memoryview(self.ring)[self.end:]
+
+    def _compact(self):
+        """ move the partial frame to the front of the ring,
+        into a bigger ring if the frame does not fit
+        """
+        ring = self.ring
+        pending = self.end - self.start
+        need = pending + self.min_read
+        if pending >= 6:
+            elen, = struct.unpack_from('!I', ring, self.start + 2)
+            need = max(need, 6 + elen)
+        if need > len(ring):
+            self.ring = bytearray(need)
+        self.ring[:pending] = ring[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        if self.tunnel is not None:
+            self.tunnel.nbytes += nbytes
+        ring = self.ring
+        with memoryview(ring) as view:
+            while self.end - self.start >= 6 and self.state != self.CLOSING:
+                etype, elen = struct.unpack_from('!HI', ring, self.start)
+                stop = self.start + 6 + elen
+                if stop > self.end:
+                    # remaining part of packet is not received yet
+                    break
+                edata = view[self.start + 6:stop]
+                self.start = stop
+                self.packet_received(etype, edata)
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.ring) > self.ring_size:
+                self.ring = bytearray(self.ring_size)
+
+    def packet_received(self, etype, edata):
+        """ handle the encrypted data of a frame, a view of the ring """
         if self.state == self.GREETING:
-            packet = protocol.read_packet(
-                io.BytesIO(packet_data), self.cipher)
+            packet = protocol.decode_packet(edata, self.cipher)
             if packet.mtype is not protocol.MTYPE.HELLO:
                 self.transport.abort()
                 self.state = self.CLOSING
                 return
             self.transport.write(
                 protocol.Hello().to_packet(self.cipher))
-            self.tunnel = Tunnel(self.transport, self.fuzz)
+            self.tunnel = Tunnel(self.transport)
             self.state = self.NEGOTIATING
         elif self.state == self.NEGOTIATING:
-            packet = protocol.read_packet(
-                io.BytesIO(packet_data), self.cipher)
+            packet = protocol.decode_packet(edata, self.cipher)
             if packet.mtype is not protocol.MTYPE.HANDSHAKE:
                 self.transport.abort()
                 self.state = self.CLOSING
+                return
             fuzz = self.choose_fuzzer(packet.fuzz.fuzz_list)
-            logger.info('choose {}'.format(fuzz))
+            logger.info('choose %s', fuzz)
             response = protocol.HandShake(fuzz=fuzz)
             self.transport.write(response.to_packet(self.cipher))
-            self.fuzz = fuzz
-            self.tunnel.fuzz = fuzz
+            self.ciphers = protocol.Ciphers(self.cipher, fuzz)
+            self.tunnel.ciphers = self.ciphers
+            self.tunnel.offer = packet.fuzz.fuzz_list
+            tunnels.add(self.tunnel)
             self.state = self.OPEN
         elif self.state == self.OPEN:
-            packet = protocol.read_packet(
-                io.BytesIO(packet_data), self.fuzz)
+            packet = self.ciphers.decode(etype, edata)
             self.tunnel.handle_request(packet)
         else:
-            logger.warn('tunel is closing')
+            logger.warning('tunel is closing')
 
     def choose_fuzzer(self, fuzz_list):
         nfuzzs = len(fuzz_list)
-        logger.info('client HandShake with {} fuzzing methods'.format(nfuzzs))
+        logger.info('client HandShake with %d fuzzing methods', nfuzzs)
         indexes = list(range(nfuzzs))
         random.shuffle(indexes)
         length = random.randint(1, 3)  # chaining too much fuzzers may be slow
@@ -232,14 +678,29 @@ class TunnelServer(asyncio.Protocol):
 def main():
     config.load_args()
     loop = asyncio.get_event_loop()
+    destinations.configure(config.connect_timeout_min, config.timeout,
+                           config.circuit_failures, config.negative_ttl)
+    admission.configure(config.connect_limit, config.connect_limit_tunnel,
+                        config.connect_limit_destination,
+                        config.connect_queue, config.connect_queue_timeout)
     host, port = config.server_address
-    logger.info('tunnel server listen on {}:{}'.format(host, port))
+    logger.info('tunnel server listen on %s:%d', host, port)
     server = loop.create_server(TunnelServer, host, port)
     loop.run_until_complete(server)
+    metrics_server = metrics.start(loop, config)
+    profiler = profiling.install(loop, config)
+    monitor = LoadMonitor(loop, config.renegotiate_interval,
+                          config.renegotiate_lag,
+                          config.renegotiate_cpu_per_mb)
+    monitor.start()
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         logger.info('shuting down tunnel server')
+        monitor.stop()
+        if metrics_server is not None:
+            metrics_server.close()
+        profiler.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+""" helpers for UDP ASSOCIATE
+
+High-rate UDP must not cost one tunnel frame (and one fuzz pass) per
+datagram: datagrams received within one loop iteration are batched
+into a single DATAGRAM message.
+"""
+import socket
+import asyncio
+from .log import logger
+
+
+__all__ = ['Endpoint', 'Batcher', 'Resolver']
+
+
+class Endpoint(asyncio.DatagramProtocol):
+    """ forward every datagram to callback(data, addr) """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.callback(data, addr)
+
+    def error_received(self, exc):
+        logger.debug('udp error: %s', exc)
+
+
+class Batcher:
+    """ collect datagrams and hand them to flush(batch) once per loop
+    iteration, or as soon as max_bytes are pending
+    """
+
+    def __init__(self, flush, max_bytes=32768):
+        self.flush = flush
+        self.max_bytes = max_bytes
+        self.batch = []
+        self.size = 0
+        self.handle = None
+        self.loop = asyncio.get_event_loop()
+
+    def add(self, addr, data):
+        self.batch.append((addr, data))
+        self.size += len(data)
+        if self.size >= self.max_bytes:
+            self._flush()
+        elif self.handle is None:
+            self.handle = self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        self.size = 0
+        self.flush(batch)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.batch = []
+        self.size = 0
+
+
+class Resolver:
+    """ asynchronous getaddrinfo with a small positive cache,
+    so that a DNS lookup is not done for every datagram
+    """
+
+    def __init__(self, ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.cache = {}  # host -> (expire, (family, address))
+
+    def lookup(self, host):
+        """ cached (family, address) of host or None, never blocks """
+        entry = self.cache.get(host)
+        if entry is not None and entry[0] > asyncio.get_event_loop().time():
+            return entry[1]
+        return None
+
+    async def resolve(self, host, port):
+        """ return (family, (address, port)) """
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        cached = self.lookup(host)
+        if cached is not None:
+            return cached[0], (cached[1], port)
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+        family, _, _, _, sockaddr = infos[0]
+        if len(self.cache) >= self.maxsize:
+            self.cache.clear()
+        self.cache[host] = (now + self.ttl, (family, sockaddr[0]))
+        return family, (sockaddr[0], port)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+""" fakes shared by the tests """
+
+
+class FakeTransport:
+    """ records what is written, flow control and closing """
+
+    def __init__(self):
+        self.written = []
+        self.reading = True
+        self.closing = False
+        self.buffered = 0  # reported write buffer size
+
+    @property
+    def data(self):
+        return b''.join(bytes(part) for part in self.written)
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writelines(self, parts):
+        self.written.extend(parts)
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 1234)
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def is_closing(self):
+        return self.closing
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def close(self):
+        self.closing = True
+
+    abort = close
+
+
+class FakeWheel:
+    """ TimerWheel driven by advance(), no event loop """
+
+    def __init__(self):
+        self.now = 0
+        self.timers = {}  # timer -> (deadline, callback, args)
+
+    def schedule(self, delay, callback, *args):
+        timer = object()
+        self.timers[timer] = (self.now + delay, callback, args)
+        return timer
+
+    def cancel(self, timer):
+        self.timers.pop(timer, None)
+
+    def advance(self, seconds):
+        """ move the clock, running the timers due meanwhile """
+        self.now += seconds
+        due = [timer for timer, (deadline, _, _) in self.timers.items()
+               if deadline <= self.now]
+        for timer in due:
+            _, callback, args = self.timers.pop(timer)
+            callback(*args)
+
+    def __len__(self):
+        return len(self.timers)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import asyncio
+from unittest import TestCase
+from fsocks.admission import Admission
+
+
+class TestAdmission(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_soon(self, coro):
+        task = self.loop.create_task(coro)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        return task
+
+    def test_limits(self):
+        admission = Admission(total=3, per_tunnel=2, per_destination=1)
+        acquire = admission.acquire
+        run = self.loop.run_until_complete
+        self.assertTrue(run(acquire('t1', 'a')))
+        self.assertTrue(run(acquire('t1', 'b')))
+        # tunnel t1 full
+        waiting = self.run_soon(acquire('t1', 'c'))
+        self.assertFalse(waiting.done())
+        self.assertTrue(run(acquire('t2', 'd')))
+        admission.release('t1', 'a')
+        self.assertTrue(run(waiting))
+        self.assertEqual(3, admission.active)
+        self.assertEqual({'t1': 2, 't2': 1}, admission.tunnels)
+
+    def test_fairness(self):
+        admission = Admission(total=2, per_destination=1)
+        run = self.loop.run_until_complete
+        self.assertTrue(run(admission.acquire('t', 'slow')))
+        self.assertTrue(run(admission.acquire('t', 'b')))
+        # first waiter still blocked by its destination
+        blocked = self.run_soon(admission.acquire('t', 'slow'))
+        other = self.run_soon(admission.acquire('t', 'c'))
+        admission.release('t', 'b')
+        self.assertTrue(run(other))
+        self.assertFalse(blocked.done())
+        admission.release('t', 'slow')
+        self.assertTrue(run(blocked))
+
+    def test_rejected(self):
+        admission = Admission(total=1, max_queue=1, max_wait=0.01)
+        run = self.loop.run_until_complete
+        self.assertTrue(run(admission.acquire('t', 'a')))
+        waiting = self.run_soon(admission.acquire('t', 'b'))
+        # queue full
+        self.assertFalse(run(admission.acquire('t', 'c')))
+        # timed out
+        self.assertFalse(run(waiting))
+        self.assertEqual(0, len(admission.waiters))
+        admission.release('t', 'a')
+        self.assertEqual(0, admission.active)
+        self.assertEqual({}, admission.destinations)
+
+    def test_cancelled(self):
+        admission = Admission(total=1)
+        run = self.loop.run_until_complete
+        self.assertTrue(run(admission.acquire('t', 'a')))
+        waiting = self.run_soon(admission.acquire('t', 'b'))
+        waiting.cancel()
+        admission.release('t', 'a')
+        with self.assertRaises(asyncio.CancelledError):
+            run(waiting)
+        self.assertEqual(0, admission.active)
+        self.assertEqual(0, len(admission.waiters))
+
+    def test_cancelled_admitted(self):
+        admission = Admission(total=1)
+        run = self.loop.run_until_complete
+        self.assertTrue(run(admission.acquire('t', 'a')))
+        waiting = self.run_soon(admission.acquire('t', 'b'))
+        # admitted, then cancelled before it runs
+        admission.release('t', 'a')
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            run(waiting)
+        self.assertEqual(0, admission.active)
+        self.assertEqual({}, admission.tunnels)
+        self.assertTrue(run(admission.acquire('t', 'c')))
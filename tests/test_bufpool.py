@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+from unittest import TestCase
+from fsocks.bufpool import BufferPool
+
+
+class TestBufferPool(TestCase):
+    def test_basic(self):
+        pool = BufferPool((1024, 4096), max_free=1)
+        self.assertEqual(1024, pool.size_class(1))
+        self.assertEqual(4096, pool.size_class(1025))
+        self.assertEqual(4096, pool.size_class(10000))
+        buf = pool.acquire(2000)
+        self.assertEqual(4096, len(buf))
+        self.assertEqual(0, len(pool))
+        pool.release(buf)
+        self.assertEqual(1, len(pool))
+        self.assertIs(buf, pool.acquire(3000))
+        self.assertEqual(0, len(pool))
+
+    def test_corner(self):
+        pool = BufferPool((1024,), max_free=1)
+        pool.release(bytearray(1024))
+        pool.release(bytearray(1024))
+        # beyond max_free, or not of a class
+        pool.release(bytearray(100))
+        self.assertEqual(1, len(pool))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import errno
+import socket
+import asyncio
+from unittest import TestCase
+from fsocks.socks import REP
+from fsocks.destinations import Destinations, error_code
+
+
+class TestDestinations(TestCase):
+    def setUp(self):
+        self.dests = Destinations(min_timeout=2, max_timeout=10,
+                                  failures=3, ttl=5, max_ttl=12)
+        self.key = ('example.com', 443)
+
+    def test_timeout(self):
+        self.assertEqual(10, self.dests.timeout(self.key))
+        for _ in range(20):
+            self.dests.succeeded(self.key, 0.1)
+        # floor above SYN retransmission
+        self.assertEqual(2, self.dests.timeout(self.key))
+        for _ in range(30):
+            self.dests.succeeded(self.key, 3.0)
+        self.assertAlmostEqual(3.0, self.dests.table[self.key].srtt,
+                               delta=0.1)
+        timeout = self.dests.timeout(self.key)
+        self.assertTrue(2 < timeout < 10)
+        self.dests.failed(self.key, REP.HOST_UNREACHABLE, 0, timed_out=True)
+        self.assertEqual(min(10, timeout * 2), self.dests.timeout(self.key))
+
+    def test_circuit(self):
+        for now in range(3):
+            self.assertIsNone(self.dests.check(self.key, now))
+            self.dests.failed(self.key, REP.CONNECTION_REFUSED, now)
+        self.assertEqual(REP.CONNECTION_REFUSED,
+                         self.dests.check(self.key, 3))
+        self.assertEqual(1, self.dests.open_circuits(3))
+        # half open after ttl, one trial at a time
+        self.assertIsNone(self.dests.check(self.key, 7))
+        self.assertIsNotNone(self.dests.check(self.key, 7.5))
+        self.dests.failed(self.key, REP.CONNECTION_REFUSED, 8)
+        # twice as long
+        self.assertIsNotNone(self.dests.check(self.key, 17))
+        self.assertIsNone(self.dests.check(self.key, 18))
+        self.dests.succeeded(self.key, 0.1)
+        self.assertIsNone(self.dests.check(self.key, 18.5))
+        self.assertEqual(0, self.dests.open_circuits(18.5))
+
+    def test_maxsize(self):
+        self.dests.maxsize = 2
+        for port in range(3):
+            self.dests.succeeded(('example.com', port), 0.1)
+        self.assertEqual(2, len(self.dests))
+        self.assertNotIn(('example.com', 0), self.dests.table)
+
+    def test_error_code(self):
+        self.assertEqual(REP.CONNECTION_REFUSED,
+                         error_code(ConnectionRefusedError()))
+        self.assertEqual(REP.HOST_UNREACHABLE,
+                         error_code(asyncio.TimeoutError()))
+        self.assertEqual(REP.HOST_UNREACHABLE,
+                         error_code(socket.gaierror(-2, 'not known')))
+        self.assertEqual(REP.NETWORK_UNREACHABLE,
+                         error_code(OSError(errno.ENETUNREACH, 'down')))
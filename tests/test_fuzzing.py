@@ -2,7 +2,7 @@
 import time
 import struct
 from unittest import TestCase
-from fsocks.fuzzing.base import FuzzError
+from fsocks.fuzzing.base import FuzzError, FuzzChain
 from fsocks.fuzzing.symmetric import XOR, RailFence
 from fsocks.fuzzing.codec import Base16, Base32, Base64, Base85,\
     AtBash, XXencode, UUencode
@@ -22,6 +22,15 @@ class TestCipher(TestCase):
         for s in src:
             e = cipher.encrypt(s)
             self.assertEqual(s, cipher.decrypt(e))
+            # same result written to a bigger buffer from a view
+            size = cipher.max_expansion(len(s))
+            self.assertLessEqual(len(e), size)
+            dst = bytearray(size + 3)
+            n = cipher.encrypt_into(memoryview(s), dst)
+            self.assertEqual(e, dst[:n])
+            out = bytearray(n)
+            n = cipher.decrypt_into(memoryview(dst)[:n], out)
+            self.assertEqual(s, out[:n])
 
     def _do_test_bench(self, cipher):
         text = b'HELLO' * 200
@@ -112,3 +121,30 @@ class TestXXEncode(TestCipher):
     def test_bench(self):
         self._do_test_bench(XXencode())
         self._do_test_bench(UUencode())
+
+
+class TestFuzzChain(TestCipher):
+    def get_chain(self):
+        return FuzzChain([XOR(b'\x26'), Base64(), RailFence(b'\x00\x03'),
+                          XXencode(), AtBash()])
+
+    def test_basic(self):
+        self._do_test_cipher(self.get_chain())
+        self._do_test_cipher(FuzzChain([]))
+
+    def test_known(self):
+        chain = self.get_chain()
+        text = b'hello, world'
+        expected = text
+        for fuzz in chain.fuzz_list:
+            expected = fuzz.encrypt(expected)
+        self.assertEqual(expected, chain.encrypt(text))
+
+    def test_scratch(self):
+        chain = FuzzChain([XOR(b'\x26'), RailFence(b'\x00\x03')])
+        first = chain.encrypt(b'x' * 1000)
+        # results are not views of the reused scratch buffers
+        chain.encrypt(b'y' * 1000)
+        self.assertIsInstance(first, bytes)
+        self.assertEqual(b'x' * 1000, chain.decrypt(first))
+        self.assertEqual(1000, len(chain.scratch[0]))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import os
+import time
+import atexit
+import logging
+import tempfile
+from unittest import TestCase
+from fsocks import log
+from fsocks.log import logger, RateLimitFilter
+
+
+class TestRateLimit(TestCase):
+    def _record(self, msg, level=logging.WARNING, args=()):
+        return logging.LogRecord('t', level, __file__, 1, msg, args, None)
+
+    def test_basic(self):
+        f = RateLimitFilter(0.05)
+        self.assertTrue(f.filter(self._record('channel is not ready')))
+        self.assertFalse(f.filter(self._record('channel is not ready')))
+        self.assertFalse(f.filter(self._record('channel is not ready')))
+        self.assertTrue(f.filter(self._record('another message')))
+        self.assertTrue(f.filter(self._record('x', logging.DEBUG)))
+        self.assertTrue(f.filter(self._record('x', logging.DEBUG)))
+        time.sleep(0.06)
+        record = self._record('channel is not ready')
+        self.assertTrue(f.filter(record))
+        self.assertEqual('channel is not ready (2 suppressed)', record.msg)
+
+    def test_arguments(self):
+        f = RateLimitFilter(10)
+        msg = 'connect %s:%d failed'
+        self.assertTrue(f.filter(self._record(msg, args=('a.com', 80))))
+        self.assertTrue(f.filter(self._record(msg, args=('b.com', 80))))
+        self.assertFalse(f.filter(self._record(msg, args=('a.com', 80))))
+        # errors are never dropped
+        for _ in range(3):
+            self.assertTrue(f.filter(self._record('fatal', logging.ERROR)))
+
+    def test_forget(self):
+        f = RateLimitFilter(0.01)
+        f.maxsize = 2
+        f.filter(self._record('a'))
+        f.filter(self._record('b'))
+        time.sleep(0.02)
+        f.filter(self._record('c'))
+        self.assertEqual([(logging.WARNING, 'c')], list(f.records))
+
+
+class TestSetup(TestCase):
+    def tearDown(self):
+        log.setup(logging.DEBUG, async_=False)
+
+    def test_async_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        log.setup(logging.INFO, path, async_=True, ratelimit=10)
+        logger.debug('dropped %s', 'debug')
+        logger.info('hello %s', 'world')
+        logger.warning('limited')
+        logger.warning('limited')
+        log.shutdown()
+        with open(path) as f:
+            content = f.read()
+        os.remove(path)
+        self.assertNotIn('dropped', content)
+        self.assertIn('hello world', content)
+        self.assertEqual(1, content.count('limited'))
+
+    def test_atexit_once(self):
+        registered = []
+        register = atexit.register
+        atexit.register = registered.append
+        log._exit_registered = False
+        try:
+            for _ in range(3):
+                log.setup(logging.INFO, async_=True)
+        finally:
+            atexit.register = register
+        self.assertEqual([log.shutdown], registered)
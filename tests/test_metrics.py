@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import os
+import asyncio
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+from fsocks import metrics
+from fsocks.metrics import Registry, MetricsServer, LoopLagMonitor
+
+
+class TestRegistry(TestCase):
+    def test_basic(self):
+        r = Registry()
+        c = r.counter('x_total', 'some counter', direction='tx')
+        self.assertIs(c, r.counter('x_total', 'some counter', direction='tx'))
+        c.inc()
+        c.value += 2
+        g = r.gauge('y', 'some gauge')
+        g.inc()
+        g.dec(3)
+        r.gauge('z', 'callback gauge', func=lambda: 42)
+        text = r.render()
+        self.assertIn('# TYPE x_total counter', text)
+        self.assertIn('x_total{direction="tx"} 3', text)
+        self.assertIn('y -2', text)
+        self.assertIn('z 42', text)
+        r.remove('z')
+        self.assertNotIn('z 42', r.render())
+        self.assertRaises(ValueError, r.gauge, 'x_total', 'wrong kind')
+
+    def test_histogram(self):
+        r = Registry()
+        h = r.histogram('lat_seconds', 'latency', buckets=(0.1, 1))
+        for v in 0.05, 0.1, 0.5, 5:
+            h.observe(v)
+        text = r.render()
+        self.assertIn('lat_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('lat_seconds_bucket{le="1"} 3', text)
+        self.assertIn('lat_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn('lat_seconds_count 4', text)
+        self.assertIn('lat_seconds_sum 5.65', text)
+
+
+class TestEndpoint(TestCase):
+    def test_scrape(self):
+        loop = asyncio.new_event_loop()
+        r = Registry()
+        r.counter('scraped_total', 'test').inc()
+        server = MetricsServer(r)
+
+        async def scrape():
+            srv = await server.start('127.0.0.1', 0)
+            port = srv.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+            data = await reader.read()
+            writer.close()
+            server.close()
+            return data
+
+        monitor = LoopLagMonitor(loop, 0.001, r.histogram('lag', 'lag'))
+        monitor.start()
+        data = loop.run_until_complete(scrape())
+        loop.run_until_complete(asyncio.sleep(0.01))
+        monitor.stop()
+        loop.close()
+        self.assertTrue(data.startswith(b'HTTP/1.0 200 OK'))
+        self.assertIn(b'scraped_total 1', data)
+        self.assertLess(0, r.histogram('lag', 'lag').count)
+
+    def test_start(self):
+        loop = asyncio.new_event_loop()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = SimpleNamespace(
+                metrics_host=None, metrics_port=0,
+                metrics_path=os.path.join(tmpdir, 'metrics.sock'))
+            server = metrics.start(loop, config)
+            monitor = server.monitor
+            self.assertIsNotNone(monitor.handle)
+            server.close()
+            self.assertIsNone(monitor.handle)
+            self.assertIsNone(server.monitor)
+        loop.close()
+        config.metrics_path = None
+        self.assertIsNone(metrics.start(loop, config))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import os
+import socket
+import struct
+import asyncio
+import threading
+from unittest import TestCase
+from fsocks.net import ReadSizer, SockStream, NetworkError, pipe
+from fsocks.fuzzing import FuzzChain, XOR, Base16
+from fsocks.cryption import AES256CBC
+
+
+class TestReadSizer(TestCase):
+    def test_grow(self):
+        sizer = ReadSizer(2048, 16384)
+        self.assertEqual(2048, sizer.size)
+        for size in 4096, 8192, 16384, 16384:
+            self.assertEqual(size, sizer.update(sizer.size))
+
+    def test_shrink(self):
+        sizer = ReadSizer(2048, 16384)
+        for _ in range(3):
+            sizer.update(sizer.size)
+        self.assertEqual(16384, sizer.size)
+        # one small read is not enough
+        self.assertEqual(16384, sizer.update(100))
+        self.assertEqual(8192, sizer.update(100))
+        # a medium read resets the streak
+        sizer.update(100)
+        sizer.update(5000)
+        self.assertEqual(8192, sizer.update(100))
+        for _ in range(10):
+            sizer.update(1)
+        self.assertEqual(2048, sizer.size)
+
+
+class TestSockStream(TestCase):
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.a, self.b = SockStream(a), SockStream(b)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_sync(self):
+        data = os.urandom(1 << 20)
+        writer = threading.Thread(target=self.a.write_all, args=(data,))
+        writer.start()
+        self.assertEqual(data, self.b.read(len(data)))
+        writer.join()
+        self.a.write(b'abc', insist=False)
+        self.assertEqual(b'abc', self.b.read(10, insist=False))
+        self.a.close()
+        self.assertRaises(NetworkError, self.b.read, 1)
+
+    def test_async(self):
+        loop = asyncio.new_event_loop()
+        a, b = SockStream(self.a.sock, loop), SockStream(self.b.sock, loop)
+        data = os.urandom(1 << 20)
+
+        async def run():
+            writer = asyncio.ensure_future(a.async_write(data))
+            got = await b.async_read(len(data))
+            await writer
+            await a.async_write(b'abc')
+            some = await b.async_read(10, insist=False)
+            return got, some
+        try:
+            got, some = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual(data, got)
+        self.assertEqual(b'abc', some)
+
+
+class TestPipe(TestCase):
+    def test_basic(self):
+        self.relay(FuzzChain([XOR()]))
+
+    def test_bytes_cipher(self):
+        self.relay(AES256CBC('password'))
+
+    def test_expanding(self):
+        # 16 KiB would encode to 64 KiB, over the 2 bytes length
+        self.relay(FuzzChain([Base16(), Base16()]))
+
+    def relay(self, cipher):
+        user, plain = socket.socketpair()
+        tunnel, fuzz = socket.socketpair()
+        # fail rather than hang if the relay dies
+        user.settimeout(5)
+        tunnel.settimeout(5)
+        user, tunnel = SockStream(user), SockStream(tunnel)
+        relay = threading.Thread(target=pipe, args=(
+            SockStream(plain), SockStream(fuzz), cipher))
+        relay.start()
+        try:
+            data = os.urandom(100000)
+            user.write_all(data)
+            got = b''
+            while len(got) < len(data):
+                elen, = struct.unpack('!H', tunnel.read(2))
+                got += cipher.decrypt(bytes(tunnel.read(elen)))
+            self.assertEqual(data, got)
+            edata = cipher.encrypt(b'pong')
+            tunnel.write_all(struct.pack('!H', len(edata)) + edata)
+            self.assertEqual(b'pong', user.read(4))
+        finally:
+            user.close()
+            relay.join(5)
+            tunnel.close()
+            plain.close()
+            fuzz.close()
+        self.assertFalse(relay.is_alive())
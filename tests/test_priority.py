@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+from unittest import TestCase
+from fsocks.protocol import PRIORITY
+from fsocks.priority import PriorityRules
+
+
+class TestPriorityRules(TestCase):
+    def test_basic(self):
+        rules = PriorityRules([
+            {'priority': 'high', 'port': 22},
+            {'priority': 'low', 'domain': 'backup.example.com'},
+            {'priority': 'low', 'network': '10.1.0.0/16', 'port': [873]},
+        ])
+        self.assertIs(PRIORITY.HIGH, rules.match('github.com', 22))
+        self.assertIs(PRIORITY.LOW, rules.match('backup.example.com', 443))
+        self.assertIs(PRIORITY.LOW, rules.match('s3.Backup.example.com', 80))
+        self.assertIs(PRIORITY.NORMAL, rules.match('xbackup.example.com', 80))
+        self.assertIs(PRIORITY.LOW, rules.match('10.1.2.3', 873))
+        self.assertIs(PRIORITY.NORMAL, rules.match('10.1.2.3', 80))
+        self.assertIs(PRIORITY.NORMAL, rules.match('10.2.2.3', 873))
+        self.assertIs(PRIORITY.NORMAL, rules.match('example.com', 873))
+        self.assertIs(PRIORITY.NORMAL, PriorityRules().match('a.com', 22))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, PriorityRules, [{'priority': 'urgent'}])
+        self.assertRaises(ValueError, PriorityRules,
+                          [{'priority': 'low', 'network': 'nonsense'}])
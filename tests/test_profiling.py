@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+import os
+import asyncio
+import tempfile
+from unittest import TestCase
+from fsocks.profiling import Profiler
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.outdir = tempfile.mkdtemp()
+        self.profiler = Profiler(self.loop, self.outdir, seconds=0.05)
+
+    def tearDown(self):
+        self.profiler.close()
+        self.loop.close()
+
+    def test_profile(self):
+        self.profiler.toggle_profile()
+        self.assertTrue(self.profiler.profiling)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertFalse(self.profiler.profiling)
+        # dumped by an executor thread
+        self.loop.run_until_complete(self.profiler.dump)
+        files = os.listdir(self.outdir)
+        self.assertEqual(2, len(files))
+        self.assertIsNone(self.profiler.stop_profile())
+
+    def test_snapshot(self):
+        self.assertIsNone(self.profiler.take_snapshot())
+        garbage = [bytearray(1024) for _ in range(100)]
+        path = self.loop.run_until_complete(self.profiler.take_snapshot())
+        self.assertTrue(os.path.exists(path))
+        with open(path + '.txt') as f:
+            self.assertIn('since previous snapshot', f.read())
+        del garbage
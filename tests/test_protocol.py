@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 import io
 import struct
+import asyncio
 from unittest import TestCase
-from fsocks import protocol, socks, fuzzing
+from fsocks import protocol, socks, fuzzing, cryption
+from fsocks.fuzzing import FuzzChain, XOR
 from fsocks.protocol import ProtocolError, Hello, HandShake,\
-    Request, Reply, Relaying, Close
+    Request, Reply, Relaying, Close, Flow, get_message
 
 
 class TestHello(TestCase):
@@ -77,6 +79,19 @@ class TestRequest(TestCase):
         m1 = Request.from_stream(io.BytesIO(m.to_bytes()))
         self.assertEqual(m.to_bytes(), m1.to_bytes())
 
+    def test_priority(self):
+        socks_msg = socks.Message(socks.VER.SOCKS5, socks.CMD.CONNECT,
+                                  socks.ATYPE.DOMAINNAME, ('example.com', 22))
+        m = Request(3, 4, socks_msg, protocol.PRIORITY.HIGH)
+        m1 = Request.from_stream(io.BytesIO(m.to_bytes()))
+        self.assertIs(protocol.PRIORITY.HIGH, m1.priority)
+        self.assertIs(protocol.PRIORITY.NORMAL,
+                      Request(3, 4, socks_msg).priority)
+        b = bytearray(m.to_bytes())
+        b[15] = 0x09
+        self.assertRaises(ProtocolError, Request.from_stream,
+                          io.BytesIO(bytes(b)))
+
 
 class TestReply(TestCase):
     def test_basic(self):
@@ -101,9 +116,149 @@ class TestRelaying(TestCase):
         msg1 = Relaying.from_stream(io.BytesIO(msg.to_bytes()))
         self.assertEqual(msg.to_bytes(), msg1.to_bytes())
 
+    def test_buffer(self):
+        payload = b'GET / HTTP/1.1\r\n\r\n'
+        start = Relaying.header.size
+        buf = bytearray(start) + payload + bytearray(10)
+        msg = Relaying(3, 5, memoryview(buf)[start:start + len(payload)],
+                       buf)
+        self.assertEqual(Relaying(3, 5, payload, nonce=msg.nonce).to_bytes(),
+                         bytes(msg.to_bytes()))
+
+    def test_frame(self):
+        fuzz = FuzzChain([fuzzing.Plain()])
+        payload = b'x' * 65536
+        msg = Relaying(3, 5, payload)
+        header, data = msg.to_frame(fuzz)
+        self.assertEqual(6, len(header))
+        self.assertEqual(msg.to_packet(fuzz), header + data)
+        # pooled payload is not copied to prepend the header
+        start = Relaying.header.size
+        buf = bytearray(start) + payload
+        msg = Relaying(3, 5, memoryview(buf)[start:], buf)
+        header, data = msg.to_frame(fuzz)
+        self.assertIs(buf, data.obj)
+
+    def test_slots(self):
+        # one is created per relayed chunk, keep it compact
+        msg = Relaying(3, 5, b'')
+        self.assertFalse(hasattr(msg, '__dict__'))
+        self.assertRaises(AttributeError, setattr, msg, 'foo', 1)
+
 
 class TestClose(TestCase):
     def test_basic(self):
         msg = Close(3)
         msg1 = Close.from_stream(io.BytesIO(msg.to_bytes()))
         self.assertEqual(msg.to_bytes(), msg1.to_bytes())
+
+
+class TestFlow(TestCase):
+    def test_basic(self):
+        for paused in True, False:
+            msg = Flow(3, 5, paused)
+            msg1 = get_message(msg.to_bytes())
+            self.assertIsInstance(msg1, Flow)
+            self.assertEqual((3, 5, paused),
+                             (msg1.src, msg1.dst, msg1.paused))
+
+
+class TestDatagram(TestCase):
+    def test_basic(self):
+        datagrams = [(('127.0.0.1', 53), b'\x12\x34query'),
+                     (('::1', 443), b''),
+                     (('example.com', 8080), b'x' * 1000)]
+        msg = protocol.Datagram(3, 5, datagrams)
+        self.assertEqual(1007, msg.size)
+        msg1 = protocol.Datagram.from_stream(io.BytesIO(msg.to_bytes()))
+        self.assertEqual(datagrams, msg1.datagrams)
+        self.assertEqual(msg.to_bytes(), msg1.to_bytes())
+        msg2 = protocol.get_message(msg.to_bytes())
+        self.assertEqual(datagrams, msg2.datagrams)
+
+    def test_corner(self):
+        msg = protocol.Datagram(3, 5, [(('127.0.0.1', 53), b'data')])
+        self.assertRaises(ProtocolError, protocol.Datagram.from_stream,
+                          io.BytesIO(msg.to_bytes()[:-1]))
+        b = bytearray(msg.to_bytes())
+        b[17] = 0x09  # ATYP
+        self.assertRaises(ProtocolError, protocol.Datagram.from_stream,
+                          io.BytesIO(bytes(b)))
+
+
+class TestFrameReader(TestCase):
+    def test_batch(self):
+        loop = asyncio.new_event_loop()
+        fuzz = FuzzChain([XOR()])
+        reader = asyncio.StreamReader(loop=loop)
+        frames = protocol.FrameReader(reader, protocol.Ciphers(None, fuzz))
+        messages = [Relaying(1, 2, b'x' * n) for n in (1, 1000, 5)]
+        data = b''.join(m.to_packet(fuzz) for m in messages)
+        # last frame incomplete
+        reader.feed_data(data[:-3])
+        try:
+            packets = loop.run_until_complete(frames.read_packets())
+            self.assertEqual([m.payload for m in messages[:2]],
+                             [p.payload for p in packets])
+            reader.feed_data(data[-3:])
+            packets = loop.run_until_complete(frames.read_packets())
+            self.assertEqual(b'x' * 5, packets[0].payload)
+            reader.feed_eof()
+            self.assertRaises(asyncio.IncompleteReadError,
+                              loop.run_until_complete, frames.read_packets())
+        finally:
+            loop.close()
+
+
+class TestCiphers(TestCase):
+    def transfer(self, frame, ciphers):
+        header, data = frame
+        etype, elen = struct.unpack('!HI', header)
+        self.assertEqual(len(data), elen)
+        return ciphers.decode(etype, data)
+
+    def test_renegotiate(self):
+        aes = cryption.AES256CBC('password')
+        offer = [XOR(b'\x26'), fuzzing.Base64()]
+        server = protocol.Ciphers(aes, FuzzChain(offer))
+        client = protocol.Ciphers(aes, FuzzChain(offer))
+        # sent by client before it knows of the new epoch
+        in_flight = client.encode(Relaying(1, 2, b'old'))
+        shake = server.encode(server.start(FuzzChain(offer[:1])))
+        after = server.encode(Relaying(2, 1, b'new'))
+        self.assertTrue(server.switching)
+        # client side
+        packet = self.transfer(shake, client)
+        self.assertEqual(1, packet.epoch)
+        ack = client.received(packet)
+        self.assertEqual(b'new', self.transfer(after, client).payload)
+        ack = client.encode(ack)
+        self.assertFalse(client.switching)
+        reply = client.encode(Relaying(1, 2, b'reply'))
+        # server side
+        self.assertEqual(b'old', self.transfer(in_flight, server).payload)
+        self.assertIsNone(server.received(self.transfer(ack, server)))
+        self.assertFalse(server.switching)
+        self.assertEqual(b'reply', self.transfer(reply, server).payload)
+        self.assertEqual(1 << 8 | 1, struct.unpack('!H', reply[0][:2])[0])
+        # frames of retired epoch are refused
+        self.assertRaises(ProtocolError, self.transfer, in_flight, server)
+
+    def test_frame_reader(self):
+        loop = asyncio.new_event_loop()
+        aes = cryption.AES256CBC('password')
+        server = protocol.Ciphers(aes, FuzzChain([fuzzing.Base64()]))
+        client = protocol.Ciphers(aes, FuzzChain([fuzzing.Base64()]))
+        frames = [server.encode(server.start(FuzzChain([XOR(b'\x26')]))),
+                  server.encode(Relaying(2, 1, b'new'))]
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(b''.join(h + d for h, d in frames))
+        frames = protocol.FrameReader(reader, client)
+        try:
+            # batch stops at the HANDSHAKE, its fuzz decodes the next one
+            shake, = loop.run_until_complete(frames.read_packets())
+            client.received(shake)
+            relay, = loop.run_until_complete(frames.read_packets())
+            self.assertEqual(b'new', relay.payload)
+        finally:
+            loop.close()
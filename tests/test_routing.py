@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+from unittest import TestCase
+from fsocks.routing import Router, ROUTE
+
+
+class TestRouter(TestCase):
+    def test_networks(self):
+        router = Router([
+            {'route': 'direct', 'network': '10.0.0.0/8'},
+            {'route': 'tunnel', 'network': '10.1.2.0/24'},
+            {'route': 'direct', 'network': '10.1.2.3'},
+            {'route': 'direct', 'network': 'fd00::/8'},
+        ])
+        self.assertIs(ROUTE.DIRECT, router.route('10.2.3.4'))
+        self.assertIs(ROUTE.TUNNEL, router.route('10.1.2.4'))
+        self.assertIs(ROUTE.DIRECT, router.route('10.1.2.3'))
+        self.assertIs(ROUTE.TUNNEL, router.route('11.0.0.1'))
+        self.assertIs(ROUTE.DIRECT, router.route('fd12::1'))
+        self.assertIs(ROUTE.TUNNEL, router.route('fe80::1'))
+        # host bits are ignored
+        router.add(ROUTE.DIRECT, '11.0.0.1/16')
+        self.assertIs(ROUTE.DIRECT, router.route('11.0.255.255'))
+
+    def test_domains(self):
+        router = Router([
+            {'route': 'direct', 'domain': 'example.cn'},
+            {'route': 'tunnel', 'domain': 'blocked.example.cn'},
+        ], default='direct')
+        self.assertIs(ROUTE.DIRECT, router.route('example.cn'))
+        self.assertIs(ROUTE.DIRECT, router.route('www.Example.cn.'))
+        self.assertIs(ROUTE.TUNNEL, router.route('blocked.example.cn'))
+        self.assertIs(ROUTE.TUNNEL, router.route('a.blocked.example.cn'))
+        self.assertIs(ROUTE.DIRECT, router.route('xblocked.example.cn'))
+        # no domain rule matches an IP
+        router.add(ROUTE.TUNNEL, '1.2.3.4.example.cn')
+        self.assertIs(ROUTE.DIRECT, router.route('1.2.3.4'))
+
+    def test_cache(self):
+        router = Router([{'route': 'direct', 'domain': 'example.cn'}],
+                        maxsize=2)
+        for host in ('a.example.cn', 'b.example.cn', 'example.com'):
+            router.route(host)
+        self.assertEqual(['b.example.cn', 'example.com'], list(router.cache))
+        # rules added after decisions are taken into account
+        router.add(ROUTE.DIRECT, 'example.com')
+        self.assertIs(ROUTE.DIRECT, router.route('example.com'))
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'direct.txt')
+            with open(path, 'w') as f:
+                f.write('# LAN\n192.168.0.0/16\n\n'
+                        '*.example.cn  # and subdomains\n.example.jp\n')
+            router = Router([{'route': 'direct', 'file': path}])
+        self.assertEqual(3, len(router))
+        self.assertIs(ROUTE.DIRECT, router.route('192.168.1.1'))
+        self.assertIs(ROUTE.DIRECT, router.route('www.example.cn'))
+        self.assertIs(ROUTE.DIRECT, router.route('example.jp'))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Router, default='nowhere')
+        self.assertRaises(ValueError, Router,
+                          [{'route': 'direct', 'network': 'example.cn'}])
+        self.assertRaises(ValueError, Router,
+                          [{'route': 'direct', 'network': '10.0.0.0/33'}])
+        self.assertRaises(ValueError, Router().add, ROUTE.DIRECT, '10.0.0/8')
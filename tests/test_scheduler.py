@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import asyncio
+from unittest import TestCase
+from fsocks.protocol import Relaying, Close, PRIORITY
+from fsocks.scheduler import EgressScheduler
+from tests.helpers import FakeTransport
+
+
+class TestScheduler(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.transport = FakeTransport()
+        self.scheduler = EgressScheduler(self.transport, lambda m: (m,),
+                                         quantum=500, channel_limit=5000)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_once(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_round_robin(self):
+        bulk = [Relaying(1, 2, b'x' * 900) for _ in range(4)]
+        for m in bulk:
+            self.scheduler.push(1, m)
+        small = Relaying(3, 4, b'ls\n')
+        self.scheduler.push(3, small)
+        self.scheduler.push(None, Close(0))
+        self.run_once()
+        written = self.transport.written
+        self.assertEqual(6, len(written))
+        self.assertIsInstance(written[0], Close)
+        # interactive frame is not queued behind the bulk ones
+        self.assertIs(small, written[2])
+        self.assertEqual(bulk, [m for m in written if m.src == 1])
+        self.assertEqual({}, self.scheduler.queues)
+
+    def test_priority(self):
+        # cost of each frame is exactly 500 bytes
+        for _ in range(2):
+            self.scheduler.push(1, Relaying(1, 2, b'x' * 468),
+                                priority=PRIORITY.LOW)
+        for _ in range(8):
+            self.scheduler.push(3, Relaying(3, 4, b'y' * 468),
+                                priority=PRIORITY.HIGH)
+        self.run_once()
+        order = [m.src for m in self.transport.written]
+        # high class first with 4 times the share of low class
+        self.assertEqual([3, 3, 3, 3, 1] * 2, order)
+
+    def test_backpressure(self):
+        self.scheduler.pause()
+        source = FakeTransport()
+        for _ in range(6):
+            self.scheduler.push(1, Relaying(1, 2, b'x' * 1000), source)
+        self.run_once()
+        self.assertEqual([], self.transport.written)
+        self.assertFalse(source.reading)
+        self.assertLess(5000, self.scheduler.pending(1))
+        self.scheduler.resume()
+        self.run_once()
+        self.assertEqual(6, len(self.transport.written))
+        self.assertTrue(source.reading)
+        self.assertEqual(0, self.scheduler.pending(1))
+
+    def test_transport_full(self):
+        self.transport.buffered = 1 << 20
+        for _ in range(3):
+            self.scheduler.push(1, Relaying(1, 2, b'x' * 100))
+        self.run_once()
+        # stop after first round once the transport buffer is full
+        self.assertTrue(self.scheduler.paused)
+        self.assertEqual(3, len(self.transport.written))
+        self.scheduler.push(1, Relaying(1, 2, b'x'))
+        self.run_once()
+        self.assertEqual(3, len(self.transport.written))
+        self.scheduler.close()
+        self.scheduler.push(1, Relaying(1, 2, b'x'))
+        self.assertEqual({}, self.scheduler.queues)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+from unittest import TestCase
+from fsocks import metrics
+from fsocks.servers import Servers, parse_servers
+
+
+class TestServers(TestCase):
+    def test_parse(self):
+        self.assertEqual([('a.example.com', 1081), ('::1', 1082),
+                          ('10.0.0.1', 1083)],
+                         parse_servers(['a.example.com:1081', '[::1]:1082',
+                                        {'host': '10.0.0.1', 'port': 1083}],
+                                       ('0.0.0.0', 1)))
+        self.assertEqual([('0.0.0.0', 1)], parse_servers([], ('0.0.0.0', 1)))
+        self.assertRaises(ValueError, parse_servers, ['example.com'], None)
+
+    def test_best(self):
+        servers = Servers([('a', 1), ('b', 2), ('c', 3)], failures=2)
+        a, b, c = servers
+        self.assertIsNone(servers.best())
+        for server in servers:
+            server.tunnel = object()
+        servers.succeeded(a, 0.3)
+        servers.succeeded(b, 0.1)
+        # measured before unmeasured
+        self.assertIs(b, servers.best())
+        # smoothed: one slow probe doesn't move channels away
+        servers.succeeded(b, 0.5)
+        self.assertIs(b, servers.best())
+        for _ in range(10):
+            servers.succeeded(b, 0.5)
+        self.assertIs(a, servers.best())
+        # failover
+        servers.failed(a)
+        self.assertIs(a, servers.best())
+        servers.failed(a)
+        self.assertIs(b, servers.best())
+        b.tunnel = None
+        self.assertIs(c, servers.best())
+        c.tunnel = None
+        # down, but the last one left
+        self.assertIs(a, servers.best())
+        servers.succeeded(a, 0.3)
+        self.assertTrue(servers.usable(a))
+        up = metrics.registry.gauge('fsocks_server_up', '', server='a:1')
+        self.assertEqual([('fsocks_server_up', {'server': 'a:1'}, 1)],
+                         list(up.samples('fsocks_server_up')))
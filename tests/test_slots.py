@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+from unittest import TestCase
+from fsocks.slots import SlotTable, SlotError, INDEX_MASK
+
+
+class TestSlotTable(TestCase):
+    def test_basic(self):
+        t = SlotTable()
+        a, b = t.add('a'), t.add('b')
+        self.assertNotEqual(0, a)
+        self.assertEqual(2, len(t))
+        self.assertEqual('a', t.get(a))
+        self.assertIn(b, t)
+        self.assertEqual(['a', 'b'], t.values())
+        self.assertEqual('a', t.remove(a))
+        self.assertIsNone(t.remove(a))
+        self.assertIsNone(t.get(a))
+        self.assertEqual(1, len(t))
+        self.assertIsNone(t.get(12345))
+
+    def test_reuse(self):
+        t = SlotTable()
+        old = t.add('old')
+        t.remove(old)
+        new = t.add('new')
+        # same slot, different generation
+        self.assertEqual(old & INDEX_MASK, new & INDEX_MASK)
+        self.assertNotEqual(old, new)
+        self.assertIsNone(t.get(old))
+        self.assertEqual('new', t.get(new))
+        for _ in range(10000):
+            t.remove(new)
+            new = t.add('new')
+            self.assertNotEqual(0, new)
+            self.assertLess(new, 1 << 32)
+
+    def test_capacity(self):
+        t = SlotTable(2)
+        t.add(1)
+        t.add(2)
+        self.assertRaises(SlotError, t.add, 3)
@@ -3,7 +3,8 @@ import io
 import struct
 from unittest import TestCase
 from fsocks import socks
-from fsocks.socks import Message, ClientGreeting, ServerGreeting, SocksError
+from fsocks.socks import Message, ClientGreeting, ServerGreeting, SocksError,\
+    UdpDatagram, HandshakeParser
 
 
 class TestMessage(TestCase):
@@ -57,3 +58,68 @@ class TestGreeting(TestCase):
         for m in sg, sg1:
             self.assertEqual('<SOCKS5 USERNAME_PASSWORD>', str(m))
             self.assertEqual(b'\x05\x02', m.to_bytes())
+
+
+class TestUdpDatagram(TestCase):
+    def test_basic(self):
+        d = UdpDatagram(('127.0.0.1', 53), b'query')
+        self.assertEqual(b'\x00\x00\x00\x01\x7f\x00\x00\x01\x00\x35query',
+                         d.to_bytes())
+        for addr in ('127.0.0.1', 53), ('::1', 53), ('example.com', 53):
+            d1 = UdpDatagram.from_bytes(UdpDatagram(addr, b'q').to_bytes())
+            self.assertEqual(addr, d1.addr)
+            self.assertEqual(b'q', d1.data)
+            self.assertEqual(0, d1.frag)
+
+    def test_corner(self):
+        self.assertRaises(SocksError, UdpDatagram.from_bytes, b'\x00\x00')
+        self.assertRaises(SocksError, UdpDatagram.from_bytes,
+                          b'\x00\x00\x00\x09\x00\x00')
+        d = UdpDatagram.from_bytes(b'\x00\x00\x01\x01\x7f\x00\x00\x01\x00\x35')
+        self.assertEqual(1, d.frag)
+        self.assertEqual(b'', d.data)
+
+
+class TestHandshakeParser(TestCase):
+    greeting = b'\x05\x02\x00\x02'
+    request = Message(socks.VER.SOCKS5, socks.CMD.CONNECT,
+                      socks.ATYPE.DOMAINNAME, ('example.com', 443)).to_bytes()
+
+    def test_pipelined(self):
+        parser = HandshakeParser()
+        self.assertTrue(parser.feed(self.greeting + self.request + b'GET'))
+        self.assertTrue(parser.no_auth)
+        self.assertEqual(('example.com', 443), parser.request.addr)
+        self.assertIs(socks.CMD.CONNECT, parser.request.code)
+        self.assertEqual(b'GET', parser.buffer)
+
+    def test_segmented(self):
+        parser = HandshakeParser()
+        data = self.greeting + self.request
+        for i, b in enumerate(data[:-1]):
+            self.assertFalse(parser.feed(data[i:i + 1]))
+            self.assertEqual(i >= 3, parser.greeting_done)
+        self.assertTrue(parser.feed(data[-1:]))
+        self.assertEqual(('example.com', 443), parser.request.addr)
+        self.assertEqual(b'', parser.buffer)
+        for addr in ('127.0.0.1', 80), ('::1', 80):
+            parser = HandshakeParser()
+            parser.feed(b'\x05\x01\x00')
+            self.assertTrue(parser.feed(Message(
+                socks.VER.SOCKS5, socks.CMD.UDP, socks.atype_of(addr[0]),
+                addr).to_bytes()))
+            self.assertEqual(addr, parser.request.addr)
+
+    def test_corner(self):
+        parser = HandshakeParser()
+        self.assertRaises(SocksError, parser.feed, b'\x04\x01')
+        parser = HandshakeParser()
+        parser.feed(b'\x05\x01\x02')
+        self.assertFalse(parser.no_auth)
+        with self.assertRaises(SocksError) as cm:
+            parser.feed(b'\x05\x09\x00\x01\x7f\x00\x00\x01\x00\x50')
+        self.assertIs(socks.REP.COMMAND_NOT_SUPPORTED, cm.exception.code)
+        parser = HandshakeParser()
+        with self.assertRaises(SocksError) as cm:
+            parser.feed(b'\x05\x01\x00\x05\x01\x00\x02\x7f')
+        self.assertIs(socks.REP.ADDRESS_TYPE_NOT_SUPPORTED, cm.exception.code)
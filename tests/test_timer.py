@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import asyncio
+from unittest import TestCase
+from fsocks.timer import TimerWheel, get_wheel
+
+
+class TestTimerWheel(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.wheel = TimerWheel(self.loop, tick=0.01, size=8)
+
+    def tearDown(self):
+        self.wheel.close()
+        self.loop.close()
+
+    def test_basic(self):
+        fired = []
+        self.wheel.schedule(0.01, fired.append, 'a')
+        self.wheel.schedule(0.05, fired.append, 'b')
+        # more than one round
+        self.wheel.schedule(0.15, fired.append, 'c')
+        cancelled = self.wheel.schedule(0.02, fired.append, 'x')
+        self.wheel.cancel(cancelled)
+        self.wheel.cancel(cancelled)
+        self.assertTrue(cancelled.cancelled)
+        self.assertEqual(3, len(self.wheel))
+        self.loop.run_until_complete(asyncio.sleep(0.03))
+        self.assertEqual(['a'], fired)
+        self.loop.run_until_complete(asyncio.sleep(0.25))
+        self.assertEqual(['a', 'b', 'c'], fired)
+        self.assertEqual(0, len(self.wheel))
+        self.assertIsNone(self.wheel.handle)
+
+    def test_reschedule(self):
+        fired = []
+
+        def again(n):
+            fired.append(n)
+            if n < 3:
+                self.wheel.schedule(0.01, again, n + 1)
+        self.wheel.schedule(0.01, again, 1)
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertEqual([1, 2, 3], fired)
+
+    def test_shared(self):
+        self.assertIs(get_wheel(self.loop), get_wheel(self.loop))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+import socket
+import struct
+import asyncio
+from unittest import TestCase
+from fsocks import socks, timer, protocol, config
+from fsocks.routing import Router
+from fsocks.servers import Servers
+from fsocks.tunnel_server import TunnelServer
+from fsocks.tunnel_client import TunnelClient, UserProtocol, User
+from tests.helpers import FakeTransport, FakeWheel
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.pushed = []
+
+    def push(self, cid, message, source=None, priority=None):
+        self.pushed.append((cid, message))
+
+
+class FakeTunnel:
+    def __init__(self):
+        self.scheduler = FakeScheduler()
+
+
+class FakeClient:
+    def __init__(self):
+        self.users = {}
+        self.requests = []
+        self.relayed = []
+
+    def _add_user(self, user):
+        user.user_id = len(self.users) + 1
+        self.users[user.user_id] = user
+        return True
+
+    def _get_user(self, user_id):
+        return self.users.get(user_id)
+
+    async def _request(self, user, msg):
+        self.requests.append(msg)
+        return True
+
+    def _relay(self, user, data):
+        self.relayed.append(data)
+
+    def _user_closed(self, user):
+        del self.users[user.user_id]
+
+
+class TestUserProtocol(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = FakeClient()
+        self.transport = FakeTransport()
+        self.protocol = UserProtocol(self.client)
+        self.protocol.connection_made(self.transport)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_pipelined(self):
+        request = b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + \
+            struct.pack('!H', 80)
+        data = b'\x05\x01\x00' + request + b'GET /'
+        for c in data:
+            self.protocol.data_received(bytes([c]))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(socks.NO_AUTH_GREETING, self.transport.data)
+        self.assertEqual(('127.0.0.1', 80), self.client.requests[0].addr)
+        # early data held until REPLY
+        self.protocol.data_received(b' HTTP/1.1')
+        self.assertEqual([], self.client.relayed)
+        self.protocol.user.ready.set_result(True)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.protocol.data_received(b'\r\n')
+        self.assertEqual([b'GET / HTTP/1.1', b'\r\n'], self.client.relayed)
+        self.protocol.eof_received()
+        self.assertEqual({}, self.client.users)
+
+    def test_no_acceptable(self):
+        self.protocol.client._delete_user = lambda user, abort: user.close()
+        self.protocol.data_received(b'\x05\x01\x02')
+        self.assertEqual(socks.NO_ACCEPTABLE_GREETING, self.transport.data)
+        self.assertTrue(self.transport.closing)
+
+
+class TestFlow(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = TunnelClient()
+        self.tunnel = FakeTunnel()
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def user(self, user_id):
+        proto = UserProtocol(self.client)
+        proto.user = user = User(FakeTransport())
+        user.user_id = user_id
+        user.remote_id = user_id + 100
+        user.tunnel = self.tunnel
+        return proto
+
+    def test_per_channel(self):
+        slow, other = self.user(1), self.user(2)
+        slow.pause_writing()
+        slow.pause_writing()
+        # only the slow channel is paused, ahead of its queued frames
+        (cid, flow), = self.tunnel.scheduler.pushed
+        self.assertIsNone(cid)
+        self.assertIs(protocol.MTYPE.FLOW, flow.mtype)
+        self.assertEqual((1, 101, True), (flow.src, flow.dst, flow.paused))
+        other.resume_writing()
+        self.assertEqual(1, len(self.tunnel.scheduler.pushed))
+        slow.resume_writing()
+        cid, flow = self.tunnel.scheduler.pushed[-1]
+        self.assertEqual((1, 101, False), (flow.src, flow.dst, flow.paused))
+
+
+class TestChannels(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = TunnelClient()
+        self.client.wheel = FakeWheel()
+        self.tunnel = FakeTunnel()
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def user(self, remote_id=None):
+        user = User(FakeTransport())
+        self.client._add_user(user)
+        user.tunnel = self.tunnel
+        user.remote_id = remote_id
+        return user
+
+    def handle(self, packet):
+        self.loop.run_until_complete(
+            self.client._handle_packet(self.tunnel, packet))
+
+    def test_unknown(self):
+        user = self.user(5)
+        other = FakeTunnel()
+        user.tunnel = other
+        ok = socks.Message(socks.VER.SOCKS5, socks.REP.SUCCEEDED,
+                           socks.ATYPE.IPV4, ('127.0.0.1', 80))
+        self.handle(protocol.Relaying(5, 9, b'x'))
+        self.handle(protocol.Datagram(5, 10, []))
+        self.handle(protocol.Reply(5, 11, ok))
+        # user is known, but its channel goes through another tunnel
+        self.handle(protocol.Relaying(5, user.user_id, b'x'))
+        # failed REPLY has no channel to close
+        self.handle(protocol.Reply(0, 12, ok))
+        # CLOSE of unknown users is ignored
+        self.handle(protocol.Close(13))
+        pushed = self.tunnel.scheduler.pushed
+        self.assertEqual([9, 10, 11, user.user_id], [m.src for _, m in pushed])
+        self.assertEqual({protocol.MTYPE.CLOSE},
+                         {m.mtype for _, m in pushed})
+        self.assertEqual([], other.scheduler.pushed)
+        self.assertFalse(user.transport.written)
+
+    def test_half_open(self):
+        user = self.user()
+        self.client._check_user(user)
+        self.assertIsNone(self.client._get_user(user.user_id))
+        self.assertTrue(user.transport.closing)
+        self.assertFalse(self.loop.run_until_complete(user.ready))
+        # never got a remote, nothing to close on the server
+        self.assertEqual([], self.tunnel.scheduler.pushed)
+
+    def test_idle(self):
+        wheel = self.client.wheel
+        user = self.user(7)
+        user.timer = wheel.schedule(config.idle_timeout,
+                                    self.client._check_user, user)
+        wheel.advance(config.idle_timeout - 1)
+        user.last_active = wheel.now
+        wheel.advance(1)
+        # active meanwhile, rescheduled for the time left
+        self.assertIs(user, self.client._get_user(user.user_id))
+        self.assertEqual(1, len(wheel))
+        wheel.advance(config.idle_timeout - 1)
+        self.assertIsNone(self.client._get_user(user.user_id))
+        self.assertTrue(user.transport.closing)
+        self.assertEqual(0, len(wheel))
+        (cid, close), = self.tunnel.scheduler.pushed
+        self.assertIs(protocol.MTYPE.CLOSE, close.mtype)
+        self.assertEqual(user.user_id, close.src)
+
+
+class TestDirect(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    async def relay(self):
+        async def echo(reader, writer):
+            writer.write(await reader.read(100))
+            writer.close()
+        dest = await asyncio.start_server(echo, '127.0.0.1', 0)
+        dest_port = dest.sockets[0].getsockname()[1]
+        client = TunnelClient()
+        client.router = Router([{'route': 'direct',
+                                 'network': '127.0.0.0/8'}])
+        client.wheel = timer.get_wheel(self.loop)
+        # no tunnel: its scheduler would be needed otherwise
+        server = await self.loop.create_server(
+            lambda: UserProtocol(client), '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection(
+            *server.sockets[0].getsockname())
+        writer.write(b'\x05\x01\x00\x05\x01\x00\x01' +
+                     socket.inet_aton('127.0.0.1') +
+                     struct.pack('!H', dest_port) + b'ping')
+        self.assertEqual(socks.NO_AUTH_GREETING, await reader.readexactly(2))
+        reply = await reader.readexactly(10)
+        self.assertEqual(socks.REP.SUCCEEDED.value, reply[1])
+        self.assertEqual(b'ping', await reader.read())
+        writer.close()
+        server.close()
+        dest.close()
+        await asyncio.sleep(0.01)
+        self.assertEqual(0, len(client.users))
+
+    def test_relay(self):
+        self.loop.run_until_complete(asyncio.wait_for(self.relay(), 5))
+
+
+class TestServers(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    async def failover(self):
+        listeners = [await self.loop.create_server(
+            TunnelServer, '127.0.0.1', 0) for _ in range(2)]
+        client = TunnelClient()
+        client.wheel = timer.get_wheel(self.loop)
+        client.servers = Servers([listener.sockets[0].getsockname()[:2]
+                                  for listener in listeners])
+        first, second = client.servers
+        for server in client.servers:
+            await client._probe(server)
+            self.assertIsNotNone(server.tunnel)
+            self.assertIsNotNone(server.srtt)
+        # a probe of an open tunnel keeps it
+        tunnel = first.tunnel
+        await client._probe(first)
+        self.assertIs(tunnel, first.tunnel)
+        # tunnel lost, new channels go to the other server
+        best = client.servers.best()
+        other = second if best is first else first
+        listeners[list(client.servers).index(best)].close()
+        best.tunnel.writer.transport.abort()
+        await asyncio.sleep(0.05)
+        self.assertIs(other, client.servers.best())
+        self.assertIsNone(best.tunnel)
+        self.assertEqual(1, best.failures)
+        other.tunnel.task.cancel()
+        await asyncio.sleep(0)
+        for listener in listeners:
+            listener.close()
+
+    def test_failover(self):
+        self.loop.run_until_complete(asyncio.wait_for(self.failover(), 5))
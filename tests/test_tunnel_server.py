@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+import os
+import struct
+import asyncio
+from unittest import TestCase
+from fsocks import protocol, cryption, socks, config
+from fsocks.fuzzing import FuzzChain, XOR, Base85
+from fsocks.tunnel_server import TunnelServer, Tunnel, Channel
+from tests.helpers import FakeTransport, FakeWheel
+
+
+class FakeTunnel:
+    def __init__(self):
+        self.packets = []
+        self.nbytes = 0
+
+    def handle_request(self, packet):
+        self.packets.append(packet)
+
+
+class TestReceiveRing(TestCase):
+    def setUp(self):
+        self.server = TunnelServer()
+        self.server.ring_size = 4096
+        self.server.min_read = 1024
+        self.server.connection_made(FakeTransport())
+        self.server.state = TunnelServer.OPEN
+        self.server.ciphers = protocol.Ciphers(None, FuzzChain([XOR()]))
+        self.server.tunnel = FakeTunnel()
+
+    def tearDown(self):
+        self.server.tunnel = None
+        self.server.connection_lost(None)
+
+    def feed(self, data, chunk):
+        while data:
+            buf = self.server.get_buffer(-1)
+            n = min(len(buf), len(data), chunk)
+            buf[:n] = data[:n]
+            data = data[n:]
+            self.server.buffer_updated(n)
+
+    def test_frames(self):
+        payloads = [os.urandom(n) for n in (1, 3000, 10000, 500, 0, 70)]
+        fuzz = self.server.ciphers.fuzz
+        data = b''.join(protocol.Relaying(1, 2, p).to_packet(fuzz)
+                        for p in payloads)
+        for chunk in 1000, 7, len(data):
+            self.server.tunnel.packets = []
+            self.feed(data, chunk)
+            self.assertEqual(payloads, [bytes(p.payload) for p in
+                                        self.server.tunnel.packets])
+            # nothing left, ring shrunk back after the big frame
+            self.assertEqual(0, self.server.end)
+            self.assertEqual(4096, len(self.server.ring))
+
+
+class TestRenegotiate(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.transport = FakeTransport()
+        self.offer = [Base85(), XOR(b'\x26')]
+        self.ciphers = protocol.Ciphers(cryption.AES256CBC('password'),
+                                        FuzzChain(self.offer))
+        self.tunnel = Tunnel(self.transport, self.ciphers, self.offer)
+
+    def tearDown(self):
+        self.tunnel.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_cheapest(self):
+        self.assertTrue(self.tunnel.renegotiate())
+        # one at a time
+        self.assertFalse(self.tunnel.renegotiate())
+        self.loop.run_until_complete(asyncio.sleep(0))
+        header, data = self.transport.written
+        etype, = struct.unpack_from('!H', header)
+        self.assertEqual(1 << 8, etype)
+        self.assertEqual(1, self.ciphers.epoch)
+        self.assertEqual([self.offer[1]], self.ciphers.fuzz.fuzz_list)
+        # client switched
+        shake = self.ciphers.decode(etype, data)
+        self.tunnel.handle_request(shake)
+        self.assertFalse(self.ciphers.switching)
+        self.assertFalse(self.tunnel.renegotiate())
+
+
+class TestFlow(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.transport = FakeTransport()
+        self.tunnel = Tunnel(self.transport, protocol.Ciphers(
+            None, FuzzChain([XOR()])))
+        self.tunnel.scheduler.channel_limit = 1000
+        self.chan = self.open(1)
+
+    def tearDown(self):
+        self.tunnel.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def open(self, user):
+        chan = Channel(self.tunnel, user)
+        chan.remote = self.tunnel.remotes.add(chan)
+        chan.remote_transport = FakeTransport()
+        chan.state = Channel.DATA
+        self.tunnel.channels[user] = chan
+        return chan
+
+    def flow(self, chan, paused):
+        self.tunnel.handle_request(
+            protocol.Flow(chan.user, chan.remote, paused))
+
+    def test_pause(self):
+        other = self.open(2)
+        self.flow(self.chan, True)
+        self.assertFalse(self.chan.remote_transport.reading)
+        self.assertTrue(other.remote_transport.reading)
+        # FLOW of another user's channel is ignored
+        self.tunnel.handle_request(protocol.Flow(2, self.chan.remote, False))
+        self.assertFalse(self.chan.remote_transport.reading)
+        self.flow(self.chan, False)
+        self.assertTrue(self.chan.remote_transport.reading)
+
+    def test_backlog(self):
+        # scheduler and user both pause, reading resumes after both
+        self.transport.buffered = 1 << 20
+        self.tunnel.scheduler.pause()
+        for _ in range(2):
+            self.tunnel.write(protocol.Relaying(
+                self.chan.remote, 1, b'x' * 1000), self.chan)
+        self.assertFalse(self.chan.remote_transport.reading)
+        self.flow(self.chan, True)
+        self.transport.buffered = 0
+        self.tunnel.scheduler.resume()
+        self.tunnel.scheduler.flush()
+        self.assertFalse(self.chan.remote_transport.reading)
+        self.flow(self.chan, False)
+        self.assertTrue(self.chan.remote_transport.reading)
+
+
+class TestConnect(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.transport = FakeTransport()
+        self.ciphers = protocol.Ciphers(None, FuzzChain([XOR()]))
+        self.tunnel = Tunnel(self.transport, self.ciphers)
+
+    def tearDown(self):
+        self.tunnel.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def packets(self):
+        parts = self.transport.written
+        return [self.ciphers.decode(struct.unpack_from('!H', header)[0],
+                                    data)
+                for header, data in zip(parts[::2], parts[1::2])]
+
+    async def banner(self):
+        async def greet(reader, writer):
+            writer.write(b'220 ready\r\n')
+            await writer.drain()
+        dest = await asyncio.start_server(greet, '127.0.0.1', 0)
+        create_connection = self.loop.create_connection
+
+        async def slow_connection(*args, **kwargs):
+            # the banner arrives before the channel is attached
+            connection = await create_connection(*args, **kwargs)
+            await asyncio.sleep(0.05)
+            return connection
+        self.loop.create_connection = slow_connection
+        chan = Channel(self.tunnel, 1)
+        chan.remote = self.tunnel.remotes.add(chan)
+        self.tunnel.channels[1] = chan
+        await chan.connect(*dest.sockets[0].getsockname()[:2])
+        await asyncio.sleep(0.05)
+        chan.close(notify=False)
+        dest.close()
+
+    def test_banner(self):
+        self.loop.run_until_complete(asyncio.wait_for(self.banner(), 5))
+        reply, relaying = self.packets()
+        self.assertIs(protocol.MTYPE.REPLY, reply.mtype)
+        self.assertIs(socks.REP.SUCCEEDED, reply.msg.code)
+        self.assertEqual(b'220 ready\r\n', bytes(relaying.payload))
+
+
+class TestChannels(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.transport = FakeTransport()
+        self.ciphers = protocol.Ciphers(None, FuzzChain([XOR()]))
+        self.tunnel = Tunnel(self.transport, self.ciphers)
+        self.tunnel.wheel = FakeWheel()
+
+    def tearDown(self):
+        self.tunnel.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def open(self, user):
+        chan = Channel(self.tunnel, user)
+        chan.remote = self.tunnel.remotes.add(chan)
+        chan.remote_transport = FakeTransport()
+        chan.state = Channel.DATA
+        self.tunnel.channels[user] = chan
+        chan.touch()
+        return chan
+
+    def packets(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+        parts = self.transport.written
+        self.transport.written = []
+        return [self.ciphers.decode(struct.unpack_from('!H', header)[0],
+                                    data)
+                for header, data in zip(parts[::2], parts[1::2])]
+
+    def test_remove(self):
+        chan = self.open(1)
+        remote_transport = chan.remote_transport
+        self.assertEqual(1, len(self.tunnel.wheel))
+        self.tunnel.handle_request(protocol.Close(1))
+        self.assertEqual({}, self.tunnel.channels)
+        self.assertIsNone(self.tunnel.remotes.get(chan.remote))
+        self.assertEqual(0, len(self.tunnel.remotes))
+        self.assertEqual(0, len(self.tunnel.wheel))
+        self.assertTrue(remote_transport.closing)
+        close, = self.packets()
+        self.assertIs(protocol.MTYPE.CLOSE, close.mtype)
+        self.assertEqual(1, close.src)
+        # freed slot is reused, stale id stays unknown
+        self.assertIs(self.open(2), self.tunnel.remotes.get(
+            self.tunnel.channels[2].remote))
+        self.assertIsNone(self.tunnel.remotes.get(chan.remote))
+
+    def test_unknown(self):
+        chan = self.open(1)
+        self.tunnel.handle_request(protocol.Relaying(1, 99, b'x'))
+        # ids of another user's channel
+        self.tunnel.handle_request(protocol.Relaying(2, chan.remote, b'x'))
+        self.tunnel.handle_request(protocol.Datagram(3, 99, []))
+        # not an association
+        self.tunnel.handle_request(protocol.Datagram(1, chan.remote, []))
+        packets = self.packets()
+        self.assertEqual({protocol.MTYPE.CLOSE}, {p.mtype for p in packets})
+        # queued per user, in round-robin order
+        self.assertEqual([1, 1, 2, 3], sorted(p.src for p in packets))
+        # CLOSE of unknown channels is ignored
+        self.tunnel.handle_request(protocol.Close(4))
+        self.assertEqual([], self.packets())
+        self.assertIs(chan, self.tunnel.channels[1])
+
+    def test_idle(self):
+        wheel = self.tunnel.wheel
+        chan = self.open(1)
+        wheel.advance(config.idle_timeout - 1)
+        chan.forward(b'x')
+        wheel.advance(1)
+        # active meanwhile, rescheduled for the time left
+        self.assertEqual(Channel.DATA, chan.state)
+        self.assertEqual(1, len(wheel))
+        wheel.advance(config.idle_timeout - 2)
+        self.assertEqual(Channel.DATA, chan.state)
+        wheel.advance(1)
+        self.assertEqual(Channel.CLOSED, chan.state)
+        self.assertEqual({}, self.tunnel.channels)
+        self.assertEqual(0, len(wheel))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+import socket
+import asyncio
+from unittest import TestCase
+from fsocks.udp import Batcher, Resolver
+
+
+class TestBatcher(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_basic(self):
+        batches = []
+        batcher = Batcher(batches.append, max_bytes=100)
+        for i in range(3):
+            batcher.add(('127.0.0.1', 53), b'x' * 10)
+        self.assertEqual([], batches)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(1, len(batches))
+        self.assertEqual(3, len(batches[0]))
+        # flushed early once max_bytes are pending
+        batcher.add(('127.0.0.1', 53), b'x' * 60)
+        batcher.add(('127.0.0.1', 53), b'x' * 60)
+        self.assertEqual(2, len(batches))
+        batcher.add(('127.0.0.1', 53), b'x')
+        batcher.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(2, len(batches))
+
+    def test_resolver(self):
+        resolver = Resolver()
+        self.assertIsNone(resolver.lookup('127.0.0.1'))
+        family, addr = self.loop.run_until_complete(
+            resolver.resolve('127.0.0.1', 53))
+        self.assertEqual(socket.AF_INET, family)
+        self.assertEqual(('127.0.0.1', 53), addr)
+        self.assertEqual((socket.AF_INET, '127.0.0.1'),
+                         resolver.lookup('127.0.0.1'))